@@ -1,10 +1,13 @@
+import io
 import unittest
 import uuid
 
 import psycopg
-from google import protobuf
+from google.protobuf.internal import decoder
 
 from example.config import Config
+from py_protodb import runtime
+from example.public import example_a_db, product_db
 from example.test_schema import user_db
 
 
@@ -18,8 +21,6 @@ class CRUDTestCase(unittest.TestCase):
         password = self.config.get_config()['database']['password']
         self.conn_str = f'host={host} port={port} dbname={dbname} user={user} password={password}'
         self.conn = psycopg.connect(self.conn_str)
-        self.conn.adapters.register_dumper(protobuf.pyext._message.RepeatedScalarContainer,
-                                           psycopg.types.array.ListDumper)
 
     def tearDown(self) -> None:
         print('------------------- CLEANING UP -------------------\n')
@@ -29,6 +30,16 @@ class CRUDTestCase(unittest.TestCase):
             self.conn.execute(q)
         self.conn.close()
 
+    def create_users(self, count: int):
+        users = []
+        for i in range(count):
+            user = user_db.User(first_name='Bryan', last_name=f'Hughes {i}', user_state='living',
+                                user_type='BIG_SHOT', email=f'hughesb+{i}@gmail.com',
+                                user_token=str(uuid.uuid4()), enabled=True)
+            user.created_on.GetCurrentTime()
+            users.append(user_db.create(self.conn, user))
+        return users
+
     def test_crud(self):
         user = user_db.User(
             first_name='Bryan',
@@ -77,6 +88,243 @@ class CRUDTestCase(unittest.TestCase):
 
         self.conn.close()
 
+    def test_mappings(self):
+        users = []
+        for i in range(5):
+            user = user_db.User(first_name='Bryan', last_name=f'Hughes {i}', user_state='living',
+                                user_type='BIG_SHOT', email=f'hughesb+{i}@gmail.com',
+                                user_token=str(uuid.uuid4()), enabled=True)
+            user.created_on.GetCurrentTime()
+            users.append(user_db.create(self.conn, user))
+
+        results = list(user_db.list_by_user_type(self.conn, 'BIG_SHOT', 10, 0, fetch_size=2))
+        self.assertEqual(sorted(u.user_id for u in users), sorted(r.user_id for r in results))
+
+        self.assertEqual(1, user_db.update_pword_hash(self.conn, 'secret', users[0].email))
+        self.assertEqual(['secret'], [r.pword_hash for r in user_db.get_pword_hash(self.conn, users[0].email)])
+
+        tokens = user_db.set_token(self.conn, users[0].user_id)
+        self.assertEqual(1, len(tokens))
+        self.assertNotEqual(users[0].user_token, tokens[0].user_token)
+
+        self.conn.commit()
+        self.conn.close()
+
+    def test_mapping_clears_cache(self):
+        user = self.create_users(1)[0]
+        self.assertEqual(user.user_token, user_db.read(self.conn, user.user_id).user_token)
+        tokens = user_db.set_token(self.conn, user.user_id)
+        self.assertEqual(tokens[0].user_token, user_db.read(self.conn, user.user_id).user_token)
+        self.assertEqual(1, user_db.set_user_type(self.conn, 'LITTLE-SHOT', user.user_id))
+        self.assertEqual(user_db.User.LITTLE_SHOT, user_db.read(self.conn, user.user_id).user_type)
+        self.conn.close()
+
+    def test_read_if_newer(self):
+        users = []
+        for i in range(3):
+            user = user_db.User(first_name='Bryan', last_name=f'Hughes {i}', user_state='living',
+                                user_type='BIG_SHOT', email=f'hughesb+{i}@gmail.com',
+                                user_token=str(uuid.uuid4()), enabled=True)
+            user.created_on.GetCurrentTime()
+            users.append(user_db.create(self.conn, user))
+
+        self.assertEqual(user_db.UNCHANGED, user_db.read_if_newer(self.conn, users[0].user_id, users[0].version))
+        users[1].first_name = 'Big Chief'
+        updated = user_db.update(self.conn, users[1])
+        self.assertEqual(updated, user_db.read_if_newer(self.conn, users[1].user_id, users[1].version))
+        user_db.delete(self.conn, users[2])
+        self.assertIsNone(user_db.read_if_newer(self.conn, users[2].user_id, users[2].version))
+
+        results = user_db.refresh_many(self.conn, [(u.user_id, u.version) for u in users])
+        self.assertEqual([user_db.UNCHANGED, updated, None], results)
+        self.conn.close()
+
+    def test_update_fields(self):
+        user = user_db.User(first_name='Bryan', last_name='Hughes', user_state='living', user_type='BIG_SHOT',
+                            email='hughesb@gmail.com', user_token=str(uuid.uuid4()), enabled=True)
+        user.created_on.GetCurrentTime()
+        base = user_db.create(self.conn, user)
+
+        changed = user_db.User()
+        changed.CopyFrom(base)
+        self.assertIs(changed, user_db.update_fields(self.conn, changed, base=base))
+        changed.first_name = 'Big Chief'
+        updated = user_db.update_fields(self.conn, changed, base=base)
+        self.assertEqual(('Big Chief', 'Hughes', 1), (updated.first_name, updated.last_name, updated.version))
+        # The version guard still applies, base is now stale
+        self.assertIsNone(user_db.update_fields(self.conn, base, fields=['last_name']))
+        self.conn.close()
+
+    def test_export_stream(self):
+        created = []
+        for i in range(5):
+            user = user_db.User(first_name='Bryan', last_name=f'Hughes {i}', user_state='living',
+                                user_type='BIG_SHOT', email=f'hughesb+{i}@gmail.com',
+                                user_token=str(uuid.uuid4()), enabled=True)
+            user.created_on.GetCurrentTime()
+            created.append(user_db.create(self.conn, user))
+        self.conn.commit()
+
+        out = io.BytesIO()
+        self.assertEqual(2, user_db.export_stream(self.conn, out, 'user_id = ANY(%s)',
+                                                  [[u.user_id for u in created[:2]]]))
+        data, pos, exported = out.getvalue(), 0, []
+        while pos < len(data):
+            size, pos = decoder._DecodeVarint(data, pos)
+            exported.append(user_db.User.FromString(data[pos:pos + size]))
+            pos += size
+        self.assertEqual(sorted(created[:2], key=lambda u: u.user_id), sorted(exported, key=lambda u: u.user_id))
+        self.conn.close()
+
+    def test_import_stream(self):
+        out = io.BytesIO()
+        for i in range(25):
+            user = user_db.User(first_name='Bryan', last_name=f'Hughes {i}', user_state='living',
+                                user_type='BIG_SHOT', email=f'hughesb+{i}@gmail.com',
+                                user_token=str(uuid.uuid4()), enabled=True)
+            user.created_on.GetCurrentTime()
+            if i == 7:
+                # Does not bind, email is NOT NULL
+                user.ClearField('email')
+            elif i == 12:
+                # Refused by the database, email is unique
+                user.email = 'hughesb+11@gmail.com'
+            runtime.write_delimited(out, user)
+        out.seek(0)
+
+        progress, rejects = [], []
+        imported, rejected = user_db.import_stream(self.conn, out, batch_size=10,
+                                                   progress=lambda *counts: progress.append(counts),
+                                                   on_reject=lambda ordinal, data, error: rejects.append(ordinal))
+        self.conn.commit()
+        self.assertEqual((23, 2), (imported, rejected))
+        self.assertEqual([7, 12], rejects)
+        self.assertEqual([(9, 1), (18, 2), (23, 2)], progress)
+
+        out = io.BytesIO()
+        self.assertEqual(23, user_db.export_stream(self.conn, out))
+        out.seek(0)
+        self.assertEqual({0}, {user_db.User.FromString(data).version for data in runtime.read_delimited(out)})
+        self.conn.close()
+
+    def test_read_delete_many(self):
+        users = self.create_users(3)
+        keys = [users[2].user_id, -1, users[0].user_id]
+        self.assertEqual([users[2], None, users[0]], user_db.read_many(self.conn, keys))
+        self.assertEqual([True, False, True], user_db.delete_many(self.conn, keys))
+        self.assertEqual([None, users[1]], user_db.read_many(self.conn, [users[0].user_id, users[1].user_id]))
+        self.assertEqual([False, True], user_db.delete_many(self.conn, [users[0].user_id, users[1].user_id]))
+        self.assertEqual([], user_db.read_many(self.conn, []))
+        self.assertEqual([], user_db.delete_many(self.conn, []))
+        self.conn.close()
+
+    def test_read_many_key_types(self):
+        # The keys only have to be castable to the column type, they are never compared with the proto fields
+        users = self.create_users(2)
+        keys = [str(users[1].user_id), str(users[0].user_id), '-1']
+        self.assertEqual([users[1], users[0], None], user_db.read_many(self.conn, keys))
+        self.conn.close()
+
+    def test_read_delete_many_composite(self):
+        for (a, b) in [('a', '1'), ('a', '2'), ('b', '1')]:
+            self.conn.execute('INSERT INTO public.example_a (column_a, column_b, column_i) VALUES (%s, %s, %s)',
+                              [a, b, a + b])
+        keys = [('b', '1'), ('a', '3'), ('a', '1')]
+        found = example_a_db.read_many(self.conn, keys)
+        self.assertEqual([('b', '1'), None, ('a', '1')],
+                         [None if proto is None else (proto.column_a, proto.column_b) for proto in found])
+        self.assertEqual([True, False, True], example_a_db.delete_many(self.conn, keys))
+        self.assertEqual([False, True], example_a_db.delete_many(self.conn, [('a', '1'), ('a', '2')]))
+        self.assertEqual([None, None], example_a_db.read_many(self.conn, [('a', '2'), ('b', '1')]))
+        self.conn.close()
+
+    def test_upsert(self):
+        (user,) = self.create_users(1)
+        user.ClearField('user_id')
+        user.ClearField('version')
+        user.email = 'bigchief@gmail.com'
+        (status, inserted) = user_db.upsert(self.conn, user, check_version=True)
+        self.assertEqual((user_db.INSERTED, 0), (status, inserted.version))
+
+        inserted.first_name = 'Big Chief'
+        (status, updated) = user_db.upsert(self.conn, inserted, check_version=True)
+        self.assertEqual((user_db.UPDATED, 'Big Chief', 1), (status, updated.first_name, updated.version))
+        self.assertEqual(inserted.user_id, updated.user_id)
+
+        # inserted is now stale, it is only written when the versions are not checked
+        self.assertEqual((user_db.SKIPPED, None), user_db.upsert(self.conn, inserted, check_version=True))
+        (status, updated) = user_db.upsert(self.conn, inserted)
+        self.assertEqual((user_db.UPDATED, 2), (status, updated.version))
+        self.conn.close()
+
+    def test_upsert_many(self):
+        (stale, fresh) = self.create_users(2)
+        self.assertEqual(1, user_db.update(self.conn, stale).version)
+        stale.first_name = 'Stale'
+        fresh.first_name = 'Fresh'
+        user = user_db.User()
+        user.CopyFrom(fresh)
+        user.ClearField('user_id')
+        user.ClearField('version')
+        user.email = 'bigchief@gmail.com'
+
+        results = user_db.upsert_many(self.conn, [user, stale, fresh], check_version=True)
+        self.assertEqual([user_db.INSERTED, user_db.SKIPPED, user_db.UPDATED], [status for (status, _) in results])
+        self.assertEqual(('bigchief@gmail.com', 0), (results[0][1].email, results[0][1].version))
+        self.assertIsNone(results[1][1])
+        self.assertEqual((fresh.user_id, 'Fresh', 1),
+                         (results[2][1].user_id, results[2][1].first_name, results[2][1].version))
+
+        results = user_db.upsert_many(self.conn, [stale])
+        self.assertEqual([(user_db.UPDATED, 'Stale', 2)],
+                         [(status, proto.first_name, proto.version) for (status, proto) in results])
+        self.assertEqual([], user_db.upsert_many(self.conn, []))
+        self.conn.close()
+
+    def test_list_paging(self):
+        users = self.create_users(5)
+        for i in [1, 3]:
+            users[i].enabled = False
+            users[i] = user_db.update(self.conn, users[i])
+
+        # list_by_user_type_enabled is on (enabled, user_type), its comment orders it by enabled DESC
+        expected = [u.user_id for u in sorted(users, key=lambda u: (u.enabled, u.user_id), reverse=True)]
+        self.assertEqual(expected, [u.user_id for u in user_db.list_by_user_type_enabled(self.conn)])
+
+        pages, after = [], None
+        while True:
+            page = list(user_db.list_by_user_type_enabled(self.conn, after=after, limit=2, fetch_size=1))
+            if len(page) == 0:
+                break
+            pages.append([u.user_id for u in page])
+            after = user_db.list_by_user_type_enabled_key(page[-1])
+        self.assertEqual([expected[0:2], expected[2:4], expected[4:]], pages)
+        self.conn.close()
+
+    def test_lookup(self):
+        users = self.create_users(2)
+        self.assertEqual(users[1], user_db.lookup_by_email(self.conn, users[1].email))
+        self.assertIsNone(user_db.lookup_by_email(self.conn, 'nobody@gmail.com'))
+        self.assertEqual([users[1], None, users[0]],
+                         user_db.lookup_many_by_email(self.conn, [users[1].email, 'nobody@gmail.com', users[0].email]))
+        self.assertEqual([], user_db.lookup_many_by_email(self.conn, []))
+        self.conn.close()
+
+    def test_lookup_stream(self):
+        ids = {}
+        for (name, sku) in [('a', 'sku-1'), ('b', 'sku-2'), ('c', 'sku-1')]:
+            cur = self.conn.execute('INSERT INTO public.product (product_name, sku, produced) VALUES (%s, %s, now()) '
+                                    'RETURNING product_id', [name, sku])
+            ids[name] = cur.fetchone()[0]
+
+        # The rows of a key come in primary key order
+        self.assertEqual([ids['a'], ids['c']], [p.product_id for p in product_db.lookup_by_sku(self.conn, 'sku-1')])
+        self.assertEqual([], list(product_db.lookup_by_sku(self.conn, 'sku-3')))
+        results = product_db.lookup_many_by_sku(self.conn, ['sku-2', 'sku-3', 'sku-1'], fetch_size=1)
+        self.assertEqual([('sku-2', ids['b']), ('sku-1', ids['a']), ('sku-1', ids['c'])],
+                         [(key, p.product_id) for (key, p) in results])
+        self.conn.close()
+
 
 if __name__ == '__main__':
     unittest.main()
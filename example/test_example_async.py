@@ -0,0 +1,92 @@
+import asyncio
+import unittest
+import uuid
+
+import psycopg
+
+from example.config import Config
+from example.test_schema import user_db_async
+
+CONNECTIONS = 8
+USERS = 200
+
+
+class AsyncCRUDTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.config = Config('config/example.yaml')
+        host = self.config.get_config()['database']['host']
+        port = self.config.get_config()['database']['port']
+        dbname = self.config.get_config()['database']['database']
+        user = self.config.get_config()['database']['user']
+        password = self.config.get_config()['database']['password']
+        self.conn_str = f'host={host} port={port} dbname={dbname} user={user} password={password}'
+
+    def tearDown(self) -> None:
+        print('------------------- CLEANING UP -------------------\n')
+        queries = ["DELETE FROM test_schema.user"]
+        conn = psycopg.connect(self.conn_str, autocommit=True)
+        for q in queries:
+            conn.execute(q)
+        conn.close()
+
+    @staticmethod
+    def new_user(i: int):
+        user = user_db_async.User(
+            first_name='Bryan',
+            last_name=f'Hughes {i}',
+            user_state='living',
+            user_type='BIG_SHOT',
+            email=f'hughesb+{i}@gmail.com',
+            user_token=str(uuid.uuid4()),
+            enabled=True,
+            number_value=i)
+        user.created_on.GetCurrentTime()
+        user.my_array.extend([i, i + 1])
+        return user
+
+    async def crud(self, conn, i: int):
+        # The operations of one user are sequential, the users themselves run concurrently
+        user_1 = await user_db_async.create(conn, self.new_user(i))
+        self.assertIsNotNone(user_1.user_id)
+        self.assertEqual(0, user_1.version)
+
+        user_2 = await user_db_async.read(conn, user_id=user_1.user_id)
+        self.assertEqual(user_1.last_name, user_2.last_name)
+
+        user_2.first_name = 'Big Chief'
+        user_2.updated_on.GetCurrentTime()
+        user_3 = await user_db_async.update(conn, user=user_2)
+        self.assertEqual('Big Chief', user_3.first_name)
+        self.assertEqual(1, user_3.version)
+
+        await user_db_async.delete(conn, user_3)
+        self.assertIsNone(await user_db_async.read(conn, user_id=user_3.user_id))
+
+    async def test_concurrent_crud(self):
+        conns = [await psycopg.AsyncConnection.connect(self.conn_str, autocommit=True) for _ in range(CONNECTIONS)]
+        try:
+            await asyncio.gather(*[self.crud(conns[i % CONNECTIONS], i) for i in range(USERS)])
+        finally:
+            for conn in conns:
+                await conn.close()
+
+    async def test_concurrent_many(self):
+        conns = [await psycopg.AsyncConnection.connect(self.conn_str, autocommit=True) for _ in range(CONNECTIONS)]
+        try:
+            batches = [[self.new_user(b * 10 + i) for i in range(10)] for b in range(CONNECTIONS)]
+            created = await asyncio.gather(*[user_db_async.create_many(conn, batch)
+                                             for conn, batch in zip(conns, batches)])
+            for batch, users in zip(batches, created):
+                self.assertEqual([u.last_name for u in batch], [u.last_name for u in users])
+
+            keys = [u.user_id for users in created for u in users]
+            found = await user_db_async.read_many(conns[0], keys + [-1])
+            self.assertEqual(keys, [u.user_id for u in found[:-1]])
+            self.assertIsNone(found[-1])
+        finally:
+            for conn in conns:
+                await conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""Set-based introspection of a postgres schema straight from pg_catalog.
+
+Rather than running the column, index, foreign key and check constraint queries once per table, each query is run
+once for the entire schema and the rows are grouped by table name. The rows have exactly the same shape and ordering
+as the per-table queries in `postgres`, so the same loaders build the `Table`, `Column`, `Index` and `ForeignRel`
+objects from either path.
+"""
+from typing import Dict, List
+
+# A generated column has no default, as in information_schema.columns
+READ_SCHEMA_COLUMNS = """SELECT
+        c.relname AS table_name,
+        a.attname AS column_name,
+        a.attnum AS ordinal_position,
+        CASE
+            WHEN t.typtype = 'd' THEN
+                CASE
+                    WHEN bt.typelem <> 0 AND bt.typlen = -1 THEN 'ARRAY'
+                    WHEN bns.nspname = 'pg_catalog' THEN format_type(t.typbasetype, NULL)
+                    ELSE 'USER-DEFINED'
+                END
+            ELSE
+                CASE
+                    WHEN t.typelem <> 0 AND t.typlen = -1 THEN 'ARRAY'
+                    WHEN tns.nspname = 'pg_catalog' THEN format_type(a.atttypid, NULL)
+                    ELSE 'USER-DEFINED'
+                END
+        END AS data_type,
+        format_type(COALESCE(bt.oid, t.oid), NULL) AS udt_name,
+        CASE WHEN a.attgenerated = '' THEN pg_get_expr(ad.adbin, ad.adrelid) END AS column_default,
+        CASE WHEN a.attnotnull OR (t.typtype = 'd' AND t.typnotnull) THEN 'NO' ELSE 'YES' END AS is_nullable,
+        EXISTS (
+            SELECT 1
+            FROM pg_index pi
+            WHERE pi.indrelid = c.oid
+                AND pi.indisprimary = true
+                AND a.attnum = ANY(pi.indkey)
+        ) AS is_pkey,
+        pg_get_serial_sequence(quote_ident(ns.nspname) || '.' || quote_ident(c.relname), a.attname)
+            IS NOT NULL AS is_seq
+    FROM
+        pg_namespace ns
+        JOIN pg_class c ON
+            c.relnamespace = ns.oid
+            AND c.relkind IN ('r', 'p')
+            AND c.relispartition = 'f'
+        JOIN pg_attribute a ON
+            a.attrelid = c.oid
+            AND a.attnum > 0
+            AND NOT a.attisdropped
+        JOIN pg_type t ON
+            t.oid = a.atttypid
+        JOIN pg_namespace tns ON
+            tns.oid = t.typnamespace
+        LEFT OUTER JOIN pg_type bt ON
+            t.typtype = 'd'
+            AND bt.oid = t.typbasetype
+        LEFT OUTER JOIN pg_namespace bns ON
+            bns.oid = bt.typnamespace
+        LEFT OUTER JOIN pg_attrdef ad ON
+            ad.adrelid = a.attrelid
+            AND ad.adnum = a.attnum
+    WHERE
+        ns.nspname = %s
+    ORDER BY table_name, ordinal_position"""
+
+READ_SCHEMA_INDEXES = """SELECT
+        t.relname AS table_name,
+        i.relname AS index_name,
+        a.attname AS column_name,
+        ix.indisunique is_unique,
+        ix.indisprimary is_pkey,
+        ix.indpred IS NOT NULL OR ix.indexprs IS NOT NULL AS is_partial,
+        obj_description(i.oid) AS comment
+    FROM
+        pg_class t,
+        pg_class i,
+        pg_index ix,
+        pg_attribute a,
+        pg_namespace ns
+    WHERE
+        t.oid = ix.indrelid
+        AND i.oid = ix.indexrelid
+        AND a.attrelid = t.oid
+        AND a.attnum = ANY(ix.indkey)
+        AND t.relkind = 'r'
+        AND t.relnamespace = ns.oid
+        AND ns.nspname = %s
+    ORDER BY
+        table_name, index_name, array_position(ix.indkey::int2[], a.attnum)"""
+
+# ordinal_position is the position of the referenced column in the referenced key, like the position_in_unique_constraint
+# the per table query takes from information_schema
+READ_SCHEMA_FOREIGN_RELATIONSHIPS = """SELECT
+        cls.relname AS table_name,
+        con.conname AS constraint_name,
+        fns.nspname AS foreign_schema,
+        fcls.relname AS foreign_table,
+        fa.attname AS foreign_column,
+        la.attname AS local_column,
+        array_position(ucon.conkey, k.foreign_num) AS ordinal_position
+    FROM
+        pg_constraint con
+        JOIN pg_class cls ON
+            cls.oid = con.conrelid
+        JOIN pg_namespace ns ON
+            ns.oid = cls.relnamespace
+        JOIN pg_class fcls ON
+            fcls.oid = con.confrelid
+        JOIN pg_namespace fns ON
+            fns.oid = fcls.relnamespace
+        JOIN pg_constraint ucon ON
+            ucon.conrelid = con.confrelid
+            AND ucon.conindid = con.conindid
+            AND ucon.contype IN ('p', 'u')
+        CROSS JOIN LATERAL unnest(con.conkey, con.confkey) AS k(local_num, foreign_num)
+        JOIN pg_attribute la ON
+            la.attrelid = con.conrelid
+            AND la.attnum = k.local_num
+        JOIN pg_attribute fa ON
+            fa.attrelid = con.confrelid
+            AND fa.attnum = k.foreign_num
+    WHERE
+        con.contype = 'f'
+        AND ns.nspname = %s
+    ORDER BY
+        table_name, foreign_schema, foreign_table, constraint_name, ordinal_position"""
+
+READ_SCHEMA_CHECK_CONSTRAINTS = """SELECT
+        cls.relname AS table_name,
+        pg_get_constraintdef(pgc.oid) as constr
+    FROM pg_constraint pgc
+        JOIN pg_class cls ON pgc.conrelid = cls.oid
+        JOIN pg_namespace nsp ON nsp.oid = cls.relnamespace
+        CROSS JOIN LATERAL unnest(pgc.conkey) AS k(attnum)
+    WHERE
+        contype ='c'
+        AND nsp.nspname = %s
+    ORDER BY
+        table_name, pgc.conname"""
+
+
+class Catalog:
+    """Reads the columns, indexes, foreign relationships and check constraints for every table in a schema using one
+    query each. The resulting rows are keyed by table name with the table name column removed.
+    """
+    def __init__(self, conn, schema_name: str):
+        self.conn = conn
+        self.name = schema_name
+        self.columns = self.read_grouped(READ_SCHEMA_COLUMNS)
+        self.indexes = self.read_grouped(READ_SCHEMA_INDEXES)
+        self.relations = self.read_grouped(READ_SCHEMA_FOREIGN_RELATIONSHIPS)
+        self.constraints = self.read_grouped(READ_SCHEMA_CHECK_CONSTRAINTS)
+
+    def read_grouped(self, query: str) -> Dict[str, List[tuple]]:
+        grouped = {}
+        cur = self.conn.execute(query, (self.name,))
+        for record in cur:
+            grouped.setdefault(record[0], []).append(tuple(record[1:]))
+        cur.close()
+        return grouped
+
+    def get_columns(self, table_name: str) -> List[tuple]:
+        return self.columns.get(table_name, [])
+
+    def get_indexes(self, table_name: str) -> List[tuple]:
+        return self.indexes.get(table_name, [])
+
+    def get_relations(self, table_name: str) -> List[tuple]:
+        return self.relations.get(table_name, [])
+
+    def get_constraints(self, table_name: str) -> List[tuple]:
+        return self.constraints.get(table_name, [])
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 import os
+from dataclasses import dataclass
 from datetime import datetime
 from re import sub
+from textwrap import indent
+from typing import Dict, List
 
-from config import Config
+import postgres_datatypes
+from config import Config, InvalidConfigError
 from database import Database
-from schema import Table
+from emitter import Emitter, Template
+from schema import Table, Column, Statement, IndexType
 
 
 def camel_case(s):
@@ -23,6 +28,545 @@ def cap_camel_case(s):
     return ''.join([s[0].upper(), s[1:]])
 
 
+DEFAULT_FETCH_SIZE = 1000
+DEFAULT_IMPORT_BATCH_SIZE = 10000
+
+# generator.prepare to the value of PREPARE in the generated code
+PREPARE_MODES = {'auto': 'None', 'always': 'True', 'never': 'False'}
+
+# The fields that turn the function templates into their sync or async form
+SYNC = {'async_': '', 'await_': '', 'pooled': 'pooled', 'pooled_iter': 'pooled_iter'}
+ASYNC = {'async_': 'async ', 'await_': 'await ', 'pooled': 'async_pooled', 'pooled_iter': 'async_pooled_iter'}
+
+# uuid, enum and numeric values come back from psycopg as UUID, str and Decimal
+CASTS = {'string': 'str', 'double': 'float'}
+
+# Utility statements create_many and import_stream run with prepare=False, the SELECT export_stream wraps in COPY and
+# the two halves of the update_fields statements
+UNPREPARED = ('INSERT_MANY_STAGING', 'INSERT_MANY_TRUNCATE', 'INSERT_MANY_COPY', 'IMPORT_COPY', 'EXPORT',
+              'UPDATE_FIELDS', 'UPDATE_FIELDS_WHERE')
+
+# Templates for the generated code. Each one is compiled once, when the module is loaded.
+
+HEADER = Template("""#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# This file is automatically generated from the database schema using py-protodb
+# database:     ${database}
+# user:         ${user}
+# generated on: ${generated_on}
+# ----------------- DO NOT MAKE CHANGES DIRECTLY TO THIS FILE! -----------------
+from py_protodb import runtime
+from py_protodb.runtime import is_null, not_null, to_datetime
+from ${schema} import ${name}_pb2
+
+${cc} = ${name}_pb2.${cc}
+
+# psycopg's prepare argument: None prepares after prepare_threshold runs, True on first use, False never
+PREPARE = ${prepare}
+
+# The rows list functions fetch from their server side cursor per round trip
+FETCH_SIZE = ${fetch_size}
+
+# The rows import_stream copies per transaction
+IMPORT_BATCH_SIZE = ${import_batch_size}
+
+""")
+
+QUERY = Template("""${query_type} = "${sql}"
+""")
+
+ENUM_VALUE = Template("""def ${cname}_value(enum):
+    match enum:
+        case None:
+            return None
+""")
+
+ENUM_VALUE_CASE = Template("""        case ${name}_pb2.${cc}.${label}:
+            return '${value}'
+""")
+
+VALUE_ENUM = Template("""${const}_ENUMS = {
+""")
+
+VALUE_ENUM_CASE = Template("""    '${value}': ${name}_pb2.${cc}.${label},
+""")
+
+VALUE_ENUM_END = Template("""}
+
+
+def ${cname}_enum(value):
+    return ${const}_ENUMS.get(value)
+
+
+""")
+
+CONFIGURE_PREPARE = Template("""def configure_prepare(conn):
+    # Call once for each new connection, e.g. from the configure callback of a connection pool. This only sizes the
+    # connection's statement cache for the module's statements, or turns preparing off when PREPARE is False. Each
+    # statement is still prepared by its first execution.
+    runtime.configure_prepare(conn, __name__, PREPARE, ${statements})
+
+
+""")
+
+MAKE_ROW = Template("""def make_row(values):
+    # Builds the message straight from a row of the table's columns, the conversion of each column is fixed here
+    (${values}) = values
+    out = ${cc}()
+""")
+
+SET_NULLABLE = Template("""    if ${cname} is not None:
+        ${assign}
+""")
+
+SET_ARRAY = Template("""    if len(${cname}) > 0:
+        out.${cname}.extend(${cname})
+""")
+
+SET_FIELD = Template("""    ${assign}
+""")
+
+SET_FIELDS_END = Template("""    return out
+
+
+""")
+
+ROW_FACTORY = Template("""def row_factory(cursor):
+    # psycopg row factory for the statements that return the table's columns
+    return make_row
+
+
+def make_tagged_row(values):
+    return values[0], make_row(values[1:])
+
+
+def tagged_row_factory(cursor):
+    # For the statements that return a tag, the upsert status or the key ordinal, before the table's columns
+    return make_tagged_row
+
+
+""")
+
+ASYNC_HEADER = Template("""#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# ------------------------------------------------------------------------------
+# This file is automatically generated from the database schema using py-protodb
+# database:     ${database}
+# user:         ${user}
+# generated on: ${generated_on}
+# ----------------- DO NOT MAKE CHANGES DIRECTLY TO THIS FILE! -----------------
+# The functions of ${module} for a psycopg AsyncConnection. The SQL and the conversions are shared with it.
+from ${schema}.${module} import *
+
+
+""")
+
+PROTO_IN_FUN = Template("""@runtime.${pooled}
+${async_}def ${fname}(conn, ${name}: ${name}_pb2.${cc}):
+    bind_args = [${params}]
+""")
+
+EXECUTE = Template("""    ${await_}conn.execute(${query_type}, bind_args, prepare=PREPARE)
+
+
+""")
+
+EXECUTE_CACHED = Template("""    ${await_}conn.execute(${query_type}, bind_args, prepare=PREPARE)
+    CACHE.invalidate(${key})
+
+
+""")
+
+EXECUTE_RETURNING_CACHED = Template("""    cur = conn.cursor(row_factory=row_factory)
+    ${await_}cur.execute(${query_type}, bind_args, prepare=PREPARE)
+    result = ${await_}cur.fetchone()
+    CACHE.invalidate(${key})
+    return result
+
+
+""")
+
+UPDATE_FIELDS_FUN = Template("""@runtime.${pooled}
+${async_}def update_fields(conn, ${name}: ${name}_pb2.${cc}, fields=None, base=None):
+    # Like update, but only sets the columns of the fields named by fields, a FieldMask or a list of names, or else of
+    # the fields that differ from base. Nothing is written when none of them changed, ${name} is returned as is.
+    changed = runtime.changed_fields(${name}, fields, base)
+    sets, bind_args = [], []
+""")
+
+UPDATE_FIELDS_SET = Template("""    if ${condition}:
+        sets.append("${clause}")
+        bind_args.extend([${params}])
+""")
+
+UPDATE_FIELDS_END = Template("""    if len(sets) == 0:
+        return ${name}
+    bind_args.extend([${params}])
+    sql = runtime.partial_update(UPDATE_FIELDS, tuple(sets), UPDATE_FIELDS_WHERE)
+""")
+
+EXECUTE_RETURNING = Template("""    cur = conn.cursor(row_factory=row_factory)
+    ${await_}cur.execute(${query_type}, bind_args, prepare=PREPARE)
+    return ${await_}cur.fetchone()
+
+
+""")
+
+COPY_TYPES = Template("""INSERT_MANY_TYPES = [${types}]
+""")
+
+CREATE_MANY_FUN = Template("""@runtime.${pooled}
+${async_}def create_many(conn, protos):
+    ${async_}with conn.transaction(), conn.cursor(row_factory=row_factory) as cur:
+        ${await_}cur.execute(INSERT_MANY_STAGING, [], prepare=False)
+        ${await_}cur.execute(INSERT_MANY_TRUNCATE, [], prepare=False)
+        ${async_}with cur.copy(INSERT_MANY_COPY) as copy:
+${set_types}            for ordinal, ${name} in enumerate(protos):
+                ${await_}copy.write_row([ordinal, ${params}])
+        ${await_}cur.execute(INSERT_MANY, [], prepare=PREPARE)
+        return ${await_}cur.fetchall()
+
+
+""")
+
+EXPORT_FUN = Template("""@runtime.${pooled}
+${async_}def export_stream(conn, out, where=None, params=()):
+    # Writes the rows, or those matching the where clause, to out as length-delimited ${cc} messages. The where clause
+    # is SQL with %s placeholders for params. The rows are streamed, returns how many were written.
+    # params stays a sequence even when empty, psycopg only turns the %% of the statement back into % when it is given
+    # parameters
+    query = EXPORT if where is None else EXPORT + ' WHERE ' + where
+    count = 0
+    ${async_}with conn.cursor() as cur:
+        # COPY does not describe the rows it sends, so take their types from the SELECT
+        ${await_}cur.execute('SELECT * FROM (' + query + ') export LIMIT 0', params)
+        types = [column.type_code for column in cur.description]
+        ${async_}with cur.copy('COPY (' + query + ') TO STDOUT${copy_format}', params) as copy:
+            copy.set_types(types)
+            ${async_}for row in copy.rows():
+                runtime.write_delimited(out, make_row(row))
+                count += 1
+    return count
+
+
+""")
+
+IMPORT_TYPES = Template("""IMPORT_TYPES = [${types}]
+""")
+
+IMPORT_ROW = Template("""def import_row(${name}: ${name}_pb2.${cc}):
+    # The row import_stream copies for a message, in COPY column order
+    return [${params}]
+
+
+""")
+
+IMPORT_COPY_FUN = Template("""${async_}def import_batch(conn, rows):
+    ${async_}with conn.cursor() as cur:
+        ${async_}with cur.copy(IMPORT_COPY) as copy:
+${set_types}            for ordinal, data, row in rows:
+                ${await_}copy.write_row(row)
+
+
+""")
+
+IMPORT_STAGING_FUN = Template("""${async_}def import_batch(conn, rows):
+    ${async_}with conn.cursor() as cur:
+        ${await_}cur.execute(INSERT_MANY_STAGING, [], prepare=False)
+        ${await_}cur.execute(INSERT_MANY_TRUNCATE, [], prepare=False)
+        ${async_}with cur.copy(INSERT_MANY_COPY) as copy:
+${set_types}            for ordinal, data, row in rows:
+                ${await_}copy.write_row([ordinal, *row])
+        ${await_}cur.execute(IMPORT, [], prepare=PREPARE)
+
+
+""")
+
+IMPORT_FUN = Template("""@runtime.${pooled}
+${async_}def import_stream(conn, infile, batch_size=IMPORT_BATCH_SIZE, progress=None, on_reject=None):
+    # Copies the length-delimited ${cc} messages of infile into the table, one transaction (or savepoint) per batch,
+    # with the version set to 0. progress(imported, rejected) is called after each batch. A message that does not parse
+    # or bind, or a row the database refuses, is passed to on_reject(ordinal, data, error) and skipped, when on_reject
+    # is None the error is raised. Returns the number of rows imported and rejected.
+    imported = rejected = 0
+    for batch in runtime.batched(enumerate(runtime.read_delimited(infile)), batch_size):
+        rows = []
+        for ordinal, data in batch:
+            try:
+                rows.append((ordinal, data, import_row(${name}_pb2.${cc}.FromString(data))))
+            except Exception as error:
+                rejected += runtime.reject(on_reject, ordinal, data, error)
+        try:
+            ${async_}with conn.transaction():
+                ${await_}import_batch(conn, rows)
+            imported += len(rows)
+        except Exception:
+            if on_reject is None:
+                raise
+            # Copy the rows of the failed batch one at a time to find the ones the database refuses
+            for row in rows:
+                try:
+                    ${async_}with conn.transaction():
+                        ${await_}import_batch(conn, [row])
+                    imported += 1
+                except Exception as error:
+                    rejected += runtime.reject(on_reject, row[0], row[1], error)
+        if progress is not None:
+            progress(imported, rejected)
+    return imported, rejected
+
+
+""")
+
+SET_COPY_TYPES = Template("""            copy.set_types(INSERT_MANY_TYPES)
+""")
+
+UPSERT_STATUS = Template("""INSERTED = 'inserted'
+UPDATED = 'updated'
+SKIPPED = 'skipped'
+""")
+
+UPSERT_FUN = Template("""@runtime.${pooled}
+${async_}def upsert(conn, ${name}: ${name}_pb2.${cc}, check_version=False):
+    bind_args = [${params}]
+    cur = conn.cursor(row_factory=tagged_row_factory)
+    ${await_}cur.execute(UPSERT, bind_args, prepare=PREPARE)
+    result = ${await_}cur.fetchone()
+    if result is None:
+        return SKIPPED, None
+    else:
+        (inserted, proto) = result
+${cache_invalidate}        return (INSERTED if inserted else UPDATED), proto
+
+
+@runtime.${pooled}
+${async_}def upsert_many(conn, protos, check_version=False):
+    args = [[${params}] for ${name} in protos]
+    if len(args) == 0:
+        return []
+    ${async_}with conn.cursor(row_factory=tagged_row_factory) as cur:
+        ${await_}cur.executemany(UPSERT, args, returning=True)
+        out = []
+        while True:
+            result = ${await_}cur.fetchone()
+            if result is None:
+                out.append((SKIPPED, None))
+            else:
+                (inserted, proto) = result
+${cache_invalidate_many}                out.append(((INSERTED if inserted else UPDATED), proto))
+            if not cur.nextset():
+                break
+        return out
+
+
+""")
+
+DELETE_MANY_FUN = Template("""@runtime.${pooled}
+${async_}def delete_many(conn, keys):
+    keys = list(keys)
+    cur = ${await_}conn.execute(DELETE_MANY, ${bind_args}, prepare=PREPARE)
+    deleted = set()
+    ${async_}for (_ordinal,) in cur:
+        key = keys[_ordinal - 1]
+        deleted.add(${key})
+${cache_invalidate}    return [${key} in deleted for key in keys]
+
+
+""")
+
+LIST_FUN = Template("""@runtime.${pooled_iter}
+${async_}def ${fname}(conn, after=None, limit=None, fetch_size=FETCH_SIZE):
+    ${async_}with conn.transaction(), conn.cursor(name=runtime.cursor_name('${fname}'), row_factory=row_factory) as cur:
+        cur.itersize = fetch_size
+        if after is None:
+            ${await_}cur.execute(${query_type}, [limit])
+        else:
+            ${await_}cur.execute(${query_type}_AFTER, [*after, limit])
+        ${async_}for proto in cur:
+            yield proto
+
+
+""")
+
+LIST_KEY_FUN = Template("""def ${fname}_key(${name}: ${name}_pb2.${cc}):
+    # The after argument that resumes ${fname} after this row
+    return ${key}
+
+
+""")
+
+LOOKUP_STREAM_FUN = Template("""@runtime.${pooled_iter}
+${async_}def ${fname}(conn, ${params}, fetch_size=FETCH_SIZE):
+    ${async_}with conn.transaction(), conn.cursor(name=runtime.cursor_name('${fname}'), row_factory=row_factory) as cur:
+        cur.itersize = fetch_size
+        ${await_}cur.execute(${query_type}, [${params}])
+        ${async_}for proto in cur:
+            yield proto
+
+
+""")
+
+LOOKUP_MANY_FUN = Template("""@runtime.${pooled}
+${async_}def ${fname}(conn, keys):
+    keys = list(keys)
+    cur = conn.cursor(row_factory=tagged_row_factory)
+    ${await_}cur.execute(${query_type}, ${bind_args}, prepare=PREPARE)
+    out = [None] * len(keys)
+    ${async_}for (_ordinal, proto) in cur:
+        out[_ordinal - 1] = proto
+    return out
+
+
+""")
+
+LOOKUP_MANY_STREAM_FUN = Template("""@runtime.${pooled_iter}
+${async_}def ${fname}(conn, keys, fetch_size=FETCH_SIZE):
+    keys = list(keys)
+    ${async_}with conn.transaction(), conn.cursor(name=runtime.cursor_name('${fname}'), row_factory=tagged_row_factory) as cur:
+        cur.itersize = fetch_size
+        ${await_}cur.execute(${query_type}, ${bind_args})
+        ${async_}for (_ordinal, proto) in cur:
+            yield keys[_ordinal - 1], proto
+
+
+""")
+
+MAPPING_SET_FUN = Template("""def set_${fname}(${values}):
+    out = ${name}_pb2.${message}()
+""")
+
+MAPPING_STREAM_FUN = Template("""@runtime.${pooled_iter}
+${async_}def ${fname}(conn${params}, fetch_size=FETCH_SIZE):
+    ${async_}with conn.transaction(), conn.cursor(name=runtime.cursor_name('${fname}')) as cur:
+        cur.itersize = fetch_size
+        ${await_}cur.execute(${query_type}, [${bind_args}])
+        ${async_}for result in cur:
+            yield set_${fname}(*result)
+
+
+""")
+
+MAPPING_RETURNING_FUN = Template("""@runtime.${pooled}
+${async_}def ${fname}(conn${params}):
+    cur = ${await_}conn.execute(${query_type}, [${bind_args}], prepare=PREPARE)
+    out = [set_${fname}(*result) ${async_}for result in cur]
+${cache_clear}    return out
+
+
+""")
+
+MAPPING_EXECUTE_FUN = Template("""@runtime.${pooled}
+${async_}def ${fname}(conn${params}):
+    cur = ${await_}conn.execute(${query_type}, [${bind_args}], prepare=PREPARE)
+${cache_clear}    return cur.rowcount
+
+
+""")
+
+IF_NEWER_ROW_FACTORY = Template("""# What read_if_newer and refresh_many return for a row still at the caller's version
+UNCHANGED = 'unchanged'
+
+
+def make_if_newer_row(values):
+    # The table's columns are all NULL, and _changed with them, when the row has not changed
+    return UNCHANGED if values[0] is None else make_row(values[1:])
+
+
+def if_newer_row_factory(cursor):
+    return make_if_newer_row
+
+
+def make_tagged_if_newer_row(values):
+    return values[0], make_if_newer_row(values[1:])
+
+
+def tagged_if_newer_row_factory(cursor):
+    return make_tagged_if_newer_row
+
+
+""")
+
+READ_IF_NEWER_FUN = Template("""@runtime.${pooled}
+${async_}def read_if_newer(conn, ${params}, known_version):
+    # None when the row is gone, UNCHANGED when its version is still known_version, the row otherwise
+    cur = conn.cursor(row_factory=if_newer_row_factory)
+    ${await_}cur.execute(SELECT_IF_NEWER, [${bind_args}], prepare=PREPARE)
+    return ${await_}cur.fetchone()
+
+
+""")
+
+REFRESH_MANY_FUN = Template("""@runtime.${pooled}
+${async_}def refresh_many(conn, keys):
+    # keys are (key, known_version) pairs. Like read_if_newer for each of them, in the order of the keys.
+    keys = list(keys)
+    cur = conn.cursor(row_factory=tagged_if_newer_row_factory)
+    ${await_}cur.execute(REFRESH_MANY, ${bind_args}, prepare=PREPARE)
+    out = [None] * len(keys)
+    ${async_}for (_ordinal, proto) in cur:
+        out[_ordinal - 1] = proto
+    return out
+
+
+""")
+
+DELETE_MANY_CACHE = Template("""    for key in keys:
+        CACHE.invalidate(${key})
+""")
+
+READ_CACHE = Template("""# The read-through cache of read, CACHE.stats() has its hit, miss and eviction counters.
+# update, delete, upsert and the foreign key updates drop the entries of the rows they write, only read puts rows in, so
+# a write that is rolled back never reaches the cache. A mapping that writes could touch any row, so it clears the
+# cache. Writes made anywhere else are only seen once the entry expires.
+CACHE = runtime.ReadCache(max_size=${max_size}, ttl=${ttl})
+
+
+""")
+
+CACHED_READ_FUN = Template("""${async_}def read(conn, ${params}):
+    key = ${key}
+    proto = CACHE.get(key)
+    if proto is None:
+        proto = ${await_}read_uncached(conn, ${params})
+        if proto is not None:
+            CACHE.put(key, proto)
+    return proto
+
+
+""")
+
+PARAMS_IN_FUN = Template("""@runtime.${pooled}
+${async_}def ${fname}(conn, ${params}):
+    cur = conn.cursor(row_factory=row_factory)
+    ${await_}cur.execute(${query_type}, [${params},], prepare=PREPARE)
+    return ${await_}cur.fetchone()
+
+
+""")
+
+
+@dataclass()
+class TableContext:
+    """Everything about a table the templates need, computed once per table"""
+    table: Table
+    name: str
+    cc: str
+    queries: Dict[str, Statement]
+    returning: List[str]
+    values: str
+    staging: List[Column]                       # The columns create_many copies, in COPY order
+    binary_copy: bool
+    binary_export: bool
+
+
+def enum_label(value: str) -> str:
+    label = value.replace('-', '_').replace(' ', '_')
+    if label[0].isdigit():
+        label = '_' + label
+    return label
+
+
 class CodeGen:
     def __init__(self, config: Config, database: Database):
         self.config = config
@@ -34,204 +578,413 @@ class CodeGen:
         self.support_record_version = self.config.get_config()['generator']['support_record_version']
         self.inject_version_column = self.config.get_config()['generator']['inject_version_column']
         self.version_column = self.config.get_config()['generator']['version_column']
-
-    def generate_code(self):
+        self.db_name = self.config.get_config()['database']['database']
+        self.db_user = self.config.get_config()['database']['user']
+        prepare = self.config.get_config()['generator'].get('prepare', 'auto')
+        if prepare not in PREPARE_MODES:
+            raise InvalidConfigError(f'Invalid configuration, generator.prepare must be one of '
+                                     f'{", ".join(PREPARE_MODES)}, not {prepare}')
+        self.prepare = PREPARE_MODES[prepare]
+        self.fetch_size = int(self.config.get_config()['generator'].get('fetch_size', DEFAULT_FETCH_SIZE))
+        self.import_batch_size = int(self.config.get_config()['generator'].get('import_batch_size',
+                                                                               DEFAULT_IMPORT_BATCH_SIZE))
+        # One timestamp for the whole run, so files written by different workers are identical to a serial run
+        self.generated_on = datetime.now()
+
+    def generate_code(self, tables: List[Table] = None):
         print(f'\n------- Generating Code --------\n')
-        for schema in self.database.schemas.values():
-            for table in schema.tables.values():
-                self.generate(table)
+        for table in self.database.get_tables(tables):
+            self.generate(table)
 
     def generate(self, table: Table):
         code_path = os.path.sep.join([self.path, table.schema])
-        suffix = self.config.get_config()['output']['suffix']
-        code_fname = os.path.sep.join([code_path, table.name + suffix + '.py'])
+        code_fname = os.path.sep.join([code_path, table.name + self.suffix + '.py'])
+        async_fname = os.path.sep.join([code_path, table.name + self.suffix + '_async.py'])
         print(f'{code_fname}')
         if not os.path.exists(code_path):
             os.makedirs(code_path)
-        self.write_code(code_fname, table)
-
-    def write_code(self, code_fname: str, table: Table):
-        with open(code_fname, 'w') as pfile:
-            now = datetime.now()
-            header = ("#!/usr/bin/env python\n"
-                      "# -*- coding: utf-8 -*-\n"
-                      "# ------------------------------------------------------------------------------\n"
-                      "# This file is automatically generated from the database schema using py-protodb\n"
-                      "# database:     " + self.config.get_config()['database']['database'] + "\n"
-                      "# user:         " + self.config.get_config()['database']['user'] + "\n"
-                      "# generated on: " + now.strftime("%m/%d/%Y, %H:%M:%S") + "\n"
-                      "# ----------------- DO NOT MAKE CHANGES DIRECTLY TO THIS FILE! -----------------\n"
-                      )
-            pfile.write(header)
-
-            cc_name = cap_camel_case(table.name)
-            pfile.write(f'from {table.schema} import {table.name}_pb2\n\n')
-            pfile.write(f'{cc_name} = {table.name}_pb2.{cc_name}\n\n')
-
-            queries = self.database.build_queries(table)
-            self.write_queries(pfile, queries)
-
-            self.maybe_write_enum_value(pfile, table)
-            self.maybe_write_value_enum(pfile, table)
-            self.write_is_null(pfile, table)
-            self.write_not_nullable(pfile, table)
-            self.write_to_datetime(pfile)
-
-            self.write_set(pfile, table)
-            self.write_proto_in_funs(pfile, table, queries, 'INSERT', 'create')
-            self.write_params_in_funs(pfile, table, queries, 'SELECT', 'read')
-            self.write_proto_in_funs(pfile, table, queries, 'UPDATE', 'update')
-            self.write_proto_in_funs(pfile, table, queries, 'DELETE', 'delete')
-
-            for rel in table.relations:
-                qname = rel.constraint_name.upper() + '_UPDATE'
-                fname = rel.constraint_name + '_update'
-                self.write_proto_in_funs(pfile, table, queries, qname, fname)
-
-            pfile.close()
-
-    @staticmethod
-    def write_queries(pfile, queries):
-        for query_type in queries:
-            (sql, _, _) = queries[query_type]
-            pfile.write(f'{query_type} = "{sql}"\n')
-        pfile.write('\n\n')
-
-    def write_proto_in_funs(self, pfile, table, queries, query_type, fname):
-        query = queries[query_type]
-        (_sql, bind_params, in_params) = query
-        cc = cap_camel_case(table.name)
-        pfile.write(f'def {fname}(conn, {table.name}: {table.name}_pb2.{cc}):\n')
+        ctx = self.build_context(table)
+        self.render(ctx).write_file(code_fname)
+        self.render_async(ctx).write_file(async_fname)
+
+    def build_context(self, table: Table) -> TableContext:
         returning = self.database.build_returning_list(table)
-        bind_columns = []
-        for bind_cname in bind_params:
-            col = table.columns[bind_cname]
-            if col.is_nullable is True:
-                binding = 'is_null(' + table.name + ', \'' + bind_cname + '\', ' + table.name + '.' + bind_cname + ')'
-            elif col.data_type != 'ARRAY':
-                binding = 'not_null(' + table.name + ', \'' + bind_cname + '\', ' + table.name + '.' + bind_cname + ')'
+        return TableContext(table, table.name, cap_camel_case(table.name), self.database.build_queries(table),
+                            returning, ', '.join(returning), self.database.build_staging_columns(table),
+                            self.database.is_binary_copy(table), self.database.is_binary_export(table))
+
+    def render(self, ctx: TableContext) -> Emitter:
+        out = Emitter(**SYNC)
+        out.emit(HEADER, database=self.db_name, user=self.db_user,
+                 generated_on=self.generated_on.strftime("%m/%d/%Y, %H:%M:%S"), schema=ctx.table.schema,
+                 name=ctx.name, cc=ctx.cc, prepare=self.prepare, fetch_size=str(self.fetch_size),
+                 import_batch_size=str(self.import_batch_size))
+
+        self.write_queries(out, ctx)
+        # Only the statements run through execute are prepared, not those of the server side cursors
+        unprepared = UNPREPARED + tuple(self.cursor_queries(ctx))
+        statements = [query_type for query_type in ctx.queries if query_type not in unprepared]
+        out.emit(CONFIGURE_PREPARE, statements=str(len(statements)))
+        if ctx.table.cache_size is not None:
+            out.emit(READ_CACHE, max_size=str(ctx.table.cache_size), ttl=str(ctx.table.cache_ttl))
+
+        self.maybe_write_enum_value(out, ctx)
+        self.maybe_write_value_enum(out, ctx)
+
+        self.write_set(out, ctx)
+        if 'SELECT_IF_NEWER' in ctx.queries:
+            out.emit(IF_NEWER_ROW_FACTORY)
+        self.write_list_keys(out, ctx)
+        self.write_import_row(out, ctx)
+        self.write_mapping_sets(out, ctx)
+        self.write_funs(out, ctx)
+        return out
+
+    def render_async(self, ctx: TableContext) -> Emitter:
+        out = Emitter(**ASYNC)
+        out.emit(ASYNC_HEADER, database=self.db_name, user=self.db_user,
+                 generated_on=self.generated_on.strftime("%m/%d/%Y, %H:%M:%S"), schema=ctx.table.schema,
+                 module=ctx.name + self.suffix)
+        self.write_funs(out, ctx)
+        return out
+
+    def write_funs(self, out: Emitter, ctx: TableContext):
+        self.write_proto_in_funs(out, ctx, 'INSERT', 'create')
+        self.write_create_many(out, ctx)
+        self.write_upsert_funs(out, ctx)
+        if ctx.table.cache_size is not None:
+            self.write_params_in_funs(out, ctx, 'SELECT', 'read_uncached')
+            out.emit(CACHED_READ_FUN, params=', '.join(ctx.queries['SELECT'].bind_params),
+                     key=self.cache_key(ctx.table.pkey_list))
+        else:
+            self.write_params_in_funs(out, ctx, 'SELECT', 'read')
+        self.write_proto_in_funs(out, ctx, 'UPDATE', 'update')
+        self.write_update_fields(out, ctx)
+        self.write_proto_in_funs(out, ctx, 'DELETE', 'delete')
+        self.write_many_funs(out, ctx)
+        self.write_if_newer_funs(out, ctx)
+        self.write_list_funs(out, ctx)
+        self.write_lookup_funs(out, ctx)
+        out.emit(EXPORT_FUN, cc=ctx.cc, copy_format=' (FORMAT BINARY)' if ctx.binary_export else '')
+        self.write_import_funs(out, ctx)
+        self.write_mapping_funs(out, ctx)
+
+        for rel in ctx.table.relations:
+            qname = rel.constraint_name.upper() + '_UPDATE'
+            fname = rel.constraint_name + '_update'
+            self.write_proto_in_funs(out, ctx, qname, fname)
+
+    @staticmethod
+    def write_queries(out: Emitter, ctx: TableContext):
+        for query_type, statement in ctx.queries.items():
+            out.emit(QUERY, query_type=query_type, sql=statement.sql)
+        if 'UPSERT' in ctx.queries:
+            out.emit(UPSERT_STATUS)
+        if ctx.binary_copy:
+            types = ['bigint'] + [col.udt_name for col in ctx.staging]
+            out.emit(COPY_TYPES, types=', '.join("'" + t + "'" for t in types))
+            if 'IMPORT_COPY' in ctx.queries:
+                types = [ctx.table.columns[cname].udt_name for cname in Database.build_insert_tuple(ctx.table)[0]]
+                out.emit(IMPORT_TYPES, types=', '.join("'" + t + "'" for t in types))
+        out.write('\n\n')
+
+    @staticmethod
+    def build_binding(ctx: TableContext, bind_cname: str) -> str:
+        # The expression that reads a bind parameter from the proto
+        col = ctx.table.columns[bind_cname]
+        name = ctx.name
+        if col.is_nullable is True:
+            binding = 'is_null(' + name + ', \'' + bind_cname + '\', ' + name + '.' + bind_cname + ')'
+        elif col.data_type != 'ARRAY':
+            binding = 'not_null(' + name + ', \'' + bind_cname + '\', ' + name + '.' + bind_cname + ')'
+        else:
+            # psycopg adapts lists, not the repeated field containers of the proto
+            binding = 'list(' + name + '.' + bind_cname + ')'
+
+        if col.valid_values is not None:
+            binding = col.name + '_value(' + binding + ')'
+
+        if col.udt_name.startswith('timestamp'):
+            binding = 'to_datetime(' + binding + ')'
+        return binding
+
+    def write_proto_in_funs(self, out: Emitter, ctx: TableContext, query_type: str, fname: str):
+        bind_params = ctx.queries[query_type].bind_params
+        params = ', '.join([self.build_binding(ctx, bind_cname) for bind_cname in bind_params])
+        out.emit(PROTO_IN_FUN, fname=fname, name=ctx.name, cc=ctx.cc, params=params)
+        if ctx.table.cache_size is not None and query_type != 'INSERT':
+            # The key of the row being written, the same before and after the write
+            key = self.cache_key([ctx.name + '.' + cname for cname in ctx.table.pkey_list])
+            if query_type == 'DELETE':
+                out.emit(EXECUTE_CACHED, query_type=query_type, key=key)
             else:
-                binding = table.name + '.' + bind_cname
+                out.emit(EXECUTE_RETURNING_CACHED, query_type=query_type, key=key)
+        elif query_type == 'DELETE':
+            out.emit(EXECUTE, query_type=query_type)
+        else:
+            out.emit(EXECUTE_RETURNING, query_type=query_type)
+
+    def write_update_fields(self, out: Emitter, ctx: TableContext):
+        # A column is set when its own field or any field its update xform takes is changed
+        out.emit(UPDATE_FIELDS_FUN, name=ctx.name, cc=ctx.cc)
+        for (cname, clause) in self.database.build_update_fields_sets(ctx.table):
+            fields = [cname] + [bind_cname for bind_cname in clause.bind_params if bind_cname != cname]
+            out.emit(UPDATE_FIELDS_SET, condition=' or '.join(f"'{field}' in changed" for field in fields),
+                     clause=clause.sql, params=', '.join([self.build_binding(ctx, bind_cname)
+                                                          for bind_cname in clause.bind_params]))
+        params = ', '.join([self.build_binding(ctx, bind_cname)
+                            for bind_cname in ctx.queries['UPDATE_FIELDS_WHERE'].bind_params])
+        out.emit(UPDATE_FIELDS_END, name=ctx.name, params=params)
+        if ctx.table.cache_size is not None:
+            key = self.cache_key([ctx.name + '.' + cname for cname in ctx.table.pkey_list])
+            out.emit(EXECUTE_RETURNING_CACHED, query_type='sql', key=key)
+        else:
+            out.emit(EXECUTE_RETURNING, query_type='sql')
 
-            if col.valid_values is not None:
-                binding = col.name + '_value(' + binding + ')'
+    @staticmethod
+    def cache_key(names: List[str]) -> str:
+        # The primary key tuple the read cache is keyed by
+        return '(' + ', '.join(names) + (',)' if len(names) == 1 else ')')
+
+    def write_create_many(self, out: Emitter, ctx: TableContext):
+        # Rows are bound exactly like create, the version column is set to 0 by the INSERT itself
+        params = ', '.join([self.build_binding(ctx, col.name) for col in ctx.staging])
+        out.emit(CREATE_MANY_FUN, name=ctx.name, params=params,
+                 set_types=SET_COPY_TYPES.render({}) if ctx.binary_copy else '')
+
+    def write_import_row(self, out: Emitter, ctx: TableContext):
+        # A direct COPY takes every column of the INSERT, with a literal 0 for the version. Through the staging table
+        # the row is bound exactly like create_many.
+        if 'IMPORT_COPY' in ctx.queries:
+            (clause, _) = self.database.build_insert_tuple(ctx.table)
+            params = ', '.join(['0' if ctx.table.columns[cname].is_version else self.build_binding(ctx, cname)
+                                for cname in clause])
+        else:
+            params = ', '.join([self.build_binding(ctx, col.name) for col in ctx.staging])
+        out.emit(IMPORT_ROW, name=ctx.name, cc=ctx.cc, params=params)
 
-            if col.udt_name.startswith('timestamp'):
-                binding = 'to_datetime(' + binding + ')'
+    @staticmethod
+    def write_import_funs(out: Emitter, ctx: TableContext):
+        if 'IMPORT_COPY' in ctx.queries:
+            set_types = '            copy.set_types(IMPORT_TYPES)\n' if ctx.binary_copy else ''
+            out.emit(IMPORT_COPY_FUN, set_types=set_types)
+        else:
+            out.emit(IMPORT_STAGING_FUN, set_types=SET_COPY_TYPES.render({}) if ctx.binary_copy else '')
+        out.emit(IMPORT_FUN, name=ctx.name, cc=ctx.cc)
+
+    def write_upsert_funs(self, out: Emitter, ctx: TableContext):
+        # A skipped row is one whose version did not match, so the update did not return it
+        if 'UPSERT' not in ctx.queries:
+            return
+        bindings = []
+        for bind_cname in ctx.queries['UPSERT'].bind_params:
+            if bind_cname == 'check_version':
+                bindings.append('check_version')
+            else:
+                bindings.append(self.build_binding(ctx, bind_cname))
+        cache_invalidate = ''
+        if ctx.table.cache_size is not None:
+            key = self.cache_key(['proto.' + cname for cname in ctx.table.pkey_list])
+            cache_invalidate = 'CACHE.invalidate(' + key + ')\n'
+        out.emit(UPSERT_FUN, name=ctx.name, cc=ctx.cc, params=', '.join(bindings),
+                 cache_invalidate=indent(cache_invalidate, ' ' * 8),
+                 cache_invalidate_many=indent(cache_invalidate, ' ' * 16))
 
-            bind_columns.append(binding)
+    @staticmethod
+    def list_indexes(ctx: TableContext):
+        # The list_ indexes Database.build_queries could build queries for
+        return [index for index in ctx.table.indexes.values() if index.is_list and index.name.upper() in ctx.queries]
+
+    @staticmethod
+    def is_select_mapping(custom_query) -> bool:
+        return custom_query.query.lstrip().startswith(('select', 'values'))
+
+    @staticmethod
+    def is_stream_mapping(custom_query) -> bool:
+        return len(custom_query.result_set) > 0 and CodeGen.is_select_mapping(custom_query)
+
+    def cursor_queries(self, ctx: TableContext) -> List[str]:
+        # The statements the list, lookup stream and mapping stream functions run on a server side cursor
+        queries = []
+        for index in self.list_indexes(ctx):
+            queries += [index.name.upper(), index.name.upper() + '_AFTER']
+        for index in ctx.table.indexes.values():
+            if index.is_lookup and index.type == IndexType.NON_UNIQUE and index.name.upper() in ctx.queries:
+                queries += [index.name.upper(), index.name.upper() + '_MANY']
+        queries += [name.upper() for name, custom_query in ctx.table.mappings.items()
+                    if self.is_stream_mapping(custom_query)]
+        return queries
 
-        params = ', '.join(bind_columns)
-        values = ', '.join(returning)
-        pfile.write(f'    bind_args = [{params}]\n')
-        if query_type == 'DELETE':
-            pfile.write(f'    conn.execute({query_type}, bind_args)\n\n\n')
+    @staticmethod
+    def fun_name(index, prefix: str) -> str:
+        return Database.index_fun_name(index, prefix)
+
+    @staticmethod
+    def list_fun_name(index) -> str:
+        return CodeGen.fun_name(index, 'list')
+
+    @staticmethod
+    def key_args(cnames: List[str]) -> str:
+        # Single column keys are plain values, composite keys are tuples bound as one array per column
+        if len(cnames) == 1:
+            return '[keys]'
+        return '[' + ', '.join(f'[key[{i}] for key in keys]' for i in range(len(cnames))) + ']'
+
+    def write_lookup_funs(self, out: Emitter, ctx: TableContext):
+        # A unique index looks up one proto, or None, a non unique one streams them. The many variants resolve all the
+        # keys in one query, in the order of the keys.
+        for index in ctx.table.indexes.values():
+            query_type = index.name.upper()
+            if not index.is_lookup or query_type not in ctx.queries:
+                continue
+            fname = self.fun_name(index, 'lookup')
+            many_fname = fname.replace('lookup_by_', 'lookup_many_by_', 1)
+            params = ', '.join(index.columns)
+            bind_args = self.key_args(index.columns)
+            if index.type == IndexType.NON_UNIQUE:
+                out.emit(LOOKUP_STREAM_FUN, fname=fname, params=params, query_type=query_type)
+                out.emit(LOOKUP_MANY_STREAM_FUN, fname=many_fname, query_type=query_type + '_MANY',
+                         bind_args=bind_args)
+            else:
+                out.emit(PARAMS_IN_FUN, fname=fname, params=params, query_type=query_type)
+                out.emit(LOOKUP_MANY_FUN, fname=many_fname, query_type=query_type + '_MANY', bind_args=bind_args)
+
+    def write_list_funs(self, out: Emitter, ctx: TableContext):
+        for index in self.list_indexes(ctx):
+            out.emit(LIST_FUN, fname=self.list_fun_name(index), query_type=index.name.upper())
+
+    def write_list_keys(self, out: Emitter, ctx: TableContext):
+        for index in self.list_indexes(ctx):
+            key = []
+            for cname in self.database.build_list_key(ctx.table, index):
+                col = ctx.table.columns[cname]
+                value = ctx.name + '.' + cname
+                if col.valid_values is not None:
+                    value = cname + '_value(' + value + ')'
+                if col.udt_name.startswith('timestamp'):
+                    value = 'to_datetime(' + value + ')'
+                key.append(value)
+            key = '(' + key[0] + ',)' if len(key) == 1 else '(' + ', '.join(key) + ')'
+            out.emit(LIST_KEY_FUN, fname=self.list_fun_name(index), name=ctx.name, cc=ctx.cc, key=key)
+
+    @staticmethod
+    def write_mapping_sets(out: Emitter, ctx: TableContext):
+        # Builds the result message of a mapping from a row
+        for name, custom_query in ctx.table.mappings.items():
+            if len(custom_query.result_set) == 0:
+                continue
+            message = ''.join(word.title() for word in name.split('_'))
+            out.emit(MAPPING_SET_FUN, fname=name, values=', '.join(r.name for r in custom_query.result_set),
+                     name=ctx.name, message=message)
+            for rset in custom_query.result_set:
+                # Converted to the field type the proto generator picked for the column
+                field = rset.name
+                ftype = postgres_datatypes.sql_to_proto_datatype(rset.data_type)
+                if postgres_datatypes.is_array(rset.data_type):
+                    assign = f'out.{field}.extend({field})'
+                elif ftype == 'google.protobuf.Timestamp':
+                    assign = f'runtime.set_timestamp(out.{field}, {field})'
+                elif ftype in CASTS:
+                    assign = f'out.{field} = {CASTS[ftype]}({field})'
+                else:
+                    assign = f'out.{field} = {field}'
+                out.emit(SET_NULLABLE, cname=field, assign=assign)
+            out.emit(SET_FIELDS_END)
+
+    @staticmethod
+    def write_mapping_funs(out: Emitter, ctx: TableContext):
+        # A SELECT streams its result messages from a server side cursor. Any other statement returns the messages of
+        # its RETURNING clause, or the number of rows it affected, and clears the read cache after it ran since there is
+        # no telling which rows it wrote.
+        for name, custom_query in ctx.table.mappings.items():
+            statement = ctx.queries[name.upper()]
+            params = ''.join(', ' + p for p in dict.fromkeys(statement.bind_params))
+            cache_clear = ''
+            if ctx.table.cache_size is not None and not CodeGen.is_select_mapping(custom_query):
+                cache_clear = '    CACHE.clear()\n'
+            fields = dict(fname=name, params=params, query_type=name.upper(),
+                          bind_args=', '.join(statement.bind_params), cache_clear=cache_clear)
+            if len(custom_query.result_set) == 0:
+                out.emit(MAPPING_EXECUTE_FUN, **fields)
+            elif CodeGen.is_stream_mapping(custom_query):
+                out.emit(MAPPING_STREAM_FUN, **fields)
+            else:
+                out.emit(MAPPING_RETURNING_FUN, **fields)
+
+    @staticmethod
+    def write_many_funs(out: Emitter, ctx: TableContext):
+        # Keys are plain values for a single column primary key and tuples for a composite one. Both statements return
+        # the positions of the keys in the key arrays, so the caller's keys are never compared with the values read
+        # back, and read_many returns None for a key with no row, in the caller's order.
+        if 'SELECT_MANY' not in ctx.queries:
+            return
+        pkey_list = ctx.table.pkey_list
+        bind_args = CodeGen.key_args(pkey_list)
+        key = 'key' if len(pkey_list) == 1 else 'tuple(key)'
+        out.emit(LOOKUP_MANY_FUN, fname='read_many', query_type='SELECT_MANY', bind_args=bind_args)
+        cache_invalidate = ''
+        if ctx.table.cache_size is not None:
+            cache_invalidate = DELETE_MANY_CACHE.render({'key': '(key,)' if len(pkey_list) == 1 else 'tuple(key)'})
+        out.emit(DELETE_MANY_FUN, bind_args=bind_args, key=key, cache_invalidate=cache_invalidate)
+
+    @staticmethod
+    def write_if_newer_funs(out: Emitter, ctx: TableContext):
+        if 'SELECT_IF_NEWER' not in ctx.queries:
+            return
+        out.emit(READ_IF_NEWER_FUN, params=', '.join(ctx.table.pkey_list),
+                 bind_args=', '.join(ctx.queries['SELECT_IF_NEWER'].bind_params))
+        # The key arrays, as for read_many, then the known versions
+        pkey_list = ctx.table.pkey_list
+        if len(pkey_list) == 1:
+            arrays = ['[key for (key, _) in keys]']
         else:
-            pfile.write(f'    cur = conn.execute({query_type}, bind_args)\n')
-            pfile.write(f'    result = cur.fetchone()\n')
-            pfile.write(f'    if result is None:\n')
-            pfile.write(f'        return None\n')
-            pfile.write(f'    else:\n')
-            pfile.write(f'        ({values}) = result\n')
-            pfile.write(f'        return set_fields({values})\n\n\n')
-
-    def write_set(self, pfile, table):
-        returning = self.database.build_returning_list(table)
-        values = ', '.join(returning)
-        pfile.write(f'def set_fields({values}):\n')
-        pfile.write(f'    out = User()\n')
-        for cname in returning:
-            col = table.columns[cname]
+            arrays = [f'[key[{i}] for (key, _) in keys]' for i in range(len(pkey_list))]
+        bind_args = '[' + ', '.join(arrays + ['[version for (_, version) in keys]']) + ']'
+        out.emit(REFRESH_MANY_FUN, bind_args=bind_args)
+
+    @staticmethod
+    def write_set(out: Emitter, ctx: TableContext):
+        # A one column row still has to be unpacked as a tuple
+        values = ctx.values + (',' if len(ctx.returning) == 1 else '')
+        out.emit(MAKE_ROW, values=values, cc=ctx.cc)
+        for cname in ctx.returning:
+            col = ctx.table.columns[cname]
             assign = f'out.{cname} = {cname}'
             if col.udt_name == 'uuid':
                 assign = f'out.{cname} = str({cname})'
             elif col.valid_values is not None:
-                assign = f'out.{cname} = {cname}_enum({cname})'
+                assign = f'out.{cname} = {cname.upper()}_ENUMS[{cname}]'
             elif col.udt_name.startswith('timestamp'):
-                assign = f'out.{cname}.FromDatetime({cname})'
+                assign = f'runtime.set_timestamp(out.{cname}, {cname})'
 
             if col.is_nullable:
-                pfile.write(f'    if {cname} is not None:\n        {assign}\n')
+                out.emit(SET_NULLABLE, cname=cname, assign=assign)
             elif col.data_type == 'ARRAY':
-                pfile.write(f'    if len({cname}) > 0:\n')
-                pfile.write(f'        out.{cname}.extend({cname})\n')
+                out.emit(SET_ARRAY, cname=cname)
             else:
-                pfile.write(f'    {assign}\n')
-        pfile.write(f'    return out\n\n\n')
-
-    def write_params_in_funs(self, pfile, table, queries, query_type, fname):
-        query = queries[query_type]
-        (_sql, bind_params, in_params) = query
-        params = ', '.join(bind_params)
-        pfile.write(f'def {fname}(conn, {params}):\n')
-        returning = self.database.build_returning_list(table)
-        values = ', '.join(returning)
-        pfile.write(f'    cur = conn.execute({query_type}, [{params},])\n')
-        pfile.write(f'    result = cur.fetchone()\n')
-        pfile.write(f'    if result is None:\n')
-        pfile.write(f'        return None\n')
-        pfile.write(f'    else:\n')
-        pfile.write(f'        ({values}) = result\n')
-        pfile.write(f'        return set_fields({values})\n\n\n')
-
-    @staticmethod
-    def maybe_write_enum_value(pfile, table):
-        cc = cap_camel_case(table.name)
-        for cname in table.columns:
-            col = table.columns[cname]
+                out.emit(SET_FIELD, assign=assign)
+        out.emit(SET_FIELDS_END)
+        out.emit(ROW_FACTORY)
+
+    @staticmethod
+    def write_params_in_funs(out: Emitter, ctx: TableContext, query_type: str, fname: str):
+        params = ', '.join(ctx.queries[query_type].bind_params)
+        out.emit(PARAMS_IN_FUN, fname=fname, params=params, query_type=query_type)
+
+    @staticmethod
+    def maybe_write_enum_value(out: Emitter, ctx: TableContext):
+        for cname, col in ctx.table.columns.items():
             if col.valid_values is not None:
-                pfile.write(f'def {cname}_value(enum):\n')
-                pfile.write(f'    match enum:\n')
-                pfile.write(f'        case None:\n')
-                pfile.write(f'            return None\n')
+                out.emit(ENUM_VALUE, cname=cname)
                 for val in col.valid_values:
-                    val_cc = val.replace('-', '_').replace(' ', '_')
-                    if val_cc[0].isdigit():
-                        val_cc = '_' + val_cc
-                    pfile.write(f'        case {table.name}_pb2.{cc}.{val_cc}:\n')
-                    pfile.write(f'            return \'{val}\'\n')
-                pfile.write('\n\n')
-
-    @staticmethod
-    def maybe_write_value_enum(pfile, table):
-        cc = cap_camel_case(table.name)
-        for cname in table.columns:
-            col = table.columns[cname]
+                    out.emit(ENUM_VALUE_CASE, name=ctx.name, cc=ctx.cc, label=enum_label(val), value=val)
+                out.write('\n\n')
+
+    @staticmethod
+    def maybe_write_value_enum(out: Emitter, ctx: TableContext):
+        for cname, col in ctx.table.columns.items():
             if col.valid_values is not None:
-                pfile.write(f'def {cname}_enum(value):\n')
-                pfile.write(f'    match value:\n')
-                pfile.write(f'        case None:\n')
-                pfile.write(f'            return None\n')
+                out.emit(VALUE_ENUM, const=cname.upper())
                 for val in col.valid_values:
-                    val_cc = val.replace('-', '_').replace(' ', '_')
-                    if val_cc[0].isdigit():
-                        val_cc = '_' + val_cc
-                    pfile.write(f'        case \'{val}\':\n')
-                    pfile.write(f'            return {table.name}_pb2.{cc}.{val_cc}\n')
-                pfile.write('\n\n')
-
-    @staticmethod
-    def write_is_null(pfile, table):
-        cc = cap_camel_case(table.name)
-        pfile.write(f'def is_null({table.name}: {table.name}_pb2.{cc}, field_name, field):\n')
-        pfile.write(f'    if {table.name}.HasField(field_name) is True:\n')
-        pfile.write(f'        return field\n')
-        pfile.write(f'    else:\n')
-        pfile.write(f'        return None\n\n\n')
-
-    @staticmethod
-    def write_not_nullable(pfile, table):
-        cc = cap_camel_case(table.name)
-        pfile.write(f'def not_null({table.name}: {table.name}_pb2.{cc}, field_name, field):\n')
-        pfile.write(f'    if {table.name}.HasField(field_name) is False:\n')
-        pfile.write(f'        raise Exception(\'Field {table.name}: {table.name}_pb2.{cc}.\' + field_name + '
-                    f'\' can not be null\')\n')
-        pfile.write(f'    return field\n\n\n')
-
-    @staticmethod
-    def write_to_datetime(pfile):
-        pfile.write('def to_datetime(param):\n')
-        pfile.write('    if param is not None:\n')
-        pfile.write('        return param.ToDatetime()\n')
-        pfile.write('    else:\n')
-        pfile.write('        return param\n\n\n')
+                    out.emit(VALUE_ENUM_CASE, name=ctx.name, cc=ctx.cc, label=enum_label(val), value=val)
+                out.emit(VALUE_ENUM_END, cname=cname, const=cname.upper())
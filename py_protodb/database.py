@@ -1,12 +1,35 @@
 #!/usr/bin/env python
-from typing import List, Tuple
+import keyword
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 import psycopg
 
-import query_parser
 from config import Config, InvalidConfigError
-from postgres import Postgres
-from schema import Table, CustomQuery, Schema, BindVar, Column, ForeignRel
+from pool import ConnectionPool
+import postgres_datatypes
+from postgres import Postgres, TypeMap
+from query_parser import bind, inline, join, literal, to_statement
+from schema import Table, CustomQuery, Schema, BindVar, Column, ForeignRel, Statement, IndexType, Index
+from snapshot import Snapshot
+
+# The names every generated module defines, a custom mapping's function, set_ function and statement constant must not
+# take one of them
+GENERATED_FUNS = ('create', 'create_many', 'upsert', 'upsert_many', 'read', 'read_uncached', 'update', 'update_fields',
+                  'delete', 'read_many', 'delete_many', 'read_if_newer', 'refresh_many', 'export_stream',
+                  'import_stream', 'import_batch', 'import_row', 'make_row', 'row_factory', 'make_tagged_row',
+                  'tagged_row_factory', 'make_if_newer_row', 'if_newer_row_factory', 'make_tagged_if_newer_row',
+                  'tagged_if_newer_row_factory', 'configure_prepare', 'runtime', 'is_null', 'not_null', 'to_datetime')
+GENERATED_CONSTS = ('PREPARE', 'FETCH_SIZE', 'IMPORT_BATCH_SIZE', 'CACHE', 'UNCHANGED', 'INSERTED', 'UPDATED',
+                    'SKIPPED', 'INSERT_MANY_TYPES', 'IMPORT_TYPES', 'INSERT', 'INSERT_MANY_STAGING',
+                    'INSERT_MANY_TRUNCATE', 'INSERT_MANY_COPY', 'INSERT_MANY', 'IMPORT_COPY', 'IMPORT', 'UPSERT',
+                    'UPDATE', 'UPDATE_FIELDS', 'UPDATE_FIELDS_WHERE', 'DELETE', 'SELECT', 'SELECT_MANY', 'DELETE_MANY',
+                    'SELECT_IF_NEWER', 'REFRESH_MANY', 'EXPORT')
+
+# The names the generated mapping functions use, which their parameters must not shadow. The $name parameters become
+# those of the mapping function and the result columns those of its set_ function.
+MAPPING_LOCALS = ('conn', 'fetch_size', 'cur', 'result')
+MAPPING_SET_LOCALS = ('out', 'runtime', 'str', 'float')
 
 
 def ensure_fqn(fqn_or_name):
@@ -15,6 +38,15 @@ def ensure_fqn(fqn_or_name):
     return fqn_or_name
 
 
+def message_name(name: str) -> str:
+    # The name proto_gen gives the message of a table or a custom mapping
+    return ''.join(word.title() for word in name.split('_'))
+
+
+def is_identifier(name: str) -> bool:
+    return name.isidentifier() and not keyword.iskeyword(name)
+
+
 class Database:
     def __init__(self, config: Config):
         self.config = config
@@ -27,16 +59,65 @@ class Database:
         schema_names = self.config.get_config()['generator']['schemas']
         if schema_names is []:
             schema_names = ['public']
-        for name in schema_names:
-            schema = Postgres(name, self.config)
-            self.schemas[name] = schema
 
-        # Now process the rest of the configs
-        self.maybe_inject_version_column()
-        self.process_excluded_cols()
-        self.process_extensions()
-        self.process_custom_mappings()
-        self.process_transforms()
+        self.pool = ConnectionPool(self.config)
+        self.types = TypeMap(self.pool)
+        try:
+            snapshot = Snapshot(self.config)
+            fingerprint = None
+            if snapshot.enabled:
+                fingerprint = snapshot.fingerprint(self.pool, schema_names)
+                tables = snapshot.load(fingerprint)
+                if tables is not None:
+                    print(f'Catalog unchanged, using snapshot: {snapshot.filename}')
+                    for name in schema_names:
+                        self.schemas[name] = Postgres(name, self.config, self.pool, self.types,
+                                                     tables.get(name, {}))
+                    return
+
+            self.read_schemas(schema_names)
+
+            altered = self.maybe_inject_version_column()
+            if len(altered) > 0:
+                # The model was read before the version columns were added. Read the altered schemas again so that
+                # it matches the catalog, and the fingerprint, a fresh run would read.
+                if snapshot.enabled:
+                    fingerprint = snapshot.fingerprint(self.pool, schema_names)
+                self.read_schemas(altered)
+
+            # Now process the rest of the configs
+            self.process_excluded_cols()
+            self.process_extensions()
+            self.process_caches()
+            self.process_custom_mappings()
+            self.process_transforms()
+
+            if snapshot.enabled:
+                print(f'\nWriting snapshot: {snapshot.filename}')
+                snapshot.save(fingerprint, self.schemas)
+        finally:
+            self.pool.close()
+
+    def __getstate__(self):
+        # The connection pool and type map stay behind when the model is sent to another process
+        state = self.__dict__.copy()
+        state.pop('pool', None)
+        state.pop('types', None)
+        return state
+
+    def read_schemas(self, schema_names: List[str]):
+        # Each schema is read on its own worker, bounded by the size of the connection pool. The schemas are stored
+        # in the configured order once they have all been read so that the result does not depend on scheduling.
+        with ThreadPoolExecutor(max_workers=self.pool.size) as executor:
+            futures = [executor.submit(Postgres, name, self.config, self.pool, self.types) for name in schema_names]
+            for name, future in zip(schema_names, futures):
+                self.schemas[name] = future.result()
+
+    def get_tables(self, tables: List[Table] = None) -> List[Table]:
+        # All the tables of every schema, unless a subset is given
+        if tables is not None:
+            return tables
+        return [table for schema in self.schemas.values() for table in (schema.tables or {}).values()]
 
     def process_excluded_cols(self):
         print('\nProcessing excluded columns')
@@ -88,6 +169,31 @@ class Database:
                 raise InvalidConfigError(f'Invalid configuration while processing extensions. Table {s}.{tn} not found')
             table.proto_extensions = ext
 
+    def process_caches(self):
+        print('\nProcessing caches')
+        print('--------------------------------------------------------')
+        caches = self.config.get_config()['generator'].get('caches') or []
+        for cache in caches:
+            fqn = cache.get('table')
+            if fqn is None or cache.get('max_size') is None or cache.get('ttl') is None:
+                raise InvalidConfigError(f'Invalid configuration while processing caches: {cache}')
+            parts = fqn.split('.')
+            if len(parts) == 1:
+                s = 'public'
+                tn = parts[0]
+            else:
+                s = parts[0]
+                tn = parts[1]
+            table = self.schemas[s].tables.get(tn)
+            if table is None:
+                raise InvalidConfigError(f'Invalid configuration while processing caches. Table {s}.{tn} not found')
+            if len(table.pkey_list) == 0:
+                print(f'    WARNING: {s}.{tn} has no primary key, it can not be cached')
+                continue
+            print(f'    {s}.{tn} : {cache["max_size"]} rows for {cache["ttl"]}s')
+            table.cache_size = int(cache['max_size'])
+            table.cache_ttl = float(cache['ttl'])
+
     def process_custom_mappings(self):
         print('\nProcessing custom mappings')
         print('--------------------------------------------------------')
@@ -107,53 +213,100 @@ class Database:
 
             for query in queries:
                 n = query['name']
+                self.check_mapping_name(self.schemas[s], t, n)
                 q = query['query'].lower()
                 if q.find("*") > 1:
                     q = self.expand_sql(t, q)
 
                 print(f'        {n} : {q}')
-                rs = []
-                if q[0: 6] != 'select' and q.find('returning') == -1:
-                    rs = []
-                elif q[0: 6] != 'select' and q.find('returning') > -1:
-                    # Handle insert / update statement returning a result set
-                    rs = self.parse_query(self.schemas[s], self.returning_clause(t.fqn, q))
-                elif q[0: 6] == 'select' and q.find('returning') == -1:
-                    # The select is the result set
-                    rs = self.parse_query(self.schemas[s], self.strip_where_clause(q))
-                custom_query = CustomQuery(n, q, rs)
+                # The server describes the result set (the select list or the RETURNING clause) and the types of the
+                # bind parameters without running the query
+                try:
+                    rs, params = self.parse_query(self.schemas[s], q)
+                except psycopg.Error as error:
+                    raise InvalidConfigError(f'Invalid configuration while processing mapping {n}: {error}')
+                custom_query = CustomQuery(n, q, rs, params)
+                self.check_mapping_columns(t, custom_query)
                 t.mappings[n] = custom_query
 
+    @staticmethod
+    def index_fun_name(index: Index, prefix: str) -> str:
+        # list_email and list_by_email both become list_by_email
+        name = index.name[len(prefix) + 1:]
+        return prefix + '_' + name if name.startswith('by_') else prefix + '_by_' + name
+
+    @staticmethod
+    def build_generated_names(table: Table) -> Tuple[List[str], List[str]]:
+        # The functions and the module constants the generated module of the table defines
+        funs = list(GENERATED_FUNS) + [message_name(table.name), table.name + '_pb2']
+        consts = list(GENERATED_CONSTS)
+        for cname, col in table.columns.items():
+            if col.valid_values is not None:
+                funs += [cname + '_value', cname + '_enum']
+                consts.append(cname.upper() + '_ENUMS')
+        for index in table.indexes.values():
+            if index.is_list:
+                fname = Database.index_fun_name(index, 'list')
+                funs += [fname, fname + '_key']
+            elif index.is_lookup:
+                fname = Database.index_fun_name(index, 'lookup')
+                funs += [fname, fname.replace('lookup_by_', 'lookup_many_by_', 1)]
+            consts += [index.name.upper(), index.name.upper() + '_AFTER', index.name.upper() + '_MANY']
+        for rel in table.relations:
+            funs.append(rel.constraint_name + '_update')
+            consts.append(rel.constraint_name.upper() + '_UPDATE')
+        return funs, consts
+
+    @staticmethod
+    def check_mapping_name(schema: Schema, table: Table, name: str):
+        # The name of a mapping becomes a function, its set_ function, a statement constant and a message
+        error = None
+        (funs, consts) = Database.build_generated_names(table)
+        messages = [message_name(t.name) for t in schema.tables.values()] + \
+            [message_name(mapping) for t in schema.tables.values() for mapping in t.mappings]
+        if not isinstance(name, str) or not is_identifier(name):
+            error = 'its name is not a valid identifier'
+        elif name in table.mappings:
+            error = 'there is another mapping with the same name'
+        elif name in funs or name.upper() in consts or name in ['set_' + m for m in table.mappings] or \
+                'set_' + name in table.mappings:
+            error = 'its name clashes with a function the generator writes for the table'
+        elif message_name(name) in messages:
+            error = f'its message {message_name(name)} clashes with another message of schema {schema.name}'
+        if error is not None:
+            raise InvalidConfigError(f'Invalid configuration while processing mapping {name} of table {table.fqn}, '
+                                     f'{error}')
+
+    @staticmethod
+    def check_mapping_columns(table: Table, custom_query: CustomQuery):
+        columns = [rs.name for rs in custom_query.result_set]
+        params = [p.name for p in (custom_query.params or [])]
+        set_locals = MAPPING_SET_LOCALS + (table.name + '_pb2',)
+        for names, kind, reserved in [(columns, 'result column', set_locals), (params, 'parameter', MAPPING_LOCALS)]:
+            for name in names:
+                if not is_identifier(name) or name in reserved:
+                    raise InvalidConfigError(f'Invalid configuration while processing mapping {custom_query.name}, '
+                                             f'the {kind} {name} can not be used as a Python name')
+        duplicates = sorted({name for name in columns if columns.count(name) > 1})
+        if len(duplicates) > 0:
+            raise InvalidConfigError(f'Invalid configuration while processing mapping {custom_query.name}, the result '
+                                     f'columns {duplicates} are not unique')
+
     def expand_sql(self, table: Table, query: str):
         clause = self.build_select_list(table)
         query.replace("*", ', '.join(clause))
         return query
 
     @staticmethod
-    def parse_query(schema: Schema, query: str):
+    def parse_query(schema: Schema, query: str) -> Tuple[List[BindVar], List[BindVar]]:
         rs = []
-        cur = schema.execute_query(query, ())
-        desc = cur.description
-        for d in desc:
-            oid = d[1]
-            dt = schema.get_column_datatype(oid)
-            rs.append(BindVar(d[0], dt))
-        return rs
-
-    @staticmethod
-    def returning_clause(tname: str, query: str):
-        pos = query.find('returning')
-        if pos != -1:
-            clause = query[pos + 9:]
-            return 'select ' + clause + ' from ' + tname
-        return ''
-
-    @staticmethod
-    def strip_where_clause(query: str):
-        pos = query.find('where')
-        if pos == -1:
-            return query
-        return query[0: pos]
+        params = []
+        columns, param_types = schema.describe_query(query)
+        for (name, oid) in columns:
+            rs.append(BindVar(name, schema.get_column_datatype(oid)))
+        for (name, oid) in param_types:
+            params.append(BindVar(name, schema.get_column_datatype(oid)))
+        return rs, params
 
     def process_transforms(self):
         print('\nProcessing transforms')
@@ -228,59 +381,339 @@ class Database:
                 raise InvalidConfigError(f'Invalid configuration while processing xforms {x}. Column {cname} not '
                                          f'found in table {table.fqn}')
 
-    def build_queries(self, table: Table):
+    def build_queries(self, table: Table) -> Dict[str, Statement]:
+        # The builders emit the bind parameters along with the SQL, so there is nothing to parse
         queries = {}
-        insert_sql = self.build_insert_sql(table)
-        sql, bind_params, in_params = query_parser.parse_query(insert_sql)
-        queries['INSERT'] = (sql, bind_params, in_params)
-        print(f'    {sql}')
-
-        update_sql = self.build_update_sql(table)
-        sql, bind_params, in_params = query_parser.parse_query(update_sql)
-        print(f'    {sql}')
-        queries['UPDATE'] = (sql, bind_params, in_params)
-
-        delete_sql = self.build_delete_sql(table)
-        sql, bind_params, in_params = query_parser.parse_query(delete_sql)
-        print(f'    {sql}')
-        queries['DELETE'] = (sql, bind_params, in_params)
-
-        select_sql = self.build_select_sql(table)
-        sql, bind_params, in_params = query_parser.parse_query(select_sql)
-        print(f'    {sql}')
-        queries['SELECT'] = (sql, bind_params, in_params)
+        statement = self.build_insert_sql(table)
+        queries['INSERT'] = statement
+        print(f'    {statement.sql}')
+
+        for query_type, statement in self.build_insert_many_sql(table).items():
+            print(f'    {statement.sql}')
+            queries[query_type] = statement
+
+        for query_type, statement in self.build_import_sql(table).items():
+            print(f'    {statement.sql}')
+            queries[query_type] = statement
+
+        statement = self.build_upsert_sql(table)
+        if statement is not None:
+            print(f'    {statement.sql}')
+            queries['UPSERT'] = statement
+
+        statement = self.build_update_sql(table)
+        print(f'    {statement.sql}')
+        queries['UPDATE'] = statement
+
+        for query_type, statement in self.build_update_fields_sql(table).items():
+            print(f'    {statement.sql}')
+            queries[query_type] = statement
+
+        statement = self.build_delete_sql(table)
+        print(f'    {statement.sql}')
+        queries['DELETE'] = statement
+
+        statement = self.build_select_sql(table)
+        print(f'    {statement.sql}')
+        queries['SELECT'] = statement
+
+        if len(table.pkey_list) > 0:
+            statement = self.build_select_many_sql(table)
+            print(f'    {statement.sql}')
+            queries['SELECT_MANY'] = statement
+
+            statement = self.build_delete_many_sql(table)
+            print(f'    {statement.sql}')
+            queries['DELETE_MANY'] = statement
+
+        if len(table.pkey_list) > 0 and table.version_column is not None:
+            for query_type, statement in self.build_if_newer_sql(table).items():
+                print(f'    {statement.sql}')
+                queries[query_type] = statement
+
+        statement = self.build_export_sql(table)
+        print(f'    {statement.sql}')
+        queries['EXPORT'] = statement
+
+        indexed_lookups = self.config.get_config()['generator']['indexed_lookups']
+        for index in table.indexes.values():
+            if index.is_list:
+                for query_type, statement in self.build_list_sql(table, index).items():
+                    print(f'    {statement.sql}')
+                    queries[query_type] = statement
+            elif index.is_lookup and indexed_lookups:
+                for query_type, statement in self.build_lookup_sql(table, index).items():
+                    print(f'    {statement.sql}')
+                    queries[query_type] = statement
+
+        # The custom mappings, with their $name parameters bound in order
+        for name, custom_query in table.mappings.items():
+            statement = to_statement(custom_query.query)
+            print(f'    {statement.sql}')
+            queries[name.upper()] = statement
 
         # Now build the foreign key updates
         for rel in table.relations:
-            update_sql = self.build_fkey_sql(table, rel)
-            sql, bind_params, in_params = query_parser.parse_query(update_sql)
-            print(f'    {sql}')
-            queries[f'{rel.constraint_name.upper()}_UPDATE'] = (sql, bind_params, in_params)
+            statement = self.build_fkey_sql(table, rel)
+            print(f'    {statement.sql}')
+            queries[f'{rel.constraint_name.upper()}_UPDATE'] = statement
 
         return queries
 
-    def build_fkey_sql(self, table: Table, rel: ForeignRel):
+    @staticmethod
+    def build_pkey_where(table: Table) -> List[Statement]:
         where_clause = []
         for cname in table.pkey_list:
-            where_clause.append(cname + ' = $' + cname)
+            where_clause.append(literal(cname + ' = ') + bind(cname))
+        return where_clause
+
+    @staticmethod
+    def build_unnest(table: Table, cnames: List[str], ordinality: bool = False, aliases: List[str] = None) -> Statement:
+        # The keys are bound as one array per key column, unnest zips them back into rows. With ordinality, k._ordinal
+        # is the position of the key in the arrays, starting from 1.
+        arrays = [bind(cname) + literal('::' + table.columns[cname].udt_name + '[]') for cname in cnames]
+        aliases = cnames if aliases is None else aliases
+        if ordinality:
+            return literal('unnest(') + join(', ', arrays) + \
+                literal(') WITH ORDINALITY AS k(' + ', '.join(aliases + ['_ordinal']) + ')')
+        return literal('unnest(') + join(', ', arrays) + literal(') AS k(' + ', '.join(aliases) + ')')
+
+    @staticmethod
+    def build_pkey_unnest(table: Table) -> Statement:
+        return Database.build_unnest(table, table.pkey_list)
+
+    def build_select_many_sql(self, table: Table) -> Statement:
+        # Returns the position of each key in the key arrays before the row, as build_delete_many_sql does
+        select_clause = self.build_select_list(table)
+        return literal("SELECT " + ", ".join(['k._ordinal'] + select_clause) + " FROM ") + \
+            self.build_unnest(table, table.pkey_list, True) + \
+            literal(" JOIN " + table.schema + "." + table.name + " USING (" + ', '.join(table.pkey_list) + ")")
+
+    def build_delete_many_sql(self, table: Table) -> Statement:
+        # Returns the position of each deleted key in the key arrays, so the caller's keys are never compared with the
+        # values read back. The table is aliased, its name may be a reserved word.
+        key_clause = ['t.' + cname + ' = k.' + cname for cname in table.pkey_list]
+        return literal("DELETE FROM " + table.schema + "." + table.name + " AS t USING ") + \
+            self.build_unnest(table, table.pkey_list, True) + \
+            literal(" WHERE " + ' AND '.join(key_clause) + " RETURNING k._ordinal")
+
+    def build_if_newer_sql(self, table: Table) -> Dict[str, Statement]:
+        # The table's columns are only sent for the rows whose version differs from the caller's, the LATERAL select
+        # yields NULLs for the others. _changed tells them apart from a row that is gone.
+        version = table.version_column
+        changed = "LEFT JOIN LATERAL (SELECT 1 AS _changed, " + ", ".join(self.build_select_list(table)) + \
+            " WHERE t." + version + " IS DISTINCT FROM "
+        if_newer = literal("SELECT c.* FROM " + table.schema + "." + table.name + " t " + changed) + \
+            bind('known_version') + literal(") c ON true WHERE ") + \
+            join(' AND ', [literal('t.' + cname + ' = ') + bind(cname) for cname in table.pkey_list])
+
+        # The known versions are bound as one more array after the keys. The unnest columns are renamed so they do not
+        # clash with the table's in the LATERAL select.
+        aliases = ['_' + cname for cname in table.pkey_list] + ['_known_version']
+        key_clause = ['t.' + cname + ' = k._' + cname for cname in table.pkey_list]
+        refresh_many = literal("SELECT k._ordinal, c.* FROM ") + \
+            self.build_unnest(table, table.pkey_list + [version], True, aliases) + \
+            literal(" JOIN " + table.schema + "." + table.name + " t ON " + ' AND '.join(key_clause) + " " + changed +
+                    "k._known_version) c ON true")
+        return {'SELECT_IF_NEWER': if_newer, 'REFRESH_MANY': refresh_many}
+
+    @staticmethod
+    def build_list_key(table: Table, index: Index) -> List[str]:
+        # The index columns, made unique by the primary key so that keyset pagination never skips or repeats a row
+        return index.columns + [cname for cname in table.pkey_list if cname not in index.columns]
+
+    @staticmethod
+    def build_list_direction(index: Index) -> str:
+        # ASC, unless the comment of the index has a +ORDER BY line naming its leading columns, e.g. +ORDER BY enabled
+        # DESC. The direction is used for the whole key since a row comparison can only page in a single direction.
+        # None when the line names other columns or mixes directions.
+        lines = [line.strip() for line in (index.comment or '').splitlines()]
+        order_by = [line[len('+ORDER BY'):] for line in lines if line.upper().startswith('+ORDER BY')]
+        if len(order_by) == 0:
+            return 'ASC'
+        cnames, directions = [], set()
+        for item in order_by[0].split(','):
+            parts = item.split()
+            if len(parts) == 0 or len(parts) > 2 or (len(parts) == 2 and parts[1].upper() not in ('ASC', 'DESC')):
+                return None
+            cnames.append(parts[0])
+            directions.add(parts[1].upper() if len(parts) == 2 else 'ASC')
+        if cnames != index.columns[:len(cnames)] or len(directions) != 1:
+            return None
+        return directions.pop()
+
+    def build_list_sql(self, table: Table, index: Index) -> Dict[str, Statement]:
+        if any(cname not in table.columns for cname in index.columns):
+            print(f'    WARNING: Skipping list index {index.name}, only indexes on plain columns can be listed')
+            return {}
+        key = self.build_list_key(table, index)
+        nullable = [cname for cname in key if table.columns[cname].is_nullable]
+        if len(nullable) > 0:
+            # (a, b) > (...) is NULL, not true, for a row with a NULL in its key, so paging would skip it
+            print(f'    WARNING: Skipping list index {index.name}, its columns {nullable} can be NULL')
+            return {}
+        direction = self.build_list_direction(index)
+        if direction is None:
+            print(f'    WARNING: Skipping list index {index.name}, can not page in the order of its comment: '
+                  f'{index.comment}')
+            return {}
+        query_type = index.name.upper()
+        select_clause = self.build_select_list(table)
+        sql = literal("SELECT " + ", ".join(select_clause) + " FROM " + table.schema + "." + table.name)
+        order_by = literal(" ORDER BY " + ', '.join(cname + ' ' + direction for cname in key) + " LIMIT ") + \
+            bind('limit')
+        after = literal(" WHERE (" + ', '.join(key) + (") > (" if direction == 'ASC' else ") < (")) + \
+            join(', ', [bind(cname) for cname in key]) + literal(")")
+        return {query_type: sql + order_by, query_type + '_AFTER': sql + after + order_by}
+
+    def build_lookup_sql(self, table: Table, index: Index) -> Dict[str, Statement]:
+        if any(cname not in table.columns for cname in index.columns):
+            print(f'    WARNING: Skipping lookup index {index.name}, only indexes on plain columns can be looked up')
+            return {}
+        query_type = index.name.upper()
+        select_clause = self.build_select_list(table)
+        where_clause = [literal(cname + ' = ') + bind(cname) for cname in index.columns]
+        # A non unique lookup streams its rows, in primary key order so the stream is repeatable
+        order_by = '' if index.type != IndexType.NON_UNIQUE or len(table.pkey_list) == 0 else \
+            ' ORDER BY ' + ', '.join(table.pkey_list)
+        lookup = literal("SELECT " + ", ".join(select_clause) + " FROM " + table.schema + "." + table.name +
+                         " WHERE ") + join(' AND ', where_clause) + literal(order_by)
+
+        many_order_by = ['k._ordinal'] + table.pkey_list if index.type == IndexType.NON_UNIQUE else ['k._ordinal']
+        lookup_many = literal("SELECT " + ", ".join(['k._ordinal'] + select_clause) + " FROM ") + \
+            self.build_unnest(table, index.columns, True) + \
+            literal(" JOIN " + table.schema + "." + table.name + " USING (" + ', '.join(index.columns) +
+                    ") ORDER BY " + ', '.join(many_order_by))
+        return {query_type: lookup, query_type + '_MANY': lookup_many}
+
+    def build_fkey_sql(self, table: Table, rel: ForeignRel) -> Statement:
+        where_clause = self.build_pkey_where(table)
 
         if table.version_column is not None:
-            where_clause.append(table.version_column + ' = ' + table.version_column + ' + 1')
+            where_clause.append(literal(table.version_column + ' = ' + table.version_column + ' + 1'))
 
         clause = self.build_fkey_update_clause(table, rel)
         returning_clause = self.build_select_list(table)
-        return "UPDATE " + table.schema + "." + table.name + " SET " + ', '.join(clause) + " WHERE " + \
-               ' AND '.join(where_clause) + " RETURNING " + ', '.join(returning_clause)
+        return literal("UPDATE " + table.schema + "." + table.name + " SET ") + join(', ', clause) + \
+            literal(" WHERE ") + join(' AND ', where_clause) + literal(" RETURNING " + ', '.join(returning_clause))
+
+    def build_insert_sql(self, table: Table) -> Statement:
+        (clause, params) = self.build_insert_tuple(table)
+        returning_clause = self.build_select_list(table)
+        return literal("INSERT INTO " + table.schema + "." + table.name + " (" + ', '.join(clause) + ") VALUES (") + \
+            join(', ', params) + literal(") RETURNING " + ', '.join(returning_clause))
 
+    @staticmethod
+    def build_staging_columns(table: Table) -> List[Column]:
+        # One staging column for each distinct bind parameter of the INSERT, in bind order
+        (_, params) = Database.build_insert_tuple(table)
+        cnames = []
+        for param in params:
+            for cname in param.bind_params:
+                if cname not in cnames:
+                    cnames.append(cname)
+        return [table.columns[cname] for cname in cnames]
+
+    @staticmethod
+    def build_staging_name(table: Table) -> str:
+        return '_' + table.schema + '_' + table.name + '_staging'
 
-    def build_insert_sql(self, table: Table) -> str:
+    @staticmethod
+    def is_binary_copy(table: Table) -> bool:
+        return all(postgres_datatypes.is_binary_copyable(col.udt_name) for col in Database.build_staging_columns(table))
+
+    @staticmethod
+    def is_binary_export(table: Table) -> bool:
+        # The type of a select xform is whatever the expression returns, so only plain columns are known to be binary
+        columns = [table.columns[cname] for cname in Database.build_returning_list(table)]
+        return all(col.select_xform is None and postgres_datatypes.is_binary_copyable(col.udt_name) for col in columns)
+
+    @staticmethod
+    def build_staged_keys(table: Table) -> List[Column]:
+        # The primary key columns the INSERT does not set. The staging table draws them from the same sequence or
+        # default, so each staged row knows the key of the row it becomes.
+        (clause, _) = Database.build_insert_tuple(table)
+        return [table.columns[cname] for cname in table.pkey_list if cname not in clause]
+
+    @staticmethod
+    def build_staged_key_default(table: Table, col: Column) -> str:
+        if col.is_sequence:
+            # An identity column has no column_default, so ask for the sequence itself
+            return "nextval(pg_get_serial_sequence('" + table.schema + "." + table.name + "', '" + col.name + \
+                "')::regclass)"
+        return col.default
+
+    def build_staged_insert(self, table: Table) -> Statement:
+        # Inserts the staging rows with the xforms, and the keys drawn by the staging table
+        keys = self.build_staged_keys(table)
         (clause, params) = self.build_insert_tuple(table)
+        values = [literal('s.' + col.name) for col in keys] + \
+            [inline(param, lambda cname: 's.' + cname) for param in params]
+        overriding = ' OVERRIDING SYSTEM VALUE' if any(col.is_sequence for col in keys) else ''
+        return literal("INSERT INTO " + table.schema + "." + table.name + " (" +
+                       ', '.join([col.name for col in keys] + clause) + ")" + overriding + " SELECT ") + \
+            join(', ', values) + literal(" FROM " + self.build_staging_name(table) + " s")
+
+    def build_insert_many_sql(self, table: Table) -> Dict[str, Statement]:
+        # create_many copies the rows into a temp table and inserts them from there in a single statement. RETURNING
+        # has no defined order, so the inserted rows are joined back to their staging rows on the primary key and
+        # sorted by the ordinal they were copied with.
+        staging = self.build_staging_name(table)
+        columns = self.build_staging_columns(table)
+        keys = self.build_staged_keys(table)
+        definitions = ['_ordinal bigint'] + [col.name + ' ' + col.udt_name for col in columns]
+        for col in keys:
+            default = self.build_staged_key_default(table, col)
+            definitions.append(col.name + ' ' + col.udt_name + ('' if default is None else ' DEFAULT ' + default))
+        copy_format = ' (FORMAT BINARY)' if self.is_binary_copy(table) else ''
+
         returning_clause = self.build_select_list(table)
-        return "INSERT INTO " + table.schema + "." + table.name + " (" + ', '.join(clause) + ") VALUES (" + \
-               ', '.join(params) + ") RETURNING " + ', '.join(returning_clause)
+        if len(table.pkey_list) == 0:
+            # Nothing to join on, the rows come back in whatever order the server returns them
+            insert_many = self.build_staged_insert(table) + literal(" RETURNING " + ', '.join(returning_clause))
+        else:
+            (clause, params) = self.build_insert_tuple(table)
+            bound = dict(zip(clause, params))
+            key_values = ['s.' + cname if cname not in bound else inline(bound[cname], lambda c: 's.' + c).sql
+                          for cname in table.pkey_list]
+            returning_clause += [f'{cname} AS _key_{i}' for i, cname in enumerate(table.pkey_list)]
+            select_clause = ['ins.' + cname for cname in self.build_returning_list(table)]
+            on_clause = ' AND '.join(f'ins._key_{i} = {value}' for i, value in enumerate(key_values))
+            insert_many = literal("WITH ins AS (") + self.build_staged_insert(table) + \
+                literal(" RETURNING " + ', '.join(returning_clause) + ") SELECT " + ', '.join(select_clause) +
+                        " FROM ins JOIN " + staging + " s ON " + on_clause + " ORDER BY s._ordinal")
+        return {
+            'INSERT_MANY_STAGING': literal("CREATE TEMP TABLE IF NOT EXISTS " + staging + " (" +
+                                           ', '.join(definitions) + ") ON COMMIT DELETE ROWS"),
+            'INSERT_MANY_TRUNCATE': literal("TRUNCATE " + staging),
+            'INSERT_MANY_COPY': literal("COPY " + staging + " (" + ', '.join(['_ordinal'] + [c.name for c in columns]) +
+                                        ") FROM STDIN" + copy_format),
+            'INSERT_MANY': insert_many
+        }
 
     @staticmethod
-    def build_insert_tuple(table) -> Tuple:
+    def is_direct_import(table: Table) -> bool:
+        # import_stream can COPY straight into the table when the INSERT binds each column to itself or sets the
+        # version
+        (clause, params) = Database.build_insert_tuple(table)
+        return all(table.columns[cname].is_version or (param.sql == '%s' and param.bind_params == [cname])
+                   for cname, param in zip(clause, params))
+
+    def build_import_sql(self, table: Table) -> Dict[str, Statement]:
+        (clause, params) = self.build_insert_tuple(table)
+        if self.is_direct_import(table):
+            copy_format = ' (FORMAT BINARY)' if self.is_binary_copy(table) else ''
+            return {
+                'IMPORT_COPY': literal("COPY " + table.schema + "." + table.name + " (" + ', '.join(clause) +
+                                       ") FROM STDIN" + copy_format)
+            }
+        # Otherwise the rows are copied into the create_many staging table, and inserted from there with the xforms
+        return {
+            'IMPORT': self.build_staged_insert(table)
+        }
+
+    @staticmethod
+    def build_insert_tuple(table) -> Tuple[List[str], List[Statement]]:
         clause = []
         param = []
         for cname in table.insert_list:
@@ -290,15 +723,60 @@ class Database:
             elif col.is_virtual is True:
                 continue
             elif col.is_version is True:
-                p = '0'
+                p = literal('0')
             elif col.insert_xform is not None:
-                p = col.insert_xform
+                p = to_statement(col.insert_xform)
             else:
-                p = '$' + col.name
+                p = bind(col.name)
             clause.append(col.name)
             param.append(p)
         return clause, param
 
+    @staticmethod
+    def build_conflict_columns(table: Table) -> Optional[List[str]]:
+        # The primary key, or else the first unique index, whose columns are all set by the INSERT. A key generated by
+        # a sequence can never conflict with the row being inserted. ON CONFLICT (columns) cannot infer a partial or
+        # expression index from its plain columns alone, so those are skipped.
+        (clause, _) = Database.build_insert_tuple(table)
+        indexes = sorted(table.indexes.values(), key=lambda i: (i.type.value, i.name))
+        for index in indexes:
+            if index.type == IndexType.NON_UNIQUE or index.is_partial or index.columns is None or \
+                    len(index.columns) == 0:
+                continue
+            if all(cname in clause for cname in index.columns):
+                return index.columns
+        return None
+
+    def build_upsert_sql(self, table: Table) -> Statement:
+        conflict_columns = self.build_conflict_columns(table)
+        if conflict_columns is None:
+            return None
+
+        (clause, params) = self.build_insert_tuple(table)
+        set_clause = []
+        for cname in clause:
+            col = table.columns[cname]
+            if col.is_version is True:
+                set_clause.append(cname + ' = t.' + cname + ' + 1')
+            elif cname not in conflict_columns:
+                set_clause.append(cname + ' = EXCLUDED.' + cname)
+        if len(set_clause) == 0:
+            # DO NOTHING would not return the existing row
+            set_clause.append(conflict_columns[0] + ' = EXCLUDED.' + conflict_columns[0])
+
+        # The existing row is only updated when the caller does not check versions, or the versions match
+        where_clause = literal('')
+        version = table.columns.get(table.version_column) if table.version_column is not None else None
+        if version is not None and version.is_version is True:
+            where_clause = literal(' WHERE NOT ') + bind('check_version') + \
+                literal(' OR t.' + version.name + ' = ') + bind(version.name)
+
+        returning_clause = ['(t.xmax = 0) AS inserted'] + self.build_select_list(table)
+        return literal("INSERT INTO " + table.schema + "." + table.name + " AS t (" + ', '.join(clause) +
+                       ") VALUES (") + join(', ', params) + \
+            literal(") ON CONFLICT (" + ', '.join(conflict_columns) + ") DO UPDATE SET " + ', '.join(set_clause)) + \
+            where_clause + literal(" RETURNING " + ', '.join(returning_clause))
+
     @staticmethod
     def build_select_list(table: Table) -> List[str]:
         clause = []
@@ -325,48 +803,78 @@ class Database:
                 clause.append(col.name)
         return clause
 
-    def build_update_sql(self, table: Table):
-        where_clause = []
-        for cname in table.pkey_list:
-            where_clause.append(cname + ' = $' + cname)
+    def build_export_sql(self, table: Table) -> Statement:
+        # export_stream wraps this in a COPY TO, with an optional WHERE clause appended
+        return literal("SELECT " + ', '.join(self.build_select_list(table)) + " FROM " + table.schema + "." +
+                       table.name)
+
+    def build_update_where(self, table: Table) -> Statement:
+        where_clause = self.build_pkey_where(table)
 
         if table.version_column is not None:
-            where_clause.append(table.version_column + ' = $' + table.version_column)
+            where_clause.append(literal(table.version_column + ' = ') + bind(table.version_column))
 
-        clause = self.build_update_clause(table)
         returning_clause = self.build_select_list(table)
-        return "UPDATE " + table.schema + "." + table.name + " SET " + ', '.join(clause) + " WHERE " + \
-               ' AND '.join(where_clause) + " RETURNING " + ', '.join(returning_clause)
+        return literal(" WHERE ") + join(' AND ', where_clause) + literal(" RETURNING " + ', '.join(returning_clause))
 
-    def build_select_sql(self, table: Table):
-        where_clause = []
-        for cname in table.pkey_list:
-            where_clause.append(cname + ' = $' + cname)
+    def build_update_sql(self, table: Table) -> Statement:
+        clause = self.build_update_clause(table)
+        return literal("UPDATE " + table.schema + "." + table.name + " SET ") + join(', ', clause) + \
+            self.build_update_where(table)
+
+    def build_update_fields_sql(self, table: Table) -> Dict[str, Statement]:
+        # update_fields joins the SET clauses of the changed columns between these two. The version and the update
+        # xforms that take no fields are set by every update, so they go with the WHERE clause.
+        always = [clause for (cname, clause) in self.build_update_fields_sets(table, True)]
+        where = self.build_update_where(table)
+        if len(always) > 0:
+            where = literal(', ') + join(', ', always) + where
+        return {'UPDATE_FIELDS': literal("UPDATE " + table.schema + "." + table.name + " SET "),
+                'UPDATE_FIELDS_WHERE': where}
+
+    @staticmethod
+    def build_update_fields_sets(table: Table, always: bool = False) -> List[Tuple[str, Statement]]:
+        # The SET clause of each column of the update, those set only when their fields change or the others
+        sets = []
+        for cname in table.update_list:
+            col = table.columns[cname]
+            if col.is_sequence is True or col.is_virtual is True:
+                continue
+            clause = Database.build_set_clause(col)
+            if (col.is_version is True or len(clause.bind_params) == 0) == always:
+                sets.append((cname, clause))
+        return sets
+
+    def build_select_sql(self, table: Table) -> Statement:
+        where_clause = self.build_pkey_where(table)
 
         select_clause = self.build_select_list(table)
-        return "SELECT " + ", ".join(select_clause) + " FROM " + table.schema + "." + table.name + " WHERE " + \
-               ' AND '.join(where_clause)
+        return literal("SELECT " + ", ".join(select_clause) + " FROM " + table.schema + "." + table.name +
+                       " WHERE ") + join(' AND ', where_clause)
+
+    @staticmethod
+    def build_set_clause(col: Column) -> Statement:
+        if col.is_version is True:
+            return literal(col.name + ' = ' + col.name + ' +1')
+        elif col.update_xform is not None:
+            return literal(col.name + ' = ') + to_statement(col.update_xform)
+        else:
+            return literal(col.name + ' = ') + bind(col.name)
 
     @staticmethod
-    def build_fkey_update_clause(table: Table, rel: ForeignRel) -> List[str]:
+    def build_fkey_update_clause(table: Table, rel: ForeignRel) -> List[Statement]:
         clause = []
         for fcol in rel.foreign_columns:
-            cname = fcol.local_name
-            col = table.columns[cname]
+            col = table.columns[fcol.local_name]
             if col.is_sequence is True:
                 continue
             elif col.is_virtual is True:
                 continue
-            elif col.is_version is True:
-                clause.append(cname + ' = ' + cname + ' +1')
-            elif col.update_xform is not None:
-                clause.append(cname + ' = ' + col.update_xform)
-            else:
-                clause.append(cname + ' = $' + col.name)
+            clause.append(Database.build_set_clause(col))
         return clause
 
     @staticmethod
-    def build_update_clause(table) -> List[str]:
+    def build_update_clause(table) -> List[Statement]:
         clause = []
         for cname in table.update_list:
             col = table.columns[cname]
@@ -374,41 +882,38 @@ class Database:
                 continue
             elif col.is_virtual is True:
                 continue
-            elif col.is_version is True:
-                clause.append(cname + ' = ' + cname + ' +1')
-            elif col.update_xform is not None:
-                clause.append(cname + ' = ' + col.update_xform)
-            else:
-                clause.append(cname + ' = $' + col.name)
+            clause.append(Database.build_set_clause(col))
         return clause
 
-    @staticmethod
-    def build_delete_sql(table: Table):
-        where_clause = []
-        for cname in table.pkey_list:
-            where_clause.append(cname + ' = $' + cname)
-        return "DELETE FROM " + table.schema + "." + table.name + " WHERE " + " AND ".join(where_clause)
+    def build_delete_sql(self, table: Table) -> Statement:
+        where_clause = self.build_pkey_where(table)
+        return literal("DELETE FROM " + table.schema + "." + table.name + " WHERE ") + join(" AND ", where_clause)
 
-    def maybe_inject_version_column(self):
+    def maybe_inject_version_column(self) -> List[str]:
+        # Returns the names of the schemas with a table that was altered
+        altered = []
         inject = self.config.get_config()['generator']['inject_version_column']
         if inject:
             version_cname = self.config.get_config()['generator']['version_column']
             print('Maybe Inject Version Column')
             print('--------------------------------------------------------')
-            for schema in self.schemas.values():
-                conn = schema.connect()
-                for table in schema.tables.values():
-                    print(f'     {table.schema}.{table.name}.{version_cname}...', end='')
-                    if table.has_version:
-                        print('exists')
-                        continue
-
-                    print('does not exist, ADDING')
-                    alter_sql = f'ALTER TABLE {table.schema}.{table.name} ADD COLUMN {version_cname} bigint'
-                    try:
-                        conn.execute(alter_sql)
-                        conn.commit()
-                        table.version_column = version_cname
-                    except (Exception, psycopg.DatabaseError) as error:
-                        print(f'FAILED. {error.pgcode[:2]} - {error.pgcode}')
-                conn.close()
+            with self.pool.connection() as conn:
+                for schema in self.schemas.values():
+                    for table in schema.tables.values():
+                        print(f'     {table.schema}.{table.name}.{version_cname}...', end='')
+                        if table.has_version:
+                            print('exists')
+                            continue
+
+                        print('does not exist, ADDING')
+                        alter_sql = f'ALTER TABLE {table.schema}.{table.name} ADD COLUMN {version_cname} bigint'
+                        try:
+                            conn.execute(alter_sql)
+                            conn.commit()
+                            table.version_column = version_cname
+                            if schema.name not in altered:
+                                altered.append(schema.name)
+                        except (Exception, psycopg.DatabaseError) as error:
+                            conn.rollback()
+                            print(f'FAILED. {error.pgcode[:2]} - {error.pgcode}')
+        return altered
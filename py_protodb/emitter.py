@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Precompiled templates and a single buffer to render the generated files into
+"""
+import os
+import re
+from typing import Dict
+
+FIELD = re.compile(r'\$\{(\w+)\}')
+
+
+class Template:
+    """A template with ${name} fields. The text is split into its literals and fields once, when the template is
+    defined, so rendering is a single join.
+    """
+    def __init__(self, text: str):
+        parts = FIELD.split(text)
+        self.literals = parts[0::2]
+        self.fields = parts[1::2]
+
+    def render(self, ctx: Dict[str, str]) -> str:
+        out = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            out.append(ctx[field])
+            out.append(literal)
+        return ''.join(out)
+
+
+class Emitter:
+    """Collects the rendered templates of one file in memory and writes the file out in one go. Fields given to the
+    constructor are rendered into every template, unless a call to emit overrides them.
+    """
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self.buffer = []
+
+    def emit(self, template: Template, **ctx):
+        self.buffer.append(template.render({**self.defaults, **ctx}))
+
+    def write(self, text: str):
+        self.buffer.append(text)
+
+    def getvalue(self) -> str:
+        return ''.join(self.buffer)
+
+    def write_file(self, fname: str):
+        data = memoryview(self.getvalue().encode('utf-8'))
+        fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            while len(data) > 0:
+                written = os.write(fd, data)
+                data = data[written:]
+        finally:
+            os.close(fd)
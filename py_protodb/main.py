@@ -2,10 +2,12 @@
 import getopt
 import sys
 
+import parallel
 from config import Config
 from database import Database
 from proto_gen import ProtoGen
 from code_gen import CodeGen
+from manifest import Manifest
 
 
 def generate(argv):
@@ -13,31 +15,63 @@ def generate(argv):
     print(f'                              py-protodb')
     print(f'========================================================================\n')
     try:
-        opts, args = getopt.getopt(argv, "hc", ["help", "config="])
+        opts, args = getopt.getopt(argv, "hc:ij:", ["help", "config=", "incremental", "jobs="])
     except getopt.GetoptError as error:
-        print(f'usage: --help | --c <config> : {error}')
+        print(f'usage: --help | --c <config> | --incremental | --jobs <N> : {error}')
         sys.exit(2)
 
     c = './py-protodb.yaml'
+    incremental = None
+    jobs = None
     for opt, arg in opts:
         if opt in ('-h', '--help'):
-            print(f'usage: --help | --c <config>')
+            print(f'usage: --help | --c <config> | --incremental | --jobs <N>')
             sys.exit()
         elif opt in ("-c", "--config"):
             c = arg
+        elif opt in ("-i", "--incremental"):
+            incremental = True
+        elif opt in ("-j", "--jobs"):
+            if not arg.isdigit() or int(arg) < 1:
+                print(f'usage: --jobs <N> : N must be a positive number, got {arg}')
+                sys.exit(2)
+            jobs = int(arg)
 
     print(f'Using config: {c}')
     config = Config(c)
+    if incremental is None:
+        incremental = config.get_config()['output'].get('incremental', False)
+    if jobs is None:
+        jobs = int(config.get_config()['output'].get('jobs', 1))
 
     database = Database(config)
+    manifest = Manifest(config, database)
+    if incremental:
+        # Only the tables whose model changed since the last run are written, everything else is left untouched
+        tables = manifest.changed_tables()
+        print(f'Incremental: {len(tables)} of {len(database.get_tables())} tables changed')
+    else:
+        tables = database.get_tables()
+
     proto = ProtoGen(config, database)
-    proto.generate_protos()
+    codegen = CodeGen(config, database)
+    if jobs > 1 and len(tables) > 1:
+        errors = parallel.generate(proto, codegen, tables, jobs)
+    else:
+        proto.generate_protos(tables)
 
-    # Compile the protobuffers
-    proto.compile_all()
+        # Compile the protobuffers
+        errors = proto.compile_all(tables)
 
-    codegen = CodeGen(config, database)
-    codegen.generate_code()
+        codegen.generate_code(tables)
+
+    # Tables that failed to compile stay out of the manifest so the next incremental run tries them again
+    manifest.update([t for t in tables if t.fqn not in errors])
+    manifest.save()
+
+    if len(errors) > 0:
+        print(f'\n{len(errors)} protos failed to compile: {", ".join(errors.keys())}')
+        sys.exit(1)
 
     print(f'\n================================ DONE ==================================\n')
 
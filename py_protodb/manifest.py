@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""Tracks a content hash of every table's model so that unchanged tables can be skipped when regenerating
+"""
+import hashlib
+import json
+import os
+from typing import List
+
+from config import Config
+from database import Database
+from schema import Table
+from snapshot import dump_table, to_json
+
+MANIFEST_VERSION = 1
+
+# Generator settings that only apply to specific tables are already part of the table model
+TABLE_SCOPED_KEYS = ('schemas', 'excluded_tables', 'excluded_columns', 'extensions', 'caches', 'mapping', 'transforms',
+                     'snapshot', 'introspection')
+
+
+class Manifest:
+    def __init__(self, config: Config, database: Database):
+        self.config = config
+        self.database = database
+        self.output_path = self.config.get_config()['output']['path']
+        self.proto_path = self.config.get_config()['proto']['path']
+        self.suffix = self.config.get_config()['output']['suffix']
+        self.filename = self.config.get_config()['output'].get('manifest')
+        if self.filename is None or self.filename == '':
+            self.filename = os.path.sep.join([self.output_path, '.py-protodb.manifest.json'])
+        self.config_hash = self.build_config_hash()
+        self.entries = self.load()
+
+    def build_config_hash(self) -> str:
+        cfg = self.config.get_config()
+        key = {
+            'version': MANIFEST_VERSION,
+            'database': [cfg['database']['database'], cfg['database']['user']],
+            'output': {k: v for k, v in cfg['output'].items() if k not in ('manifest', 'incremental')},
+            'proto': cfg['proto'],
+            'generator': {k: v for k, v in cfg['generator'].items() if k not in TABLE_SCOPED_KEYS}
+        }
+        return hashlib.sha256(to_json(key, sort_keys=True).encode()).hexdigest()
+
+    def table_hash(self, table: Table) -> str:
+        # Columns, transforms, mappings, relations and indexes all live on the table model
+        model = to_json(dump_table(table), sort_keys=True)
+        return hashlib.sha256(f'{self.config_hash}:{model}'.encode()).hexdigest()
+
+    def output_files(self, table: Table) -> List[str]:
+        return [os.path.sep.join([self.proto_path, table.schema, table.name + '.proto']),
+                os.path.sep.join([self.output_path, table.schema, table.name + '_pb2.py']),
+                os.path.sep.join([self.output_path, table.schema, table.name + self.suffix + '.py']),
+                os.path.sep.join([self.output_path, table.schema, table.name + self.suffix + '_async.py'])]
+
+    def load(self) -> dict:
+        if not os.path.exists(self.filename):
+            return {}
+        try:
+            with open(self.filename, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError) as error:
+            print(f'    WARNING: Ignoring unreadable manifest {self.filename}: {error}')
+            return {}
+
+    def is_changed(self, table: Table) -> bool:
+        entry = self.entries.get(table.fqn)
+        if entry is None or entry['hash'] != self.table_hash(table):
+            return True
+        # Regenerate anything that has gone missing from the output
+        return not all(os.path.exists(f) for f in entry['files'])
+
+    def changed_tables(self) -> List[Table]:
+        return [table for table in self.database.get_tables() if self.is_changed(table)]
+
+    def update(self, tables: List[Table]):
+        for table in tables:
+            self.entries[table.fqn] = {'hash': self.table_hash(table), 'files': self.output_files(table)}
+
+    def save(self):
+        # Tables that are no longer in the model drop out of the manifest. Their files are left alone.
+        current = set(t.fqn for t in self.database.get_tables())
+        for fqn in [k for k in self.entries if k not in current]:
+            print(f'    INFO: {fqn} is no longer in the schema, removing it from the manifest')
+            del self.entries[fqn]
+
+        path = os.path.dirname(self.filename)
+        if path != '' and not os.path.exists(path):
+            os.makedirs(path)
+        tmp_fname = self.filename + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+        os.replace(tmp_fname, self.filename)
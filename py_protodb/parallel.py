@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""Spreads writing, compiling and emitting the code for each table over a pool of processes
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from code_gen import CodeGen
+from proto_gen import ProtoGen
+from schema import Table
+
+# Chunks per worker, small enough to balance the load but large enough to keep the protoc batches worthwhile
+CHUNKS_PER_JOB = 4
+
+# The generators of each worker process, set once by init_worker
+worker_proto = None
+worker_codegen = None
+
+
+def init_worker(proto: ProtoGen, codegen: CodeGen):
+    global worker_proto, worker_codegen
+    worker_proto = proto
+    worker_codegen = codegen
+
+
+def emit_chunk(schema_name: str, tables: List[Table]) -> Dict[str, str]:
+    for table in tables:
+        worker_proto.generate(table)
+    errors = worker_proto.compile_schema(schema_name, tables)
+    for table in tables:
+        worker_codegen.generate(table)
+    return errors
+
+
+def chunk_tables(tables: List[Table], jobs: int) -> List[Tuple[str, List[Table]]]:
+    # Every chunk holds tables from a single schema so that it compiles as one protoc batch
+    by_schema = {}
+    for table in tables:
+        by_schema.setdefault(table.schema, []).append(table)
+    size = max(1, math.ceil(len(tables) / (jobs * CHUNKS_PER_JOB)))
+    return [(schema_name, schema_tables[i: i + size])
+            for schema_name, schema_tables in by_schema.items()
+            for i in range(0, len(schema_tables), size)]
+
+
+def generate(proto: ProtoGen, codegen: CodeGen, tables: List[Table], jobs: int) -> Dict[str, str]:
+    """Generates the protos and code for the tables over `jobs` processes. Returns the compiler errors keyed by the
+    table fqn, in the same order as a serial run.
+    """
+    print(f'\n------- Generating Protobuffers and Code ({jobs} jobs) --------\n')
+    errors = {}
+    chunks = chunk_tables(tables, jobs)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(proto, codegen)) as executor:
+        futures = [executor.submit(emit_chunk, schema_name, chunk) for schema_name, chunk in chunks]
+        for future in futures:
+            errors.update(future.result())
+
+    for fqn, error in errors.items():
+        print(f'   Failed to compile proto for {fqn}:\n{error}')
+    return errors
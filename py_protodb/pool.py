@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+"""A small bounded connection pool shared by the schema readers
+"""
+import queue
+import threading
+from contextlib import contextmanager
+
+import psycopg
+from psycopg.pq import TransactionStatus
+
+from config import Config
+
+DEFAULT_POOL_SIZE = 4
+
+
+class ConnectionPool:
+    def __init__(self, config: Config):
+        self.config = config
+        self.size = max(1, int(config.get_config()['database'].get('pool_size', DEFAULT_POOL_SIZE)))
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.opened = []
+
+    def connect(self):
+        host = self.config.get_config()['database']['host']
+        port = self.config.get_config()['database']['port']
+        dbname = self.config.get_config()['database']['database']
+        user = self.config.get_config()['database']['user']
+        password = self.config.get_config()['database']['password']
+        conn_str = f'host={host} port={port} dbname={dbname} user={user} password={password}'
+        return psycopg.connect(conn_str)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            # Reserve a slot while holding the lock, but connect outside of it so that opening connections does not
+            # serialize the workers.
+            with self.lock:
+                can_open = len(self.opened) < self.size
+                if can_open:
+                    self.opened.append(None)
+            if can_open:
+                break
+
+            # Wait for a connection to be released, checking again for a free slot if a broken one was dropped
+            try:
+                return self.idle.get(timeout=1)
+            except queue.Empty:
+                pass
+
+        try:
+            conn = self.connect()
+        except Exception:
+            with self.lock:
+                self.opened.remove(None)
+            raise
+        with self.lock:
+            self.opened[self.opened.index(None)] = conn
+        return conn
+
+    def release(self, conn):
+        if conn.broken:
+            with self.lock:
+                self.opened.remove(conn)
+            conn.close()
+            return
+
+        # Never hand out a connection with an open (or aborted) transaction
+        if conn.info.transaction_status != TransactionStatus.IDLE:
+            conn.rollback()
+        self.idle.put(conn)
+
+    def close(self):
+        with self.lock:
+            opened = [c for c in self.opened if c is not None]
+            self.opened = []
+        for conn in opened:
+            conn.close()
+        self.idle = queue.LifoQueue()
@@ -1,10 +1,17 @@
 #!/usr/bin/env python
+import threading
 from collections import OrderedDict
+from typing import Dict, List, Tuple
 
 import psycopg
+from psycopg import pq
+
 import postgres_datatypes
+import query_parser
 
+from catalog import Catalog
 from config import Config
+from pool import ConnectionPool
 from schema import Schema, Table, Column, Index, IndexType, ForeignRel, ForeignColumn, InvalidParseError
 
 # Postgres statements
@@ -60,6 +67,7 @@ READ_INDEXES = """SELECT
         a.attname AS column_name,
         ix.indisunique is_unique,
         ix.indisprimary is_pkey,
+        ix.indpred IS NOT NULL OR ix.indexprs IS NOT NULL AS is_partial,
         obj_description(i.oid) AS comment
     FROM
         pg_class t,
@@ -77,7 +85,7 @@ READ_INDEXES = """SELECT
         AND t.relnamespace = ns.oid
         AND ns.nspname = %s
     ORDER BY
-        index_name, column_name"""
+        index_name, array_position(ix.indkey::int2[], a.attnum)"""
 
 READ_FOREIGN_RELATIONSHIPS = """SELECT DISTINCT
         rc.constraint_name,
@@ -100,7 +108,7 @@ READ_FOREIGN_RELATIONSHIPS = """SELECT DISTINCT
         AND kcu.table_name = %s
         AND kcu.position_in_unique_constraint IS NOT NULL
     ORDER BY
-        foreign_schema, foreign_table"""
+        foreign_schema, foreign_table, constraint_name, ordinal_position"""
 
 READ_CHECK_CONSTRAINTS = """SELECT
         pg_get_constraintdef(pgc.oid) as constr
@@ -113,7 +121,31 @@ READ_CHECK_CONSTRAINTS = """SELECT
     WHERE
         contype ='c'
         AND ccu.table_schema = %s
-        AND ccu.table_name = %s"""
+        AND ccu.table_name = %s
+    ORDER BY
+        pgc.conname"""
+
+READ_TYPES = """SELECT
+        t.oid,
+        t.typname,
+        t.typtype,
+        t.typbasetype,
+        t.typelem,
+        t.typcategory
+    FROM
+        pg_type t"""
+
+READ_TYPE = """SELECT
+        t.oid,
+        t.typname,
+        t.typtype,
+        t.typbasetype,
+        t.typelem,
+        t.typcategory
+    FROM
+        pg_type t
+    WHERE
+        t.oid = %(oid)s"""
 
 
 def parse_name(param):
@@ -121,37 +153,105 @@ def parse_name(param):
     return param[1: pos]
 
 
+class TypeMap:
+    """Maps pg_type OIDs to type names. The whole of pg_type is read once, on first use, and shared by every schema.
+    Domains resolve to their base type and arrays to their element type followed by [] (i.e. int4[]).
+    """
+    def __init__(self, pool: ConnectionPool):
+        self.pool = pool
+        self.types = None
+        self.names = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.types is not None:
+                return
+            types = {}
+            with self.pool.connection() as conn:
+                cur = conn.execute(READ_TYPES)
+                for record in cur:
+                    types[record[0]] = record
+                cur.close()
+            self.types = types
+            print(f'Loaded {len(types)} types from pg_type')
+
+    def get_name(self, oid: int) -> str:
+        if self.types is None:
+            self.load()
+        if oid not in self.names:
+            self.names[oid] = self.resolve(oid)
+        return self.names[oid]
+
+    def resolve(self, oid: int) -> str:
+        if oid not in self.types:
+            # Created after the map was loaded
+            with self.pool.connection() as conn:
+                cur = conn.execute(READ_TYPE, {'oid': oid})
+                record = cur.fetchone()
+                cur.close()
+            if record is None:
+                raise InvalidParseError(f'Unknown type oid {oid}')
+            self.types[oid] = record
+
+        (_oid, typname, typtype, typbasetype, typelem, typcategory) = self.types[oid]
+        if typtype == 'd':
+            return self.resolve(typbasetype)
+        if typcategory == 'A' and typelem != 0:
+            return self.resolve(typelem) + '[]'
+        return typname
+
+
 class Postgres(Schema):
-    def __init__(self, schema_name: str, cfg: Config):
+    def __init__(self, schema_name: str, cfg: Config, pool: ConnectionPool, types: TypeMap = None,
+                 tables: Dict[str, Table] = None):
         self.config = cfg
         self.name = schema_name
-        Schema.__init__(self, cfg)
-        self.read_tables()
-
-    def connect(self):
-        host = self.config.get_config()['database']['host']
-        port = self.config.get_config()['database']['port']
-        dbname = self.config.get_config()['database']['database']
-        user = self.config.get_config()['database']['user']
-        password = self.config.get_config()['database']['password']
-        conn_str = f'host={host} port={port} dbname={dbname} user={user} password={password}'
-        return psycopg.connect(conn_str)
-
-    def execute_query(self, query: str, params: tuple):
-        return self.conn.execute(query, params)
+        Schema.__init__(self, cfg, pool)
+        self.types = types if types is not None else TypeMap(pool)
+        if tables is None:
+            self.read_tables()
+        else:
+            self.load_tables(tables)
+
+    def load_tables(self, tables: Dict[str, Table]):
+        # Restores the schema from previously read tables, e.g. a snapshot, without touching the catalog
+        self.tables = tables
+        self.columns = OrderedDict()
+        self.indexes = {}
+        for table in tables.values():
+            for column in table.columns.values():
+                if not column.is_virtual:
+                    self.columns[f'{table.name}.{column.name}'] = column
+            for index in table.indexes.values():
+                self.indexes[index.name] = index
+
+    def execute_query(self, query: str, params: tuple) -> List[tuple]:
+        # The rows are fetched before the connection goes back to the pool, which rolls it back
+        with self.pool.connection() as conn:
+            cur = conn.execute(query, params)
+            rows = cur.fetchall() if cur.description is not None else []
+            cur.close()
+        return rows
 
     def get_column_datatype(self, oid: int):
-        query = """
-            SELECT 
-                typname
-            FROM
-                pg_type
-            WHERE
-                oid = %(oid)s"""
-        cur = self.conn.execute(query, {'oid': oid})
-        (t, ) = cur.fetchone()
-        cur.close()
-        return t
+        return self.types.get_name(oid)
+
+    def describe_query(self, query: str) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+        """Prepares the query as the unnamed statement and describes it (Parse/Describe, never Execute). Returns the
+        (name, type oid) of each result column and of each $name bind parameter.
+        """
+        sql, names = query_parser.number_placeholders(query)
+        with self.pool.connection() as conn:
+            res = conn.pgconn.prepare(b'', sql.encode(conn.info.encoding))
+            if res.status != pq.ExecStatus.COMMAND_OK:
+                raise psycopg.ProgrammingError(res.error_message.decode(errors='replace').strip())
+            desc = conn.pgconn.describe_prepared(b'')
+            if desc.status != pq.ExecStatus.COMMAND_OK:
+                raise psycopg.ProgrammingError(desc.error_message.decode(errors='replace').strip())
+            columns = [(desc.fname(i).decode(), desc.ftype(i)) for i in range(desc.nfields)]
+            params = [(names[i], desc.param_type(i)) for i in range(desc.nparams)]
+        return columns, params
 
     def read_tables(self):
         print(f'Reading tables from schema: {self.name}')
@@ -159,7 +259,12 @@ class Postgres(Schema):
         excluded_tables = ",".join([f'\'{s}\'' for s in self.config.get_config()['generator']['excluded_tables']])
         print(f'Excluding tables: {excluded_tables}')
         query = READ_TABLES.replace('_EXCLUDED_', excluded_tables)
-        cur = self.conn.execute(query, (self.name,))
+        with self.pool.connection() as conn:
+            self.read_schema(conn, query)
+        print('')
+
+    def read_schema(self, conn, query: str):
+        cur = conn.execute(query, (self.name,))
         for record in cur:
             (s, n) = record
             table = Table(s, n, OrderedDict(), {}, [], {}, {}, '', [], [], [], [], [])
@@ -167,23 +272,39 @@ class Postgres(Schema):
                 self.tables = {}
             self.tables[n] = table
         cur.close()
+
+        # The catalog introspection reads the entire schema in a handful of set based queries, while per_table runs
+        # four queries for every table. Both feed the same loaders.
+        catalog = None
+        if self.config.get_config()['generator'].get('introspection', 'catalog') == 'catalog':
+            catalog = Catalog(conn, self.name)
+
         for table in self.tables:
             t = self.tables[table]
             print(f'    {t.schema}.{t.name}')
-            self.read_columns(t)
-            self.read_indexes(t)
-            self.read_relationships(t)
-            self.read_constraints(t)
+            if catalog is not None:
+                self.load_columns(t, catalog.get_columns(t.name))
+                self.load_indexes(t, catalog.get_indexes(t.name))
+                self.load_relationships(t, catalog.get_relations(t.name))
+                self.load_constraints(t, catalog.get_constraints(t.name))
+            else:
+                self.read_columns(conn, t)
+                self.read_indexes(conn, t)
+                self.read_relationships(conn, t)
+                self.read_constraints(conn, t)
             print(f'            SELECT: {t.select_list}')
             print(f'            INSERT: {t.insert_list}')
             print(f'            UPDATE: {t.update_list}')
             print(f'    -------------------------------------------------')
-        print('')
 
-    def read_columns(self, table: Table):
+    def read_columns(self, conn, table: Table):
+        cur = conn.execute(READ_COLUMNS, (table.name, table.schema))
+        self.load_columns(table, cur)
+        cur.close()
+
+    def load_columns(self, table: Table, records):
         version = self.config.get_config()['generator']['version_column']
-        cur = self.conn.execute(READ_COLUMNS, (table.name, table.schema))
-        for record in cur:
+        for record in records:
             (cname, opos, dtype, udt_name, coldef, is_nullable, is_pkey, is_seq) = record
             print(f'            Column: {cname}, {opos}, {dtype}, {udt_name}, {is_nullable}, {is_pkey}, {is_seq}')
             column = Column(table.name, table.schema, cname, dtype, udt_name, coldef, '', opos,
@@ -225,21 +346,24 @@ class Postgres(Schema):
             if is_pkey is False and is_seq is False:
                 table.update_list.append(cname)
                 table.insert_list.append(cname)
+
+    def read_indexes(self, conn, table: Table):
+        cur = conn.execute(READ_INDEXES, (table.name, table.schema))
+        self.load_indexes(table, cur)
         cur.close()
 
-    def read_indexes(self, table: Table):
+    def load_indexes(self, table: Table, records):
         if self.indexes is None:
             self.indexes = {}
 
         if table.indexes is None:
             table.indexes = {}
 
-        cur = self.conn.execute(READ_INDEXES, (table.name, table.schema))
         curname = None
         name_list = []
         index = None
-        for record in cur:
-            (iname, cname, is_unique, is_pkey, comment) = record
+        for record in records:
+            (iname, cname, is_unique, is_pkey, is_partial, comment) = record
             if iname != curname:
                 # Store the current index and start a new one
                 if index is not None:
@@ -261,7 +385,8 @@ class Postgres(Schema):
                 elif iname.startswith('lookup_'):
                     is_lookup = True
 
-                index = Index(table.name, table.schema, iname, idx_type, [], is_list, is_lookup, comment)
+                index = Index(table.name, table.schema, iname, idx_type, [], is_list, is_lookup, comment, is_partial)
+                name_list = []
 
             # Add cname to list
             name_list.append(cname)
@@ -272,17 +397,20 @@ class Postgres(Schema):
             print(f'             Index: {index.name}, {index.type}, {name_list}')
             self.indexes[index.name] = index
             table.indexes[index.name] = index
+
+    def read_relationships(self, conn, table: Table):
+        cur = conn.execute(READ_FOREIGN_RELATIONSHIPS, (table.schema, table.name))
+        self.load_relationships(table, cur)
         cur.close()
 
-    def read_relationships(self, table: Table):
+    def load_relationships(self, table: Table, records):
         if table.relations is None:
-            table.relations = {}
+            table.relations = []
 
-        cur = self.conn.execute(READ_FOREIGN_RELATIONSHIPS, (table.schema, table.name))
         curname = None
         fcol_list = []
         frel = None
-        for record in cur:
+        for record in records:
             (constr_name, fschema, ftable, fcname, lcname, opos) = record
             fcol = ForeignColumn(fcname, lcname, opos)
             if constr_name != curname:
@@ -304,7 +432,6 @@ class Postgres(Schema):
             print(f'          Relation: {frel.constraint_name}, {frel.foreign_schema}, {frel.foreign_table}, '
                   f'{frel.foreign_columns}')
             table.relations.append(frel)
-        cur.close()
         self.exclude_from_update(table)
 
     @staticmethod
@@ -317,9 +444,14 @@ class Postgres(Schema):
                 except ValueError as _e:
                     pass
 
-    def read_constraints(self, table: Table):
-        cur = self.conn.execute(READ_CHECK_CONSTRAINTS, (table.schema, table.name))
-        for record in cur:
+    def read_constraints(self, conn, table: Table):
+        cur = conn.execute(READ_CHECK_CONSTRAINTS, (table.schema, table.name))
+        self.load_constraints(table, cur)
+        cur.close()
+
+    @staticmethod
+    def load_constraints(table: Table, records):
+        for record in records:
             (constr,) = record
             # We need to parse the constraint:
             #   CHECK ((number_value > 1))
@@ -334,9 +466,7 @@ class Postgres(Schema):
                 e = constr.find("]")
                 col = table.columns[cname]
                 if col is None:
-                    cur.close()
                     raise InvalidParseError(f'Failed to lookup column {cname} from table {table.schema}.{table.name}')
                 col.valid_values = [parse_name(x.strip()) for x in constr[s: e].split(',')]
                 print(f'      Valid Values: {col.valid_values}')
                 table.has_valid_values = True
-        cur.close()
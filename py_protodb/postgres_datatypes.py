@@ -3,6 +3,12 @@
 """
 
 
+# Types whose binary COPY dumpers accept the values the generated code reads from a proto. Anything else is copied as
+# text and left to the server to parse (uuid from str, timestamptz from a naive datetime, numeric from float, ...).
+BINARY_COPY_TYPES = ('smallint', 'integer', 'bigint', 'real', 'double precision', 'boolean', 'text',
+                     'character varying', 'character', 'bytea', 'timestamp without time zone')
+
+
 def is_int64(dt: str):
     match dt:
         case 'bigint':
@@ -22,7 +28,7 @@ def is_timestamp(udt_name):
 
 
 def is_array(dtype):
-    if dtype == 'ARRAY':
+    if dtype == 'ARRAY' or dtype.endswith('[]'):
         return True
     return False
 
@@ -33,6 +39,12 @@ def is_date(udt_name):
     return False
 
 
+def is_binary_copyable(udt_name: str):
+    if udt_name.endswith('[]'):
+        udt_name = udt_name[:-2]
+    return udt_name in BINARY_COPY_TYPES
+
+
 def sql_to_proto_datatype(dt: str):
     # special cases
     if dt.startswith('bit'):
@@ -71,5 +83,8 @@ def sql_to_proto_datatype(dt: str):
         case 'jsonb':
             return 'bytes'
         case _:
+            # Any other array maps to its element type
+            if dt.endswith('[]'):
+                return sql_to_proto_datatype(dt[:-2])
             print(f'    [warning] Failed to map postgres datatype to protobuf: {dt}. Using \"bytes\"')
             return 'bytes'
@@ -1,15 +1,66 @@
 #!/usr/bin/env python
 import os
+import subprocess
 import sys
+import tempfile
+from contextlib import contextmanager
 from datetime import datetime
-from typing import List
+from typing import List, Dict, Tuple
 
 import code_gen
 import postgres_datatypes
 from config import Config
 from database import Database
+from emitter import Emitter, Template
 from schema import Table, BindVar
 
+try:
+    from grpc_tools import protoc as grpc_protoc
+    GRPC_PROTO_INCLUDE = os.path.join(os.path.dirname(grpc_protoc.__file__), '_proto')
+except ImportError:
+    grpc_protoc = None
+    GRPC_PROTO_INCLUDE = None
+
+
+@contextmanager
+def capture_stderr():
+    # protoc writes its diagnostics straight to file descriptor 2, so redirect the descriptor rather than sys.stderr
+    sys.stderr.flush()
+    output = []
+    saved = os.dup(2)
+    with tempfile.TemporaryFile(mode='w+') as captured:
+        os.dup2(captured.fileno(), 2)
+        try:
+            yield output
+        finally:
+            os.dup2(saved, 2)
+            os.close(saved)
+            captured.seek(0)
+            output.append(captured.read())
+
+
+HEADER = Template("""// -*- coding: utf-8 -*-
+// ------------------------------------------------------------------------------
+// This file is automatically generated from the database schema using py-protodb
+// database:     ${database}
+// user:         ${user}
+// generated on: ${generated_on}
+// ----------------- DO NOT MAKE CHANGES DIRECTLY TO THIS FILE! -----------------
+syntax = "${version}";
+
+package ${schema};
+
+option cc_enable_arenas = true;
+option java_package = "${java_package}.${schema}";
+option java_outer_classname = "${message_name}Proto";
+option java_multiple_files = true;
+option objc_class_prefix = "${objc_prefix}";
+
+""")
+
+FIELD = Template("""  ${field_type} ${ftype} ${cname} = ${field_no};
+""")
+
 
 def not_none(s: str):
     if s is None:
@@ -27,12 +78,15 @@ class ProtoGen:
         self.go_package = self.config.get_config()['proto']['go_package']
         self.objc_prefix = self.config.get_config()['proto']['objc_prefix']
         self.version = self.config.get_config()['proto']['version']
+        self.optional = 'optional' if self.version == 'proto2' else ''
+        self.db_name = self.config.get_config()['database']['database']
+        self.db_user = self.config.get_config()['database']['user']
+        self.generated_on = datetime.now()
 
-    def generate_protos(self):
+    def generate_protos(self, tables: List[Table] = None):
         print(f'\n------- Generating Protobuffers --------\n')
-        for schema in self.database.schemas.values():
-            for table in schema.tables.values():
-                self.generate(table)
+        for table in self.database.get_tables(tables):
+            self.generate(table)
 
     def generate(self, table: Table):
         proto_path = os.path.sep.join([self.path, table.schema])
@@ -42,45 +96,32 @@ class ProtoGen:
             os.makedirs(proto_path)
         self.write_proto(proto_fname, table)
 
+    def render(self, table: Table) -> Emitter:
+        out = Emitter()
+        message_name = ''.join(word.title() for word in table.name.split('_'))
+        out.emit(HEADER, database=self.db_name, user=self.db_user,
+                 generated_on=self.generated_on.strftime("%m/%d/%Y, %H:%M:%S"), version=self.version,
+                 schema=table.schema, java_package=self.java_package, message_name=message_name,
+                 objc_prefix=self.objc_prefix)
+
+        # other imports
+        self.write_imports(out, table)
+
+        self.write_message(message_name, out, table)
+
+        out.write("//-------------------------- Raw Proto -----------------------------\n")
+
+        message_name = 'Raw' + message_name
+        self.write_message(message_name, out, table, True)
+
+        self.write_custom_proto(out, table)
+        return out
+
     def write_proto(self, proto_fname: str, table: Table):
-        with open(proto_fname, 'w') as pfile:
-            now = datetime.now()
-            header = ("// -*- coding: utf-8 -*-\n"
-                      "// ------------------------------------------------------------------------------\n"
-                      "// This file is automatically generated from the database schema using py-protodb\n"
-                      "// database:     " + self.config.get_config()['database']['database'] + "\n"
-                      "// user:         " + self.config.get_config()['database']['user'] + "\n"
-                      "// generated on: " + now.strftime("%m/%d/%Y, %H:%M:%S") + "\n"
-                      "// ----------------- DO NOT MAKE CHANGES DIRECTLY TO THIS FILE! -----------------\n"
-                      "syntax = \"" + self.version + "\";\n\n")
-            pfile.write(header)
-            pfile.write('package ' + table.schema + ';\n\n')
-
-            # options
-            message_name = ''.join(word.title() for word in table.name.split('_'))
-            option = ("option cc_enable_arenas = true;\n"
-                      "option java_package = \"" + self.java_package + "." + table.schema + "\";\n"
-                      "option java_outer_classname = \"" + message_name + "Proto\";\n"
-                      "option java_multiple_files = true;\n"
-                      "option objc_class_prefix = \"" + self.objc_prefix + "\";\n\n")
-            pfile.write(option)
-
-            # other imports
-            self.write_imports(pfile, table)
-
-            self.write_message(message_name, pfile, table)
-
-            comment = "//-------------------------- Raw Proto -----------------------------\n"
-            pfile.write(comment)
-
-            message_name = 'Raw' + message_name
-            self.write_message(message_name, pfile, table, True)
-
-            self.write_custom_proto(pfile, table)
-            pfile.close()
-
-    def write_imports(self, pfile, table):
-        pfile.write("\n// Other imports\n")
+        self.render(table).write_file(proto_fname)
+
+    def write_imports(self, out: Emitter, table):
+        out.write("\n// Other imports\n")
         line_list = []
         for col in table.columns.values():
             line = self.write_special_imports(col.udt_name)
@@ -94,16 +135,16 @@ class ProtoGen:
                     line = self.write_special_imports(rset.data_type)
                     if line not in line_list:
                         line_list.append(line)
-        [pfile.write(not_none(str(x))) for x in line_list]
+        out.write(''.join(not_none(str(x)) for x in line_list))
 
-    def write_message(self, message_name: str, pfile, table: Table, all_fields: bool = False):
+    def write_message(self, message_name: str, out: Emitter, table: Table, all_fields: bool = False):
         # message body
-        pfile.write("\nmessage " + message_name + " {\n")
+        out.write("\nmessage " + message_name + " {\n")
         # extensions
         if table.proto_extensions is not None:
-            pfile.write("  extensions " + table.proto_extensions + ";\n")
+            out.write("  extensions " + table.proto_extensions + ";\n")
         # enums
-        self.write_enums(pfile, table)
+        self.write_enums(out, table)
         # fields
         if all_fields:
             cnames = list(table.columns.values())
@@ -111,10 +152,10 @@ class ProtoGen:
             col_names = [cn.name for cn in cnames]
         else:
             col_names = table.select_list
-        self.write_fields(pfile, table, col_names)
-        pfile.write('}\n\n')
+        self.write_fields(out, table, col_names)
+        out.write('}\n\n')
 
-    def write_fields(self, pfile, table: Table, col_names: List[str]):
+    def write_fields(self, out: Emitter, table: Table, col_names: List[str]):
         field_no = 1
         for cname in col_names:
             col = table.columns[cname]
@@ -124,18 +165,12 @@ class ProtoGen:
             if col.valid_values is not None:
                 ftype = code_gen.cap_camel_case(cname)
 
-            if dtype == 'ARRAY':
-                field_type = 'repeated'
-            else:
-                if self.version == 'proto2':
-                    field_type = 'optional'
-                else:
-                    field_type = ''
-            pfile.write(f'  ' + field_type + ' ' + ftype + ' ' + cname + ' = ' + str(field_no) + ';\n')
+            field_type = 'repeated' if dtype == 'ARRAY' else self.optional
+            out.emit(FIELD, field_type=field_type, ftype=ftype, cname=cname, field_no=str(field_no))
             field_no += 1
 
     @staticmethod
-    def write_enums(pfile, table):
+    def write_enums(out: Emitter, table):
         if table.has_valid_values:
             cols = table.columns.values()
             for col in cols:
@@ -149,7 +184,7 @@ class ProtoGen:
                             v = '_' + v
                         line = line + f'    {v} = {field_no};\n'
                         field_no += 1
-                    pfile.write(line + '  }\n')
+                    out.write(line + '  }\n')
 
     @staticmethod
     def write_special_imports(udt_name: str):
@@ -158,52 +193,90 @@ class ProtoGen:
         else:
             return ''
 
-    def write_custom_proto(self, pfile, table: Table):
+    def write_custom_proto(self, out: Emitter, table: Table):
         comment = "//------------------------ Custom Queries -----------------------------\n"
-        pfile.write(comment)
+        out.write(comment)
         for qmap in table.mappings.values():
             result_set = qmap.result_set
             if len(result_set) > 0:
-                pfile.write('\nmessage ' + ''.join(word.title() for word in qmap.name.split('_')) + '{\n')
-                self.write_custom_fields(pfile, result_set)
-                pfile.write("}\n")
+                out.write('\nmessage ' + ''.join(word.title() for word in qmap.name.split('_')) + '{\n')
+                self.write_custom_fields(out, result_set)
+                out.write("}\n")
 
-    def write_custom_fields(self, pfile, result_set: List[BindVar]):
+    def write_custom_fields(self, out: Emitter, result_set: List[BindVar]):
         field_no = 1
         for rset in result_set:
             ftype = postgres_datatypes.sql_to_proto_datatype(rset.data_type)
-            if rset.data_type == 'ARRAY':
-                field_type = 'repeated'
-            else:
-                if self.version == 'proto2':
-                    field_type = 'optional'
-                else:
-                    field_type = ''
-            pfile.write(f'  ' + field_type + ' ' + ftype + ' ' + rset.name + ' = ' + str(field_no) + ';\n')
+            field_type = 'repeated' if postgres_datatypes.is_array(rset.data_type) else self.optional
+            out.emit(FIELD, field_type=field_type, ftype=ftype, cname=rset.name, field_no=str(field_no))
             field_no += 1
 
-    def compile_all(self):
+    def compile_all(self, tables: List[Table] = None) -> Dict[str, str]:
+        """Compiles the protos of each schema in one batch. Returns the compiler errors keyed by the table fqn
+        """
         print(f'\n------- Compiling Protobuffers --------\n')
-        for schema in self.database.schemas.values():
-            for table in schema.tables.values():
-                self.compile(table)
+        by_schema = {}
+        for table in self.database.get_tables(tables):
+            by_schema.setdefault(table.schema, []).append(table)
 
-    def compile(self, table: Table):
-        # protoc -I=$SRC_DIR --python_out=$DST_DIR $SRC_DIR/addressbook.proto
-        output_path = self.config.get_config()['output']['path']
-        protoc_path = self.config.get_config()['output']['protoc_path']
+        errors = {}
+        for schema_name, schema_tables in by_schema.items():
+            errors.update(self.compile_schema(schema_name, schema_tables))
+
+        for fqn, error in errors.items():
+            print(f'   Failed to compile proto for {fqn}:\n{error}')
+        return errors
 
-        src_dir = os.path.sep.join([self.path, table.schema])
-        dest_dir = os.path.sep.join([output_path, table.schema])
-        fullname = os.path.sep.join([src_dir, table.name + '.proto'])
-        print(f'{os.getcwd()} {fullname}')
+    def compile(self, table: Table) -> Dict[str, str]:
+        return self.compile_schema(table.schema, [table])
 
+    def compile_schema(self, schema_name: str, tables: List[Table]) -> Dict[str, str]:
+        # protoc -I=$SRC_DIR --python_out=$DST_DIR $SRC_DIR/a.proto $SRC_DIR/b.proto ...
+        output_path = self.config.get_config()['output']['path']
+        src_dir = os.path.sep.join([self.path, schema_name])
+        dest_dir = os.path.sep.join([output_path, schema_name])
         os.makedirs(dest_dir, exist_ok=True)
 
-        cmd = protoc_path + 'protoc -I=' + src_dir + ' --python_out=' + dest_dir + ' ' + fullname
-        print(cmd)
-        ret = os.system(cmd)
-        if ret is not 0:
-            print(f'   Failed to compile proto. Exit code: {ret}')
-            print(f'ABORTING!')
-            sys.exit()
+        fnames = {os.path.sep.join([src_dir, table.name + '.proto']): table for table in tables}
+        print(f'{os.getcwd()} {src_dir}: {len(fnames)} protos')
+        ret, output = self.run_protoc(src_dir, dest_dir, list(fnames.keys()))
+        if ret == 0:
+            return {}
+
+        # Attribute the compiler output to the files it is about. Anything else fails the whole batch.
+        errors = {}
+        unattributed = []
+        for line in output.splitlines():
+            fname = next((f for f in fnames if line.startswith(f + ':') or
+                          line.startswith(os.path.basename(f) + ':')), None)
+            if fname is None:
+                unattributed.append(line)
+            else:
+                fqn = fnames[fname].fqn
+                errors[fqn] = errors[fqn] + '\n' + line if fqn in errors else line
+        if len(errors) == 0:
+            message = '\n'.join(unattributed) if len(unattributed) > 0 else f'protoc exit code: {ret}'
+            return {table.fqn: message for table in tables}
+
+        # protoc writes nothing when any file in the batch fails, so compile the good ones again on their own
+        remaining = [table for table in tables if table.fqn not in errors]
+        if len(remaining) > 0:
+            errors.update(self.compile_schema(schema_name, remaining))
+        return errors
+
+    def run_protoc(self, src_dir: str, dest_dir: str, fnames: List[str]) -> Tuple[int, str]:
+        if grpc_protoc is not None:
+            # In process, with the well known types (google/protobuf/timestamp.proto) bundled with grpc_tools
+            args = ['grpc_tools.protoc', '-I=' + src_dir, '-I=' + GRPC_PROTO_INCLUDE, '--python_out=' + dest_dir]
+            with capture_stderr() as captured:
+                ret = grpc_protoc.main(args + fnames)
+            return ret, ''.join(captured)
+
+        protoc_path = self.config.get_config()['output']['protoc_path']
+        cmd = [os.path.join(protoc_path, 'protoc'), '-I=' + src_dir, '--python_out=' + dest_dir] + fnames
+        print(' '.join(cmd[:3]) + f' <{len(fnames)} protos>')
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True)
+        except OSError as error:
+            return 1, f'Failed to run {cmd[0]}: {error}'
+        return result.returncode, result.stdout + result.stderr
@@ -4,6 +4,8 @@ from typing import Tuple, List, Any
 
 import sqlparse
 
+from schema import Statement
+
 
 class InvalidSQLError(Exception):
     pass
@@ -107,3 +109,114 @@ def parse_query(sql: str) -> Tuple[str, List[str], List[str]]:
         return parse_delete_query(sql, parsed)
     else:
         raise InvalidSQLError(f'Invalid query. Unexpected first token: {parsed.tokens[0].value}, query: {sql}')
+
+
+def is_ident_start(c: str) -> bool:
+    return c.isalpha() or c == '_'
+
+
+def is_ident_char(c: str) -> bool:
+    return c.isalnum() or c == '_'
+
+
+def tokenize_placeholders(sql: str) -> Tuple[List[str], List[str]]:
+    """Splits the query around its $name placeholders without a full parse. String literals, quoted identifiers,
+    comments and dollar quoted strings are skipped, and a name ends at the first non identifier character, so casts
+    like $lat::float8 bind `lat`. Returns the text segments and the placeholder names, with one more segment than
+    names.
+    """
+    segments = []
+    names = []
+    start = 0
+    i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if c == "'" or c == '"':
+            # Literal or quoted identifier, a doubled quote is an escaped quote
+            i += 1
+            while i < n:
+                if sql[i] == c:
+                    if i + 1 < n and sql[i + 1] == c:
+                        i += 2
+                        continue
+                    break
+                i += 1
+            i += 1
+        elif c == '-' and sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = n if end == -1 else end + 1
+        elif c == '/' and sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+        elif c == '$' and i + 1 < n and (sql[i + 1] == '$' or is_ident_start(sql[i + 1])):
+            j = i + 1
+            while j < n and is_ident_char(sql[j]):
+                j += 1
+            if j < n and sql[j] == '$':
+                # Dollar quoted string, $$...$$ or $tag$...$tag$
+                tag = sql[i: j + 1]
+                end = sql.find(tag, j + 1)
+                i = n if end == -1 else end + len(tag)
+            else:
+                segments.append(sql[start: i])
+                names.append(sql[i + 1: j])
+                start = j
+                i = j
+        else:
+            i += 1
+    segments.append(sql[start:])
+    return segments, names
+
+
+def to_statement(sql: str) -> Statement:
+    """Converts a query with $name placeholders to psycopg %s placeholders, escaping any literal %
+    """
+    segments, names = tokenize_placeholders(sql)
+    return Statement('%s'.join(seg.replace('%', '%%') for seg in segments), names)
+
+
+def literal(sql: str) -> Statement:
+    # SQL text without any bind parameters
+    return Statement(sql.replace('%', '%%'), [])
+
+
+def bind(name: str) -> Statement:
+    return Statement('%s', [name])
+
+
+def join(separator: str, statements: List[Statement]) -> Statement:
+    out = Statement('', [])
+    for i, statement in enumerate(statements):
+        if i > 0:
+            out = out + literal(separator)
+        out = out + statement
+    return out
+
+
+def inline(statement: Statement, reference) -> Statement:
+    """Replaces every bind parameter of the statement with the SQL returned by reference(name), for example a column
+    of a staging table. The result has no bind parameters.
+    """
+    names = iter(statement.bind_params)
+    out = []
+    for part in re.split(r'(%%|%s)', statement.sql):
+        if part == '%s':
+            out.append(reference(next(names)).replace('%', '%%'))
+        else:
+            out.append(part)
+    return Statement(''.join(out), [])
+
+
+def number_placeholders(sql: str) -> Tuple[str, List[str]]:
+    """Rewrites the $name placeholders of a query as $1, $2, ... for the server. A name used more than once keeps the
+    same number. Returns the rewritten query and the names in parameter order.
+    """
+    segments, names = tokenize_placeholders(sql)
+    unique = []
+    out = segments[0]
+    for name, segment in zip(names, segments[1:]):
+        if name not in unique:
+            unique.append(name)
+        out += '$' + str(unique.index(name) + 1) + segment
+    return out, unique
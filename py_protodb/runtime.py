@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""The helpers shared by all the generated modules. Generated code imports this module as py_protodb.runtime, so it
+only depends on psycopg and protobuf.
+"""
+import functools
+import itertools
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timezone
+
+from google.protobuf import descriptor_pb2
+from psycopg.types.array import ListDumper, ListBinaryDumper
+
+try:
+    import psycopg_pool
+except ImportError:
+    psycopg_pool = None
+
+# The container protobuf uses for repeated scalar fields, which depends on the protobuf implementation in use
+RepeatedScalarContainer = type(descriptor_pb2.FileDescriptorProto().dependency)
+
+# Connections the proto adapters have been registered on, and the generated modules configure_prepare has run for on
+# each
+CONFIGURED = weakref.WeakSet()
+PREPARE_CONFIGURED = weakref.WeakKeyDictionary()
+
+# Server side cursors need a name that is unique on their connection
+CURSOR_IDS = itertools.count()
+
+# psycopg loads timestamptz as an aware datetime and timestamp as a naive one, which protobuf takes to be UTC
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+NAIVE_EPOCH = datetime(1970, 1, 1)
+
+
+def is_null(message, field_name, field):
+    if message.HasField(field_name) is True:
+        return field
+    else:
+        return None
+
+
+def not_null(message, field_name, field):
+    if message.HasField(field_name) is False:
+        raise Exception(f'Field {message.DESCRIPTOR.full_name}.{field_name} can not be null')
+    return field
+
+
+def to_datetime(param):
+    if param is not None:
+        return param.ToDatetime()
+    else:
+        return param
+
+
+def set_timestamp(ts, value):
+    """Same as ts.FromDatetime(value), with integer arithmetic on the timedelta, which is several times faster
+    """
+    delta = value - (NAIVE_EPOCH if value.tzinfo is None else EPOCH)
+    ts.seconds = delta.days * 86400 + delta.seconds
+    ts.nanos = delta.microseconds * 1000
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def write_delimited(out, message):
+    """Writes the message prefixed with its size as a varint, the framing of protobuf's writeDelimitedTo
+    """
+    data = message.SerializeToString()
+    out.write(encode_varint(len(data)))
+    out.write(data)
+
+
+def read_varint(infile):
+    """Reads a varint from the stream, None at the end of the stream
+    """
+    value = shift = 0
+    while True:
+        byte = infile.read(1)
+        if len(byte) == 0:
+            if shift == 0:
+                return None
+            raise EOFError('Stream ends inside a varint')
+        value |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            return value
+        shift += 7
+
+
+def read_delimited(infile):
+    """Yields the serialized messages of a stream written by write_delimited, or protobuf's writeDelimitedTo
+    """
+    while True:
+        size = read_varint(infile)
+        if size is None:
+            return
+        data = infile.read(size)
+        if len(data) < size:
+            raise EOFError(f'Stream ends inside a message of {size} bytes')
+        yield data
+
+
+def batched(iterable, size: int):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def reject(on_reject, ordinal: int, data: bytes, error: Exception) -> int:
+    """Reports a rejected row to the on_reject callback of import_stream, or raises the error when there is none
+    """
+    if on_reject is None:
+        raise error
+    on_reject(ordinal, data, error)
+    return 1
+
+
+def changed_fields(message, fields=None, base=None) -> set:
+    """The names of the fields update_fields writes. fields is a FieldMask or a list of names, a path into a sub message
+    stands for the whole field. Without fields, the fields of the message that differ from base.
+    """
+    if fields is not None:
+        return {path.split('.')[0] for path in getattr(fields, 'paths', fields)}
+    if base is None:
+        raise ValueError('update_fields needs either fields or base')
+    changed = set()
+    for field in message.DESCRIPTOR.fields:
+        name = field.name
+        if getattr(message, name) != getattr(base, name) or \
+                (field.has_presence and message.HasField(name) != base.HasField(name)):
+            changed.add(name)
+    return changed
+
+
+@functools.lru_cache(maxsize=1024)
+def partial_update(head: str, sets: tuple, where: str) -> str:
+    """The SQL of an update_fields statement, built once for each subset of the columns
+    """
+    return head + ', '.join(sets) + where
+
+
+class ReadCache:
+    """The read-through cache of a table's read, a bounded LRU of messages keyed by the primary key tuple. Entries
+    expire ttl seconds after they were stored. Messages are copied in and out, so callers can modify what they get.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            (expires, message) = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        out = type(message)()
+        out.CopyFrom(message)
+        return out
+
+    def put(self, key, message):
+        stored = type(message)()
+        stored.CopyFrom(message)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, stored)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+
+def configure(conn):
+    """Registers the proto adapters on a connection, once. Can be used as the configure callback of a pool.
+    """
+    if conn in CONFIGURED:
+        return
+    conn.adapters.register_dumper(RepeatedScalarContainer, ListDumper)
+    conn.adapters.register_dumper(RepeatedScalarContainer, ListBinaryDumper)
+    CONFIGURED.add(conn)
+
+
+def configure_prepare(conn, module: str, prepare, statements: int):
+    """Sizes the statement cache of a connection for a generated module. Nothing is prepared here, psycopg prepares
+    each statement when it first runs.
+    """
+    configure(conn)
+    if prepare is False:
+        # Safe behind pgbouncer in transaction pooling mode, psycopg will not prepare anything on this connection
+        conn.prepare_threshold = None
+    elif prepare is True:
+        # Make room for the module's statements so the statement cache does not evict them
+        modules = PREPARE_CONFIGURED.setdefault(conn, set())
+        if module not in modules:
+            conn.prepared_max += statements
+            modules.add(module)
+
+
+def cursor_name(prefix: str) -> str:
+    return f'{prefix}_{next(CURSOR_IDS)}'
+
+
+def is_pool(conn) -> bool:
+    return psycopg_pool is not None and isinstance(conn, psycopg_pool.ConnectionPool)
+
+
+def is_async_pool(conn) -> bool:
+    return psycopg_pool is not None and isinstance(conn, psycopg_pool.AsyncConnectionPool)
+
+
+@contextmanager
+def connection(conn):
+    """Yields a configured connection, borrowed from the pool if conn is a psycopg_pool.ConnectionPool
+    """
+    if is_pool(conn):
+        with conn.connection() as pooled:
+            configure(pooled)
+            yield pooled
+    else:
+        configure(conn)
+        yield conn
+
+
+@asynccontextmanager
+async def async_connection(conn):
+    if is_async_pool(conn):
+        async with conn.connection() as pooled:
+            configure(pooled)
+            yield pooled
+    else:
+        configure(conn)
+        yield conn
+
+
+def pooled(fun):
+    """Lets a generated function take a pool wherever it takes a connection
+    """
+    @functools.wraps(fun)
+    def wrapper(conn, *args, **kwargs):
+        with connection(conn) as c:
+            return fun(c, *args, **kwargs)
+    return wrapper
+
+
+def async_pooled(fun):
+    @functools.wraps(fun)
+    async def wrapper(conn, *args, **kwargs):
+        async with async_connection(conn) as c:
+            return await fun(c, *args, **kwargs)
+    return wrapper
+
+
+def pooled_iter(fun):
+    """Like pooled, for a generator. The connection is held until the generator is exhausted or closed.
+    """
+    @functools.wraps(fun)
+    def wrapper(conn, *args, **kwargs):
+        with connection(conn) as c:
+            yield from fun(c, *args, **kwargs)
+    return wrapper
+
+
+def async_pooled_iter(fun):
+    @functools.wraps(fun)
+    async def wrapper(conn, *args, **kwargs):
+        async with async_connection(conn) as c:
+            async for item in fun(c, *args, **kwargs):
+                yield item
+    return wrapper
@@ -6,6 +6,7 @@ from enum import Enum
 from typing import List, Dict
 
 from config import Config
+from pool import ConnectionPool
 
 __author__ = "Bryan Hughes"
 __copyright__ = "Copyright 2022, Gruvy, Inc."
@@ -43,6 +44,7 @@ class CustomQuery:
     name: str
     query: str
     result_set: List[BindVar]
+    params: List[BindVar] = None                # The $name bind parameters in order, typed by the server
 
 
 @dataclass()
@@ -58,6 +60,15 @@ class Query:
     map: str
 
 
+@dataclass()
+class Statement:
+    sql: str                                    # SQL with psycopg %s placeholders
+    bind_params: List[str]                      # The name bound to each %s, in order
+
+    def __add__(self, other):
+        return Statement(self.sql + other.sql, self.bind_params + other.bind_params)
+
+
 @dataclass()
 class Column:
     table_name: str
@@ -91,6 +102,7 @@ class Index:
     is_list: bool = False
     is_lookup: bool = False
     comment: str = None
+    is_partial: bool = False                    # Has a WHERE predicate or an expression column
 
 
 @dataclass()
@@ -138,6 +150,8 @@ class Table:
     has_version: bool = False
     version_column: str = None
     proto_extensions: str = None
+    cache_size: int = None                      # The read cache of the table, when enabled with generator.caches
+    cache_ttl: float = None
 
     @property
     def fqn(self):
@@ -151,19 +165,26 @@ class Schema:
     columns: Dict[str, Column] = None               # Keyed by table_name.column_name
     indexes: Dict[str, Index] = None                # Keyed by index_name
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, pool: ConnectionPool):
         self.config = config
-        self.conn = self.connect()
+        self.pool = pool
 
-    def connect(self):
+    def execute_query(self, query: str, params: tuple):
         pass
 
-    def execute_query(self, query: str, params: tuple):
+    def describe_query(self, query: str):
         pass
 
     def get_column_datatype(self, oid):
         pass
 
+    def __getstate__(self):
+        # The connection pool and type map stay behind when the model is sent to another process
+        state = self.__dict__.copy()
+        state.pop('pool', None)
+        state.pop('types', None)
+        return state
+
     def get_table(self, name: str):
         return self.tables[name]
 
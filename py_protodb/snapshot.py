@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""Persists the database model between runs, keyed by a fingerprint of the catalog and the generator config
+"""
+import hashlib
+import json
+import os
+from dataclasses import asdict
+from enum import Enum
+from typing import Dict, List
+
+from config import Config
+from pool import ConnectionPool
+from schema import Table, Column, Index, IndexType, ForeignRel, ForeignColumn, CustomQuery, BindVar, Query
+
+SNAPSHOT_VERSION = 2
+
+# Any DDL against a table rewrites its pg_class, pg_attribute, pg_constraint, pg_attrdef or pg_description rows, which
+# gives those rows a new xmin. Hashing the oid and xmin of every row that belongs to the configured schemas is cheap
+# and changes whenever the model read from them could have changed. The result types of the custom mappings are
+# resolved through pg_type, so every type and domain outside the temporary schemas is hashed the same way.
+CATALOG_FINGERPRINT = """SELECT
+        md5(COALESCE(string_agg(entry, ',' ORDER BY entry), ''))
+    FROM (
+        SELECT
+            'c' || c.oid::text || ':' || c.xmin::text AS entry
+        FROM
+            pg_class c
+            JOIN pg_namespace ns ON ns.oid = c.relnamespace
+        WHERE
+            ns.nspname = ANY(%(schemas)s)
+        UNION ALL
+        SELECT
+            'a' || a.attrelid::text || '.' || a.attnum::text || ':' || a.xmin::text
+        FROM
+            pg_attribute a
+            JOIN pg_class c ON c.oid = a.attrelid
+            JOIN pg_namespace ns ON ns.oid = c.relnamespace
+        WHERE
+            ns.nspname = ANY(%(schemas)s)
+            AND a.attnum > 0
+        UNION ALL
+        SELECT
+            'k' || con.oid::text || ':' || con.xmin::text
+        FROM
+            pg_constraint con
+            JOIN pg_namespace ns ON ns.oid = con.connamespace
+        WHERE
+            ns.nspname = ANY(%(schemas)s)
+        UNION ALL
+        SELECT
+            'd' || ad.oid::text || ':' || ad.xmin::text
+        FROM
+            pg_attrdef ad
+            JOIN pg_class c ON c.oid = ad.adrelid
+            JOIN pg_namespace ns ON ns.oid = c.relnamespace
+        WHERE
+            ns.nspname = ANY(%(schemas)s)
+        UNION ALL
+        SELECT
+            'o' || d.objoid::text || '.' || d.objsubid::text || ':' || d.xmin::text
+        FROM
+            pg_description d
+            JOIN pg_class c ON c.oid = d.objoid AND d.classoid = 'pg_class'::regclass
+            JOIN pg_namespace ns ON ns.oid = c.relnamespace
+        WHERE
+            ns.nspname = ANY(%(schemas)s)
+        UNION ALL
+        SELECT
+            't' || t.oid::text || ':' || t.xmin::text
+        FROM
+            pg_type t
+            JOIN pg_namespace ns ON ns.oid = t.typnamespace
+        WHERE
+            ns.nspname NOT LIKE 'pg\\_temp\\_%%'
+            AND ns.nspname NOT LIKE 'pg\\_toast\\_temp\\_%%'
+    ) entries"""
+
+
+def to_json(obj, **kwargs):
+    return json.dumps(obj, default=lambda o: o.value if isinstance(o, Enum) else str(o), **kwargs)
+
+
+def dump_table(table: Table) -> dict:
+    return asdict(table)
+
+
+def load_table(d: dict) -> Table:
+    d = dict(d)
+    d['columns'] = {k: Column(**v) for k, v in d['columns'].items()}
+    d['indexes'] = {k: load_index(v) for k, v in d['indexes'].items()}
+    d['relations'] = [load_relation(r) for r in d['relations']]
+    d['mappings'] = {k: load_custom_query(v) for k, v in d['mappings'].items()}
+    d['query_dict'] = {k: Query(**v) for k, v in d['query_dict'].items()}
+    return Table(**d)
+
+
+def load_index(d: dict) -> Index:
+    d = dict(d)
+    d['type'] = IndexType(d['type'])
+    return Index(**d)
+
+
+def load_relation(d: dict) -> ForeignRel:
+    d = dict(d)
+    d['foreign_columns'] = [ForeignColumn(**fc) for fc in d['foreign_columns']]
+    return ForeignRel(**d)
+
+
+def load_custom_query(d: dict) -> CustomQuery:
+    d = dict(d)
+    d['result_set'] = [BindVar(**b) for b in d['result_set']]
+    if d.get('params') is not None:
+        d['params'] = [BindVar(**b) for b in d['params']]
+    return CustomQuery(**d)
+
+
+class Snapshot:
+    def __init__(self, config: Config):
+        self.config = config
+        self.filename = self.config.get_config()['generator'].get('snapshot')
+
+    @property
+    def enabled(self) -> bool:
+        return self.filename is not None and self.filename != ''
+
+    def config_hash(self) -> str:
+        # The model depends on the generator config (exclusions, mappings, transforms, ...) as much as the catalog
+        database = self.config.get_config()['database']
+        key = {
+            'database': [database['host'], database['port'], database['database'], database['user']],
+            'generator': self.config.get_config()['generator']
+        }
+        return hashlib.sha256(to_json(key, sort_keys=True).encode()).hexdigest()
+
+    def fingerprint(self, pool: ConnectionPool, schema_names: List[str]) -> str:
+        with pool.connection() as conn:
+            cur = conn.execute(CATALOG_FINGERPRINT, {'schemas': list(schema_names)})
+            (catalog_hash, ) = cur.fetchone()
+            cur.close()
+        return hashlib.sha256(f'{SNAPSHOT_VERSION}:{catalog_hash}:{self.config_hash()}'.encode()).hexdigest()
+
+    def load(self, fingerprint: str) -> Dict[str, Dict[str, Table]]:
+        """Returns the tables of each schema keyed by schema name, or None if there is no snapshot for the fingerprint
+        """
+        if not os.path.exists(self.filename):
+            return None
+        try:
+            with open(self.filename, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as error:
+            print(f'    WARNING: Ignoring unreadable snapshot {self.filename}: {error}')
+            return None
+
+        if snapshot.get('fingerprint') != fingerprint:
+            return None
+        return {name: {tn: load_table(t) for tn, t in tables.items()} for name, tables in snapshot['schemas'].items()}
+
+    def save(self, fingerprint: str, schemas: Dict):
+        snapshot = {
+            'fingerprint': fingerprint,
+            'schemas': {name: {tn: dump_table(t) for tn, t in (schema.tables or {}).items()}
+                        for name, schema in schemas.items()}
+        }
+        path = os.path.dirname(self.filename)
+        if path != '' and not os.path.exists(path):
+            os.makedirs(path)
+
+        # Write and rename so an interrupted run never leaves a truncated snapshot behind
+        tmp_fname = self.filename + '.tmp'
+        with open(tmp_fname, 'w') as f:
+            f.write(to_json(snapshot))
+        os.replace(tmp_fname, self.filename)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""Opt-in benchmarks of the code generator and of the code it generates, they are not part of the unit tests. Run
+as a module of the tests package, from this directory with the repository and py_protodb on the path:
+
+    PYTHONPATH=..:../py_protodb python -m tests.benchmark
+"""
+import importlib
+import os
+import sys
+import tempfile
+import time
+
+from code_gen import CodeGen
+from config import Config
+from database import Database
+from proto_gen import ProtoGen
+from .fakes import FakeSchema, wide_row, wide_table
+
+BENCH_TABLES = 50
+BENCH_COLUMNS = 200
+BENCH_ROWS = 10000
+
+
+def bench_wide_schema():
+    # Renders the protos and both modules of a synthetic wide schema
+    config = Config('py-protodb.yaml')
+    database = Database.__new__(Database)
+    database.config = config
+    database.schemas = {'public': FakeSchema({f't{i}': wide_table(f't{i}', BENCH_COLUMNS)
+                                              for i in range(BENCH_TABLES)})}
+    tables = database.get_tables()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config.get_config()['output']['path'] = os.path.join(tmpdir, 'out')
+        config.get_config()['proto']['path'] = os.path.join(tmpdir, 'proto')
+        proto = ProtoGen(config, database)
+        codegen = CodeGen(config, database)
+        start = time.perf_counter()
+        for table in tables:
+            proto.render(table).getvalue()
+            ctx = codegen.build_context(table)
+            codegen.render(ctx).getvalue()
+            codegen.render_async(ctx).getvalue()
+        elapsed = time.perf_counter() - start
+    print(f'{len(tables)} tables x {BENCH_COLUMNS} columns: {len(tables) / elapsed:.1f} tables/sec')
+
+
+def bench_decode():
+    # Decodes rows of a wide table with the row factory of its generated module
+    config = Config('py-protodb.yaml')
+    database = Database.__new__(Database)
+    database.config = config
+    database.schemas = {'public': FakeSchema({'wide': wide_table('wide', BENCH_COLUMNS)})}
+    tables = database.get_tables()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config.get_config()['output']['path'] = tmpdir
+        config.get_config()['proto']['path'] = os.path.join(tmpdir, 'proto')
+        proto = ProtoGen(config, database)
+        proto.generate_protos(tables)
+        if len(proto.compile_all(tables)) > 0:
+            raise RuntimeError('Failed to compile the protos')
+        CodeGen(config, database).generate_code(tables)
+        sys.path.insert(0, tmpdir)
+        try:
+            make_row = importlib.import_module('public.wide_db').row_factory(None)
+        finally:
+            sys.path.remove(tmpdir)
+
+        rows = [wide_row(tables[0], i) for i in range(BENCH_ROWS)]
+        start = time.perf_counter()
+        for row in rows:
+            make_row(row)
+        elapsed = time.perf_counter() - start
+    print(f'{BENCH_COLUMNS + 1} columns: {BENCH_ROWS / elapsed:.0f} rows/sec decoded')
+
+
+if __name__ == '__main__':
+    bench_wide_schema()
+    bench_decode()
@@ -0,0 +1,51 @@
+"""Stand-ins for the database model that let the generator run without a database"""
+import datetime
+import uuid
+from collections import OrderedDict
+
+from schema import Table, Column
+
+
+class FakeSchema:
+    def __init__(self, tables):
+        self.tables = tables
+
+
+def wide_table(name: str, ncols: int) -> Table:
+    table = Table('public', name, OrderedDict(), {}, [], {}, {}, '', [], [], [], [], [])
+    table.columns['id'] = Column(name, 'public', 'id', 'bigint', 'bigint', None, '', 1, False, True, True)
+    table.pkey_list.append('id')
+    table.sequence = 'id'
+    table.select_list.append('id')
+    types = [('character varying', 'character varying'), ('integer', 'integer'),
+             ('timestamp without time zone', 'timestamp without time zone'), ('ARRAY', 'integer[]'),
+             ('uuid', 'uuid'), ('boolean', 'boolean')]
+    for i in range(ncols):
+        data_type, udt_name = types[i % len(types)]
+        col = Column(name, 'public', f'col_{i}', data_type, udt_name, None, '', i + 2, i % 2 == 0)
+        table.columns[col.name] = col
+        table.select_list.append(col.name)
+        table.insert_list.append(col.name)
+        table.update_list.append(col.name)
+    return table
+
+
+def wide_row(table, i: int) -> list:
+    # The values psycopg loads for the columns of wide_table, with every other nullable column NULL
+    values = []
+    for col in table.columns.values():
+        if col.is_nullable and i % 2 == 0:
+            values.append(None)
+        elif col.udt_name == 'character varying':
+            values.append(f'value {i}')
+        elif col.udt_name.startswith('timestamp'):
+            values.append(datetime.datetime(2022, 1, 1, 12, 30, 15, 250) + datetime.timedelta(seconds=i))
+        elif col.udt_name == 'integer[]':
+            values.append([i, i + 1])
+        elif col.udt_name == 'uuid':
+            values.append(uuid.uuid4())
+        elif col.udt_name == 'boolean':
+            values.append(True)
+        else:
+            values.append(i)
+    return values
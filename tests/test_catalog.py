@@ -0,0 +1,56 @@
+import unittest
+
+from config import Config
+from pool import ConnectionPool
+from postgres import Postgres
+
+
+class CatalogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config('py-protodb.yaml')
+        self.schema_names = self.config.get_config()['generator']['schemas']
+        self.pool = ConnectionPool(self.config)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def read_schema(self, name: str, introspection: str):
+        self.config.get_config()['generator']['introspection'] = introspection
+        return Postgres(name, self.config, self.pool)
+
+    def test_catalog_matches_per_table(self):
+        for name in self.schema_names:
+            per_table = self.read_schema(name, 'per_table')
+            catalog = self.read_schema(name, 'catalog')
+            self.assertEqual(list(per_table.tables.keys()), list(catalog.tables.keys()))
+            for tname in per_table.tables:
+                self.assertEqual(per_table.tables[tname], catalog.tables[tname], f'{name}.{tname}')
+            self.assertEqual(per_table.columns, catalog.columns)
+            self.assertEqual(per_table.indexes, catalog.indexes)
+
+    def test_catalog_matches_per_table_corner_cases(self):
+        # A generated column, and a foreign key whose columns are not in the order of the key they reference
+        with self.pool.connection() as conn:
+            conn.execute('DROP SCHEMA IF EXISTS catalog_test CASCADE')
+            conn.execute('CREATE SCHEMA catalog_test')
+            conn.execute('CREATE TABLE catalog_test.parent (a integer, b integer, PRIMARY KEY (a, b))')
+            conn.execute('CREATE TABLE catalog_test.child (id integer PRIMARY KEY, x integer, y integer, '
+                         'total integer GENERATED ALWAYS AS (x + y) STORED, '
+                         'FOREIGN KEY (y, x) REFERENCES catalog_test.parent (b, a))')
+            conn.commit()
+        try:
+            per_table = self.read_schema('catalog_test', 'per_table')
+            catalog = self.read_schema('catalog_test', 'catalog')
+            self.assertEqual(per_table.tables, catalog.tables)
+            self.assertIsNone(catalog.tables['child'].columns['total'].default)
+            self.assertEqual([('a', 'x', 1), ('b', 'y', 2)],
+                             [(fc.foreign_name, fc.local_name, fc.ordinal_position)
+                              for fc in catalog.tables['child'].relations[0].foreign_columns])
+        finally:
+            with self.pool.connection() as conn:
+                conn.execute('DROP SCHEMA catalog_test CASCADE')
+                conn.commit()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
+import contextlib
+import io
+import re
 import unittest
 
 from code_gen import CodeGen
 from config import Config
 from database import Database
+from schema import BindVar, CustomQuery, Index, IndexType
+from .fakes import FakeSchema, wide_table
 
 
 class CodeGenTestCase(unittest.TestCase):
@@ -15,5 +20,29 @@ class CodeGenTestCase(unittest.TestCase):
         codegen.generate_code()
 
 
+class ConfigurePrepareTestCase(unittest.TestCase):
+    def prepared_count(self, table) -> int:
+        database = Database.__new__(Database)
+        database.config = Config('py-protodb.yaml')
+        database.schemas = {'public': FakeSchema({table.name: table})}
+        codegen = CodeGen(database.config, database)
+        with contextlib.redirect_stdout(io.StringIO()):
+            source = codegen.render(codegen.build_context(table)).getvalue()
+        return int(re.search(r'configure_prepare\(conn, __name__, PREPARE, (\d+)\)', source).group(1))
+
+    def test_cursor_statements_not_counted(self):
+        # The list, lookup stream and mapping stream statements run on server side cursors, which never prepare
+        table = wide_table('user', 3)
+        count = self.prepared_count(table)
+        table.indexes['list_by_col_1'] = Index('user', 'public', 'list_by_col_1', IndexType.NON_UNIQUE, ['col_1'],
+                                               True)
+        table.indexes['lookup_by_col_1'] = Index('user', 'public', 'lookup_by_col_1', IndexType.NON_UNIQUE,
+                                                 ['col_1'], False, True)
+        table.mappings['get_names'] = CustomQuery('get_names', 'select col_0 from public.user where col_1 = $col_1',
+                                                  [BindVar('col_0', 'character varying')],
+                                                  [BindVar('col_1', 'integer')])
+        self.assertEqual(count, self.prepared_count(table))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+
+from config import InvalidConfigError
+from database import Database
+from schema import CustomQuery, BindVar, Index, IndexType
+from .fakes import FakeSchema, wide_table
+
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = wide_table('user', 3)
+        self.table.indexes['list_by_name'] = Index('user', 'public', 'list_by_name', IndexType.NON_UNIQUE, ['col_0'],
+                                                   True)
+        self.table.mappings['get_token'] = CustomQuery('get_token', 'select 1', [BindVar('token', 'uuid')])
+        self.schema = FakeSchema({'user': self.table, 'get_name': wide_table('get_name', 1)})
+        self.schema.name = 'public'
+
+    def test_mapping_names(self):
+        Database.check_mapping_name(self.schema, self.table, 'list_by_user_type')
+        for name in ['list by type', 'class', 'get_token', 'list_by_name', 'list_by_name_key', 'read_many', 'cache',
+                     'user', 'set_get_token', 'get_name']:
+            with self.assertRaises(InvalidConfigError, msg=name):
+                Database.check_mapping_name(self.schema, self.table, name)
+
+    def test_mapping_columns(self):
+        Database.check_mapping_columns(self.table, CustomQuery('m', 'select 1', [BindVar('lat', 'numeric')],
+                                                               [BindVar('userId', 'bigint')]))
+        for (columns, params) in [(['?column?'], []), (['lat', 'lat'], []), (['out'], []), (['user_pb2'], []),
+                                  ([], ['conn']), ([], ['class'])]:
+            with self.assertRaises(InvalidConfigError, msg=str((columns, params))):
+                Database.check_mapping_columns(self.table, CustomQuery('m', 'select 1',
+                                                                       [BindVar(c, 'int4') for c in columns],
+                                                                       [BindVar(p, 'int4') for p in params]))
+
+    def test_insert_many_order(self):
+        queries = Database.__new__(Database).build_insert_many_sql(self.table)
+        self.assertIn("id bigint DEFAULT nextval(pg_get_serial_sequence('public.user', 'id')::regclass)",
+                      queries['INSERT_MANY_STAGING'].sql)
+        self.assertNotIn('id', queries['INSERT_MANY_COPY'].sql.split('(')[1])
+        self.assertTrue(queries['INSERT_MANY'].sql.endswith(' ON ins._key_0 = s.id ORDER BY s._ordinal'))
+
+    def test_conflict_columns(self):
+        self.assertIsNone(Database.build_conflict_columns(self.table))
+        self.table.indexes['a_partial'] = Index('user', 'public', 'a_partial', IndexType.UNIQUE, ['col_1'],
+                                                is_partial=True)
+        self.assertIsNone(Database.build_conflict_columns(self.table))
+        self.table.indexes['b_unique'] = Index('user', 'public', 'b_unique', IndexType.UNIQUE, ['col_2'])
+        self.assertEqual(['col_2'], Database.build_conflict_columns(self.table))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,26 @@
+import os
+import tempfile
+import unittest
+
+from emitter import Emitter, Template
+
+
+class EmitterTestCase(unittest.TestCase):
+    def test_render(self):
+        template = Template('${a} = ${b}(${a})\n')
+        self.assertEqual('x = int(x)\n', template.render({'a': 'x', 'b': 'int'}))
+        self.assertEqual('no fields', Template('no fields').render({}))
+
+    def test_write_file(self):
+        out = Emitter()
+        out.emit(Template('${greeting}, '), greeting='hello')
+        out.write('world\n')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = os.path.join(tmpdir, 'hello.txt')
+            out.write_file(fname)
+            with open(fname) as f:
+                self.assertEqual('hello, world\n', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import os
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from config import Config
+from manifest import Manifest
+from schema import Table, Column
+
+
+class FakeDatabase:
+    def __init__(self, tables):
+        self.tables = tables
+
+    def get_tables(self, tables=None):
+        return self.tables if tables is None else tables
+
+
+class ManifestTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config('py-protodb.yaml')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config.get_config()['output']['path'] = os.path.join(self.tmpdir.name, 'out')
+        self.config.get_config()['proto']['path'] = os.path.join(self.tmpdir.name, 'proto')
+        self.table = Table('public', 'foo', OrderedDict(), {}, [], {}, {}, '', [], [], [], [], [])
+        self.table.columns['bar'] = Column('foo', 'public', 'bar', 'character varying', 'character varying', None,
+                                           '', 1, False, False, True)
+        self.database = FakeDatabase([self.table])
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def touch_outputs(self, manifest):
+        for fname in manifest.output_files(self.table):
+            os.makedirs(os.path.dirname(fname), exist_ok=True)
+            open(fname, 'w').close()
+
+    def test_unchanged_table_is_skipped(self):
+        manifest = Manifest(self.config, self.database)
+        self.assertEqual([self.table], manifest.changed_tables())
+        self.touch_outputs(manifest)
+        manifest.update([self.table])
+        manifest.save()
+
+        manifest = Manifest(self.config, self.database)
+        self.assertEqual([], manifest.changed_tables())
+
+    def test_model_change_is_detected(self):
+        manifest = Manifest(self.config, self.database)
+        self.touch_outputs(manifest)
+        manifest.update([self.table])
+        self.table.columns['bar'].select_xform = 'upper(bar)'
+        self.assertEqual([self.table], manifest.changed_tables())
+
+    def test_missing_output_is_regenerated(self):
+        manifest = Manifest(self.config, self.database)
+        self.touch_outputs(manifest)
+        manifest.update([self.table])
+        os.remove(manifest.output_files(self.table)[2])
+        self.assertEqual([self.table], manifest.changed_tables())
+
+
+if __name__ == '__main__':
+    unittest.main()
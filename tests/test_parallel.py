@@ -0,0 +1,52 @@
+import filecmp
+import os
+import tempfile
+import unittest
+
+import parallel
+from code_gen import CodeGen
+from config import Config
+from database import Database
+from proto_gen import ProtoGen
+
+
+class ParallelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config('py-protodb.yaml')
+        self.database = Database(self.config)
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def generators(self, name):
+        self.config.get_config()['output']['path'] = os.path.join(self.tmpdir.name, name)
+        self.config.get_config()['proto']['path'] = os.path.join(self.tmpdir.name, name, 'proto')
+        return ProtoGen(self.config, self.database), CodeGen(self.config, self.database)
+
+    def assert_same_tree(self, left, right):
+        cmp = filecmp.dircmp(left, right)
+        self.assertEqual([], cmp.left_only + cmp.right_only)
+        (_match, mismatch, errors) = filecmp.cmpfiles(left, right, cmp.common_files, shallow=False)
+        self.assertEqual([], mismatch + errors)
+        for sub in cmp.common_dirs:
+            self.assert_same_tree(os.path.join(left, sub), os.path.join(right, sub))
+
+    def test_parallel_matches_serial(self):
+        tables = self.database.get_tables()
+        proto, codegen = self.generators('serial')
+        proto.generate_protos(tables)
+        serial_errors = proto.compile_all(tables)
+        codegen.generate_code(tables)
+
+        parallel_proto, parallel_codegen = self.generators('parallel')
+        parallel_proto.generated_on = proto.generated_on
+        parallel_codegen.generated_on = codegen.generated_on
+        parallel_errors = parallel.generate(parallel_proto, parallel_codegen, tables, 4)
+
+        self.assertEqual(serial_errors, parallel_errors)
+        self.assert_same_tree(os.path.join(self.tmpdir.name, 'serial'), os.path.join(self.tmpdir.name, 'parallel'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,15 @@ class PostgresTestCase(unittest.TestCase):
     def test_read_schema():
         print('hello')
 
+    def test_read_schema_concurrently(self):
+        self.config.get_config()['database']['pool_size'] = 1
+        serial = Database(self.config)
+        self.config.get_config()['database']['pool_size'] = 8
+        concurrent = Database(self.config)
+        self.assertEqual(list(serial.schemas.keys()), list(concurrent.schemas.keys()))
+        for name in serial.schemas:
+            self.assertEqual(serial.schemas[name].tables, concurrent.schemas[name].tables)
+
 
 if __name__ == '__main__':
     unittest.main()
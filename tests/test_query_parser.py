@@ -0,0 +1,38 @@
+import unittest
+
+import query_parser
+from schema import Statement
+
+
+class QueryParserTestCase(unittest.TestCase):
+    def test_placeholders(self):
+        segments, names = query_parser.tokenize_placeholders('SELECT a FROM t WHERE b = $b AND c = $c')
+        self.assertEqual(['b', 'c'], names)
+        self.assertEqual(['SELECT a FROM t WHERE b = ', ' AND c = ', ''], segments)
+
+    def test_skips_literals_and_comments(self):
+        sql = "SELECT 'it''s $no', \"$no\", $$ $no $$, $q$ $no $q$ FROM t -- $no\nWHERE a = $a /* $no */"
+        _segments, names = query_parser.tokenize_placeholders(sql)
+        self.assertEqual(['a'], names)
+
+    def test_casts(self):
+        statement = query_parser.to_statement('ST_POINT($lon::float8, $lat)::geography')
+        self.assertEqual(Statement('ST_POINT(%s::float8, %s)::geography', ['lon', 'lat']), statement)
+
+    def test_escapes_percent(self):
+        statement = query_parser.to_statement("SELECT a FROM t WHERE b LIKE '5%' AND c = $c")
+        self.assertEqual("SELECT a FROM t WHERE b LIKE '5%%' AND c = %s", statement.sql)
+
+    def test_number_placeholders(self):
+        sql, names = query_parser.number_placeholders('SELECT a FROM t WHERE b = $lon AND c = $lat OR d = $lon')
+        self.assertEqual('SELECT a FROM t WHERE b = $1 AND c = $2 OR d = $1', sql)
+        self.assertEqual(['lon', 'lat'], names)
+
+    def test_inline(self):
+        statement = query_parser.to_statement("ST_POINT($lon, $lat)::geography || '5%'")
+        inlined = query_parser.inline(statement, lambda name: 's.' + name)
+        self.assertEqual(Statement("ST_POINT(s.lon, s.lat)::geography || '5%%'", []), inlined)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import importlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from contextlib import contextmanager
+
+import runtime
+from code_gen import CodeGen
+from config import Config
+from database import Database
+from proto_gen import ProtoGen
+from .fakes import FakeSchema, wide_row, wide_table
+
+BENCH_COLUMNS = 200
+
+
+class FakeCopyConnection:
+    """Just enough of a psycopg connection for import_stream, keeps the rows of the committed COPYs"""
+    def __init__(self, refuse):
+        self.adapters = self
+        self.refuse = refuse
+        self.rows = []
+        self.pending = None
+
+    def register_dumper(self, cls, dumper):
+        pass
+
+    @contextmanager
+    def transaction(self):
+        self.pending = []
+        yield
+        self.rows.extend(self.pending)
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    @contextmanager
+    def copy(self, statement):
+        yield self
+
+    def set_types(self, types):
+        pass
+
+    def write_row(self, row):
+        if self.refuse(row):
+            raise ValueError('refused')
+        self.pending.append(row)
+
+
+class FakeUpdateConnection:
+    """Just enough of a psycopg connection for update_fields, keeps the statements it executes"""
+    def __init__(self):
+        self.adapters = self
+        self.executed = []
+
+    def register_dumper(self, cls, dumper):
+        pass
+
+    def cursor(self, row_factory):
+        return self
+
+    def execute(self, query, params, prepare=None):
+        self.executed.append((query, params))
+
+    def fetchone(self):
+        return None
+
+
+class FakeExportConnection:
+    """Just enough of a psycopg connection for export_stream, keeps the parameters of each statement"""
+    def __init__(self, rows):
+        self.adapters = self
+        self.rows_out = rows
+        self.params = []
+        self.description = []
+
+    def register_dumper(self, cls, dumper):
+        pass
+
+    @contextmanager
+    def cursor(self):
+        yield self
+
+    def execute(self, query, params):
+        self.params.append(params)
+
+    @contextmanager
+    def copy(self, statement, params):
+        self.params.append(params)
+        yield self
+
+    def set_types(self, types):
+        pass
+
+    def rows(self):
+        return iter(self.rows_out)
+
+
+class RowFactoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        config = Config('py-protodb.yaml')
+        config.get_config()['output']['path'] = self.tmpdir.name
+        config.get_config()['proto']['path'] = os.path.join(self.tmpdir.name, 'proto')
+        database = Database.__new__(Database)
+        database.config = config
+        database.schemas = {'public': FakeSchema({'wide': wide_table('wide', BENCH_COLUMNS)})}
+        tables = database.get_tables()
+        proto = ProtoGen(config, database)
+        proto.generate_protos(tables)
+        self.assertEqual({}, proto.compile_all(tables))
+        CodeGen(config, database).generate_code(tables)
+
+        sys.path.insert(0, self.tmpdir.name)
+        self.table = tables[0]
+        self.module = importlib.import_module('public.wide_db')
+
+    def tearDown(self):
+        sys.path.remove(self.tmpdir.name)
+        for name in [name for name in sys.modules if name.startswith('public')]:
+            del sys.modules[name]
+        self.tmpdir.cleanup()
+
+    def test_make_row(self):
+        values = wide_row(self.table, 1)
+        proto = self.module.row_factory(None)(values)
+        self.assertEqual(1, proto.id)
+        self.assertEqual('value 1', proto.col_0)
+        self.assertEqual(values[3], proto.col_2.ToDatetime())
+        self.assertEqual([1, 2], proto.col_3)
+        self.assertEqual(str(values[5]), proto.col_4)
+
+        self.assertFalse(self.module.make_row(wide_row(self.table, 2)).HasField('col_0'))
+
+        tag, proto = self.module.tagged_row_factory(None)([7] + values)
+        self.assertEqual((7, 1), (tag, proto.id))
+
+    def test_import_stream(self):
+        infile = io.BytesIO()
+        for i in range(25):
+            proto = self.module.make_row(wide_row(self.table, i))
+            if i == 7:
+                proto.ClearField('col_1')
+            runtime.write_delimited(infile, proto)
+        infile.seek(0)
+
+        conn = FakeCopyConnection(lambda row: row[1] == 12)
+        progress, rejects = [], []
+        imported, rejected = self.module.import_stream(conn, infile, batch_size=10,
+                                                       progress=lambda *counts: progress.append(counts),
+                                                       on_reject=lambda ordinal, data, error: rejects.append(ordinal))
+        self.assertEqual((23, 2), (imported, rejected))
+        self.assertEqual([7, 12], rejects)
+        self.assertEqual([(9, 1), (18, 2), (23, 2)], progress)
+        self.assertEqual([i for i in range(25) if i not in (7, 12)], [row[1] for row in conn.rows])
+
+        infile.seek(0)
+        with self.assertRaises(Exception):
+            self.module.import_stream(FakeCopyConnection(lambda row: False), infile)
+
+    def test_update_fields(self):
+        base = self.module.make_row(wide_row(self.table, 1))
+        proto = self.module.Wide()
+        proto.CopyFrom(base)
+        conn = FakeUpdateConnection()
+        self.assertIs(proto, self.module.update_fields(conn, proto, base=base))
+        self.assertEqual([], conn.executed)
+
+        proto.col_0 = 'changed'
+        proto.ClearField('col_2')
+        self.module.update_fields(conn, proto, base=base)
+        self.module.update_fields(conn, proto, fields=['col_2', 'col_0'])
+        self.assertEqual([('UPDATE public.wide SET col_0 = %s, col_2 = %s WHERE id = %s', ['changed', None, 1])] * 2,
+                         [(query.split(' RETURNING ')[0], params) for (query, params) in conn.executed])
+
+    def test_export_stream_params(self):
+        # Without params psycopg would send the %% escapes of the statement to the server as they are
+        conn = FakeExportConnection([wide_row(self.table, i) for i in range(3)])
+        out = io.BytesIO()
+        self.assertEqual(3, self.module.export_stream(conn, out))
+        self.assertEqual([(), ()], conn.params)
+        out.seek(0)
+        self.assertEqual([0, 1, 2], [self.module.Wide.FromString(data).id for data in runtime.read_delimited(out)])
+
+
+if __name__ == '__main__':
+    unittest.main()
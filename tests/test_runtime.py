@@ -0,0 +1,141 @@
+import datetime
+import io
+import time
+import unittest
+
+from google.protobuf import descriptor_pb2, field_mask_pb2, timestamp_pb2
+from google.protobuf.internal import decoder
+
+import runtime
+
+
+class RuntimeTestCase(unittest.TestCase):
+    def test_null_checks(self):
+        message = descriptor_pb2.FileDescriptorProto()
+        self.assertIsNone(runtime.is_null(message, 'name', message.name))
+        with self.assertRaises(Exception):
+            runtime.not_null(message, 'name', message.name)
+        message.name = 'foo'
+        self.assertEqual('foo', runtime.is_null(message, 'name', message.name))
+        self.assertEqual('foo', runtime.not_null(message, 'name', message.name))
+
+    def test_to_datetime(self):
+        ts = timestamp_pb2.Timestamp()
+        ts.FromDatetime(datetime.datetime(2022, 1, 1))
+        self.assertEqual(datetime.datetime(2022, 1, 1), runtime.to_datetime(ts))
+        self.assertIsNone(runtime.to_datetime(None))
+
+    def test_set_timestamp(self):
+        for value in [datetime.datetime(2022, 1, 1, 3, 4, 5, 123456),
+                      datetime.datetime(1901, 1, 1, 3, 4, 5, 123456, tzinfo=datetime.timezone.utc),
+                      datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone(datetime.timedelta(hours=-5)))]:
+            expected, ts = timestamp_pb2.Timestamp(), timestamp_pb2.Timestamp()
+            expected.FromDatetime(value)
+            runtime.set_timestamp(ts, value)
+            self.assertEqual(expected, ts)
+
+    def test_write_delimited(self):
+        for value in [0, 1, 127, 128, 300, 2 ** 35]:
+            self.assertEqual((value, len(runtime.encode_varint(value))),
+                             decoder._DecodeVarint(runtime.encode_varint(value), 0))
+
+        out = io.BytesIO()
+        names = ['', 'foo', 'x' * 1000]
+        for name in names:
+            runtime.write_delimited(out, descriptor_pb2.FileDescriptorProto(name=name))
+        data, pos, found = out.getvalue(), 0, []
+        while pos < len(data):
+            size, pos = decoder._DecodeVarint(data, pos)
+            found.append(descriptor_pb2.FileDescriptorProto.FromString(data[pos:pos + size]).name)
+            pos += size
+        self.assertEqual(names, found)
+
+    def test_read_delimited(self):
+        out = io.BytesIO()
+        names = ['', 'foo', 'x' * 1000]
+        for name in names:
+            runtime.write_delimited(out, descriptor_pb2.FileDescriptorProto(name=name))
+        data = out.getvalue()
+        found = [descriptor_pb2.FileDescriptorProto.FromString(m).name
+                 for m in runtime.read_delimited(io.BytesIO(data))]
+        self.assertEqual(names, found)
+        with self.assertRaises(EOFError):
+            list(runtime.read_delimited(io.BytesIO(data[:-1])))
+
+    def test_batched(self):
+        self.assertEqual([[0, 1], [2, 3], [4]], list(runtime.batched(range(5), 2)))
+        self.assertEqual([], list(runtime.batched([], 2)))
+
+    def test_reject(self):
+        rejects = []
+        self.assertEqual(1, runtime.reject(lambda *args: rejects.append(args), 3, b'', ValueError('bad')))
+        self.assertEqual([3], [r[0] for r in rejects])
+        with self.assertRaises(ValueError):
+            runtime.reject(None, 3, b'', ValueError('bad'))
+
+    def test_changed_fields(self):
+        mask = field_mask_pb2.FieldMask(paths=['name', 'options.java_package'])
+        self.assertEqual({'name', 'options'}, runtime.changed_fields(None, mask))
+        self.assertEqual({'name'}, runtime.changed_fields(None, ['name']))
+
+        base = descriptor_pb2.FileDescriptorProto(name='foo', package='bar')
+        message = descriptor_pb2.FileDescriptorProto()
+        message.CopyFrom(base)
+        self.assertEqual(set(), runtime.changed_fields(message, base=base))
+        message.name = 'baz'
+        message.dependency.append('qux')
+        message.ClearField('package')
+        message.options.SetInParent()
+        self.assertEqual({'name', 'package', 'dependency', 'options'}, runtime.changed_fields(message, base=base))
+        with self.assertRaises(ValueError):
+            runtime.changed_fields(message)
+
+    def test_partial_update(self):
+        sql = runtime.partial_update('UPDATE t SET ', ('a = %s', 'b = %s'), ' WHERE id = %s')
+        self.assertEqual('UPDATE t SET a = %s, b = %s WHERE id = %s', sql)
+        self.assertIs(sql, runtime.partial_update('UPDATE t SET ', ('a = %s', 'b = %s'), ' WHERE id = %s'))
+
+    def test_read_cache(self):
+        cache = runtime.ReadCache(max_size=2, ttl=60)
+        self.assertIsNone(cache.get((1,)))
+        for i in range(3):
+            cache.put((i,), descriptor_pb2.FileDescriptorProto(name=f'name {i}'))
+        # The least recently used entry is evicted
+        self.assertIsNone(cache.get((0,)))
+        message = cache.get((1,))
+        self.assertEqual('name 1', message.name)
+        message.name = 'changed'
+        self.assertEqual('name 1', cache.get((1,)).name)
+
+        cache.invalidate((1,))
+        self.assertIsNone(cache.get((1,)))
+        self.assertEqual({'size': 1, 'hits': 2, 'misses': 3, 'evictions': 1, 'expirations': 0}, cache.stats())
+
+        cache = runtime.ReadCache(max_size=2, ttl=0.01)
+        cache.put((1,), descriptor_pb2.FileDescriptorProto(name='foo'))
+        time.sleep(0.02)
+        self.assertIsNone(cache.get((1,)))
+        self.assertEqual({'size': 0, 'hits': 0, 'misses': 1, 'evictions': 0, 'expirations': 1}, cache.stats())
+
+    def test_pooled_passes_connection_through(self):
+        class FakeConnection:
+            def __init__(self):
+                self.adapters = self
+                self.dumpers = []
+
+            def register_dumper(self, cls, dumper):
+                self.dumpers.append((cls, dumper))
+
+        @runtime.pooled
+        def fun(conn, value):
+            return conn, value
+
+        conn = FakeConnection()
+        self.assertEqual((conn, 1), fun(conn, 1))
+        self.assertEqual((conn, 2), fun(conn, 2))
+        # The adapters are only registered once per connection
+        self.assertEqual(2, len(conn.dumpers))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+from collections import OrderedDict
+
+from config import Config
+from schema import Table, Column, Index, IndexType, ForeignRel, ForeignColumn, CustomQuery, BindVar
+from snapshot import Snapshot
+from .fakes import FakeSchema
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = Config('py-protodb.yaml')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.config.get_config()['generator']['snapshot'] = os.path.join(self.tmpdir.name, 'snapshot.json')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @staticmethod
+    def build_table():
+        table = Table('test_schema', 'user', OrderedDict(), {}, [], {}, {}, 'user_id', [], [], [], [], [])
+        table.columns['user_id'] = Column('user', 'test_schema', 'user_id', 'bigint', 'bigint', None, '', 1,
+                                          False, True, True)
+        table.columns['user_type'] = Column('user', 'test_schema', 'user_type', 'character varying',
+                                            'character varying', None, '', 2, True)
+        table.columns['user_type'].valid_values = ['BIG SHOT', 'LITTLE-SHOT']
+        table.indexes['pk_user'] = Index('user', 'test_schema', 'pk_user', IndexType.PRIMARY_KEY, ['user_id'])
+        table.relations.append(ForeignRel('fk_user_address', 'test_schema', 'address',
+                                          [ForeignColumn('address_id', 'address_id', 1)]))
+        table.mappings['get_user_type'] = CustomQuery('get_user_type', 'select user_type from test_schema.user',
+                                                      [BindVar('user_type', 'varchar')])
+        table.select_list.extend(['user_id', 'user_type'])
+        table.pkey_list.append('user_id')
+        return table
+
+    def test_round_trip(self):
+        snapshot = Snapshot(self.config)
+        table = self.build_table()
+        snapshot.save('abc', {'test_schema': FakeSchema({'user': table})})
+        self.assertIsNone(snapshot.load('def'))
+        tables = snapshot.load('abc')
+        self.assertEqual(table, tables['test_schema']['user'])
+
+    def test_config_hash_changes_with_config(self):
+        snapshot = Snapshot(self.config)
+        before = snapshot.config_hash()
+        self.config.get_config()['generator']['excluded_tables'].append('another')
+        self.assertNotEqual(before, snapshot.config_hash())
+
+
+if __name__ == '__main__':
+    unittest.main()